@@ -0,0 +1,50 @@
+"""promote hot fields to typed columns
+
+Revision ID: 5c2e1f8a9d40
+Revises: 37716151a213
+Create Date: 2026-10-18 10:12:03.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5c2e1f8a9d40'
+down_revision = '37716151a213'
+branch_labels = None
+depends_on = None
+
+# Keep in step with venus.decode.PROMOTABLE_FIELDS.
+COLUMNS = [
+    ('levelno', 'SMALLINT'),
+    ('name', 'TEXT'),
+    ('pathname', 'TEXT'),
+    ('hostname', 'TEXT'),
+    ('app', 'TEXT'),
+]
+
+
+def upgrade():
+    # Nullable and without defaults, so adding them does not rewrite
+    # existing rows. Older rows keep these fields in ``data``.
+    op.execute(
+        'ALTER TABLE logs '
+        + ', '.join(f'ADD COLUMN {name} {type_}' for name, type_ in COLUMNS)
+        + ';'
+    )
+
+    # Most queries want the latest records matching a filter, so the time
+    # is part of each index.
+    for name, _ in COLUMNS:
+        op.execute(f"CREATE INDEX idx_{name} ON logs ({name}, time DESC);")
+
+
+def downgrade():
+    for name, _ in COLUMNS:
+        op.execute(f"DROP INDEX idx_{name};")
+
+    op.execute(
+        'ALTER TABLE logs '
+        + ', '.join(f'DROP COLUMN {name}' for name, _ in COLUMNS)
+        + ';'
+    )
@@ -0,0 +1,59 @@
+"""compression and chunk interval
+
+Revision ID: a41d7c3e6b25
+Revises: 5c2e1f8a9d40
+Create Date: 2026-10-18 11:40:27.093152
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a41d7c3e6b25'
+down_revision = '5c2e1f8a9d40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The hypertables were created with an integer interval, which is
+    # taken as microseconds for a TIMESTAMPTZ column. 12 hours was meant.
+    # This only applies to new chunks.
+    op.execute("SELECT set_chunk_time_interval('logs', INTERVAL '12 hours');")
+    op.execute("SELECT set_chunk_time_interval('metric', INTERVAL '12 hours');")
+
+    # Compressed chunks store a segment per distinct value of the
+    # segmentby columns, so these must be few: a segment per
+    # correlation_id would hold only a handful of rows. The policies
+    # compress chunks once they are older than 7 days. Use
+    # `venus admin compression` to change these.
+    op.execute("""
+        ALTER TABLE logs SET (
+          timescaledb.compress,
+          timescaledb.compress_segmentby = 'app',
+          timescaledb.compress_orderby = 'time DESC'
+        );
+    """)
+    op.execute("SELECT add_compression_policy('logs', INTERVAL '7 days');")
+
+    op.execute("""
+        ALTER TABLE metric SET (
+          timescaledb.compress,
+          timescaledb.compress_orderby = 'time DESC'
+        );
+    """)
+    op.execute("SELECT add_compression_policy('metric', INTERVAL '7 days');")
+
+    # There is no retention policy by default, since it drops data. Use
+    # `venus admin retention` to add one.
+
+
+def downgrade():
+    for table in ('metric', 'logs'):
+        op.execute(f"SELECT remove_retention_policy('{table}', if_exists => true);")
+        op.execute(f"SELECT remove_compression_policy('{table}', if_exists => true);")
+        op.execute(f"""
+            SELECT decompress_chunk(c, if_compressed => true)
+            FROM show_chunks('{table}') c;
+        """)
+        op.execute(f"ALTER TABLE {table} SET (timescaledb.compress = false);")
@@ -0,0 +1,57 @@
+"""log volume rollups
+
+Revision ID: d7f3b9e0c162
+Revises: a41d7c3e6b25
+Create Date: 2026-10-18 14:05:51.772630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'd7f3b9e0c162'
+down_revision = 'a41d7c3e6b25'
+branch_labels = None
+depends_on = None
+
+# Continuous aggregate, bucket width, and its refresh policy: the window
+# that is refreshed, relative to now, and how often.
+ROLLUPS = [
+    ('logs_1m', '1 minute', '2 hours', '1 minute', '1 minute'),
+    ('logs_1h', '1 hour', '2 days', '1 hour', '30 minutes'),
+]
+
+
+def upgrade():
+    # Counts of records by the promoted columns. Records written before
+    # these columns were added are counted with NULLs for them. With
+    # materialized_only = false, the buckets that have not been
+    # materialized yet are computed from the raw rows at query time, so
+    # the latest minutes are not missing.
+    for view, width, start_offset, end_offset, schedule in ROLLUPS:
+        op.execute(f"""
+            CREATE MATERIALIZED VIEW {view}
+            WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+            SELECT
+              time_bucket(INTERVAL '{width}', time) AS bucket,
+              levelno,
+              name,
+              app,
+              count(*) AS records
+            FROM logs
+            GROUP BY bucket, levelno, name, app
+            WITH NO DATA;
+        """)
+        op.execute(f"CREATE INDEX idx_{view}_name ON {view} (name, bucket DESC);")
+        op.execute(f"CREATE INDEX idx_{view}_app ON {view} (app, bucket DESC);")
+        op.execute(f"""
+            SELECT add_continuous_aggregate_policy('{view}',
+              start_offset => INTERVAL '{start_offset}',
+              end_offset => INTERVAL '{end_offset}',
+              schedule_interval => INTERVAL '{schedule}');
+        """)
+
+
+def downgrade():
+    for view, *_ in reversed(ROLLUPS):
+        op.execute(f"DROP MATERIALIZED VIEW {view};")
@@ -0,0 +1,50 @@
+"""metric series columns
+
+Revision ID: e8a4c6d2f351
+Revises: d7f3b9e0c162
+Create Date: 2026-10-18 16:42:09.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e8a4c6d2f351'
+down_revision = 'd7f3b9e0c162'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A row is the aggregate of one series (name and tags) over one
+    # window, see `venus.aggregation`. The quantiles go in "data".
+    op.execute("""
+        ALTER TABLE metric
+          ADD COLUMN name TEXT,
+          ADD COLUMN tags JSONB,
+          ADD COLUMN count BIGINT,
+          ADD COLUMN sum DOUBLE PRECISION,
+          ADD COLUMN min DOUBLE PRECISION,
+          ADD COLUMN max DOUBLE PRECISION;
+    """)
+    op.execute("CREATE INDEX idx_metric_name ON metric (name, time DESC);")
+    op.execute("CREATE INDEX idxgin_metric_tags ON metric USING GIN (tags jsonb_path_ops);")
+
+    # Nothing was written to metric before, so there are no compressed
+    # chunks that would prevent changing this.
+    op.execute("ALTER TABLE metric SET (timescaledb.compress_segmentby = 'name');")
+
+
+def downgrade():
+    op.execute("ALTER TABLE metric SET (timescaledb.compress_segmentby = '');")
+    op.execute("DROP INDEX idxgin_metric_tags;")
+    op.execute("DROP INDEX idx_metric_name;")
+    op.execute("""
+        ALTER TABLE metric
+          DROP COLUMN max,
+          DROP COLUMN min,
+          DROP COLUMN sum,
+          DROP COLUMN count,
+          DROP COLUMN tags,
+          DROP COLUMN name;
+    """)
@@ -0,0 +1,25 @@
+"""context updated
+
+Revision ID: f2b7d95c0e18
+Revises: e8a4c6d2f351
+Create Date: 2026-10-18 18:20:37.511946
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f2b7d95c0e18'
+down_revision = 'e8a4c6d2f351'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The "created" of the context record, so that an older one, e.g.
+    # replayed from the spill log, does not replace a newer one.
+    op.execute("ALTER TABLE context ADD COLUMN updated TIMESTAMPTZ;")
+
+
+def downgrade():
+    op.execute("ALTER TABLE context DROP COLUMN updated;")
@@ -0,0 +1,87 @@
+"""
+Microbenchmark of the codecs on the ingest hot path.
+
+For each JSON codec, and for msgpack bodies (if msgpack is installed),
+this times the raw decode of a README-style log record, the re-encode
+of the data to JSON for the DB, and the full `decode_message` step done
+by `collect` for every message. No database is needed:
+
+    $ python benchmarks/bench_codec.py
+"""
+import argparse
+import json
+import time
+import uuid
+
+from venus import codec
+from venus.decode import CONTENT_TYPE_MSGPACK, decode_message, msgpack
+from venus.models import Message
+
+
+RECORD = {
+    "name": "root",
+    "msg": "blah blah blah",
+    "args": [],
+    "levelname": "INFO",
+    "levelno": 20,
+    "pathname": "tests/sender.py",
+    "filename": "sender.py",
+    "module": "sender",
+    "exc_text": None,
+    "stack_info": None,
+    "lineno": 59,
+    "funcName": "app_items",
+    "created": 1554635562.8368905,
+    "msecs": 836.890459060669,
+    "relativeCreated": 1485.8589172363281,
+    "thread": 15368,
+    "threadName": "MainThread",
+    "processName": "MainProcess",
+    "process": 11604,
+    "correlation_id": str(uuid.uuid4()),
+    "random_timing_data": 1.23,
+    "message": "blah blah blah",
+    "created_iso": "2019-04-07T11:12:42.836890+00:00"
+}
+
+
+def timeit(f, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def main(args):
+    payload = json.dumps(RECORD).encode()
+    msg = Message(b'INFO', payload)
+    codecs = ['json'] + (['orjson'] if codec.orjson else [])
+
+    print(f'{"codec":>16} {"bytes":>6} {"loads us":>10} {"dumps us":>10} '
+          f'{"decode_message us":>18}')
+    for name in codecs:
+        codec.use(name)
+        d = codec.loads(payload)
+        t_loads = timeit(lambda: codec.loads(payload), args.n)
+        t_dumps = timeit(lambda: codec.dumps(d), args.n)
+        t_decode = timeit(lambda: decode_message(msg), args.n)
+        print(f'{name:>16} {len(payload):>6} {t_loads:>10.2f} {t_dumps:>10.2f} '
+              f'{t_decode:>18.2f}')
+
+    if msgpack:
+        # The data still goes to the DB as JSON, with the fastest codec.
+        packed = msgpack.packb(RECORD)
+        msg = Message(b'INFO', packed, CONTENT_TYPE_MSGPACK)
+        d = msgpack.unpackb(packed)
+        t_loads = timeit(lambda: msgpack.unpackb(packed), args.n)
+        t_dumps = timeit(lambda: codec.dumps(d), args.n)
+        t_decode = timeit(lambda: decode_message(msg), args.n)
+        name = f'msgpack+{codec.NAME}'
+        print(f'{name:>16} {len(packed):>6} {t_loads:>10.2f} {t_dumps:>10.2f} '
+              f'{t_decode:>18.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', default=100000, type=int)
+    main(parser.parse_args())
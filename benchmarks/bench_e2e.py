@@ -0,0 +1,250 @@
+"""
+End-to-end throughput benchmark.
+
+Starts the venus pipeline in this process, drives it with M sender
+processes at a target rate each, and reports the sustained throughput,
+drop counts, end-to-end lag percentiles and memory use.
+
+By default the records go to the null sink, so no database is needed:
+
+    $ python benchmarks/bench_e2e.py --senders 4 --rate 5000 --duration 20
+
+Use ``--sinks ndjson`` to write to files, or ``--sinks postgres`` to
+write to the database configured with the usual DB_* env vars. Several
+sinks can be given, as in the ``SINKS`` setting, e.g.
+``--sinks postgres,ndjson``. Any other venus setting can be given as an
+env var as usual, e.g., ``DECODE_WORKERS=2`` or
+``ADAPTIVE_BATCHING=True``. The lag percentiles come from the sampled
+traces (``TRACE_SAMPLE_RATE``, 0.01 by default here), and are
+interpolated within histogram buckets.
+
+The throughput is measured from the first message received to the last
+commit, less the time that the last, partial batch waited for its flush
+deadline, so neither the sender start-up nor ``MAX_BATCH_AGE_SECONDS``
+is counted.
+
+``INGEST_WORKERS`` is not supported here, because the metrics are read
+from this process.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import time
+import uuid
+
+import portpicker
+import zmq
+
+
+def make_record(i):
+    return {
+        "name": "bench",
+        "msg": "This is a test %s",
+        "args": [i],
+        "levelname": "INFO",
+        "levelno": 20,
+        "pathname": "benchmarks/bench_e2e.py",
+        "filename": "bench_e2e.py",
+        "module": "bench_e2e",
+        "exc_text": None,
+        "stack_info": None,
+        "lineno": 42,
+        "funcName": "sender",
+        "created": time.time(),
+        "msecs": 836.890459060669,
+        "relativeCreated": 1485.8589172363281,
+        "thread": 15368,
+        "threadName": "MainThread",
+        "processName": "MainProcess",
+        "process": os.getpid(),
+        "correlation_id": str(uuid.uuid4()),
+        "message": f"This is a test {i}",
+    }
+
+
+def sender(port, rate, duration, batch, totals):
+    """Send at ``rate`` records per second for ``duration`` seconds,
+    ``batch`` records per message."""
+    from venus.decode import encode_batch
+
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PUSH)
+    sock.connect(f'tcp://127.0.0.1:{port}')
+    sent = hwm_drops = 0
+    start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+        due = int(rate * elapsed)
+        while sent + hwm_drops + batch <= due:
+            bodies = [json.dumps(make_record(sent + i)).encode()
+                      for i in range(batch)]
+            payload = encode_batch(bodies) if batch > 1 else bodies[0]
+            try:
+                sock.send_multipart([b'INFO', payload], flags=zmq.DONTWAIT)
+                sent += batch
+            except zmq.Again:
+                hwm_drops += batch
+        time.sleep(0.001)
+
+    sock.close(linger=5000)
+    ctx.term()
+    with totals.get_lock():
+        totals[0] += sent
+        totals[1] += hwm_drops
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+async def watch(marks):
+    """Note the times of the first and last receive, and of the last
+    commit, to within 10 ms."""
+    from venus import metrics
+
+    received = written = 0
+    while True:
+        now = time.perf_counter()
+        if metrics.MESSAGES_RECEIVED.value() != received:
+            received = metrics.MESSAGES_RECEIVED.value()
+            marks.setdefault('first_received', now)
+            marks['last_received'] = now
+        if metrics.RECORDS_WRITTEN.value() != written:
+            written = metrics.RECORDS_WRITTEN.value()
+            marks['last_commit'] = now
+        await asyncio.sleep(0.01)
+
+
+def measured_seconds(marks) -> float:
+    from venus.db import write
+
+    end = marks['last_commit']
+    if end > marks['last_received']:
+        # The last batch was flushed by its deadline, not by its size.
+        end = max(marks['last_received'], end - write.BATCHING.flush_age)
+    return end - marks['first_received']
+
+
+def shed() -> float:
+    from venus import metrics
+
+    # Counted by level.
+    return sum(metrics.MESSAGES_SHED.values.values())
+
+
+def handled(batch: int) -> float:
+    """Records that have been dealt with one way or another: written,
+    dropped, shed, spilled, or rejected by the decoder."""
+    from venus import metrics
+
+    return (metrics.RECORDS_WRITTEN.value()
+            + metrics.RECORDS_SPILLED.value()
+            + (metrics.MESSAGES_DROPPED.value() + shed()
+               + metrics.MESSAGES_SPILLED.value()) * batch
+            + metrics.DECODE_FAILURES.value()
+            + metrics.MISSING_CREATED.value())
+
+
+async def run(args):
+    from venus import main, metrics
+
+    tasks = await main.amain(None)
+    await asyncio.sleep(1)
+    marks = {}
+    watcher = asyncio.get_event_loop().create_task(watch(marks))
+
+    mp = multiprocessing.get_context('spawn')
+    totals = mp.Array('q', 2)
+    procs = [
+        mp.Process(target=sender,
+                   args=(args.port, args.rate, args.duration, args.batch, totals))
+        for _ in range(args.senders)
+    ]
+    for p in procs:
+        p.start()
+
+    peak_rss = rss_mb()
+    while any(p.is_alive() for p in procs):
+        await asyncio.sleep(0.5)
+        peak_rss = max(peak_rss, rss_mb())
+    sent, hwm_drops = totals[0], totals[1]
+
+    # Wait for the pipeline to catch up with what was received.
+    deadline = time.perf_counter() + args.drain_timeout
+    while time.perf_counter() < deadline:
+        if handled(args.batch) >= sent:
+            break
+        await asyncio.sleep(0.1)
+        peak_rss = max(peak_rss, rss_mb())
+    watcher.cancel()
+
+    for t in tasks.values():
+        t.cancel()
+    await asyncio.sleep(0.5)
+
+    written = metrics.RECORDS_WRITTEN.value()
+    lag = metrics.END_TO_END_LAG_SECONDS
+    print(f'sinks:                  {os.environ["SINKS"]}')
+    print(f'senders x rate:         {args.senders} x {args.rate}/s '
+          f'for {args.duration}s')
+    print(f'sent:                   {sent}')
+    print(f'dropped at sender HWM:  {hwm_drops}')
+    print(f'messages received:      {metrics.MESSAGES_RECEIVED.value():.0f}')
+    print(f'msgs dropped (full q):  {metrics.MESSAGES_DROPPED.value():.0f}')
+    print(f'msgs shed (by level):   {shed():.0f}')
+    print(f'msgs spilled:           {metrics.MESSAGES_SPILLED.value():.0f}')
+    print(f'records spilled:        {metrics.RECORDS_SPILLED.value():.0f}')
+    print(f'written:                {written:.0f}')
+    if written:
+        print(f'sustained msgs/sec:     {written / measured_seconds(marks):,.0f}')
+    print(f'lag p50 / p99 (s):      {lag.quantile(0.5):.3f} / '
+          f'{lag.quantile(0.99):.3f} ({lag.count()} samples)')
+    print(f'RSS now / peak (MB):    {rss_mb():.1f} / {peak_rss:.1f}')
+    print(f'max RSS (getrusage):    '
+          f'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--senders', default=2, type=int)
+    parser.add_argument('-r', '--rate', default=5000, type=int,
+                        help='Records per second, per sender.')
+    parser.add_argument('-d', '--duration', default=10.0, type=float)
+    parser.add_argument('-b', '--batch', default=1, type=int,
+                        help='Records per message, in a batch envelope.')
+    parser.add_argument('--sinks', default='null',
+                        help='Comma-separated: null, ndjson, postgres.')
+    parser.add_argument('--drain-timeout', default=30.0, type=float)
+    args = parser.parse_args()
+    args.port = portpicker.pick_unused_port()
+
+    # These must be set before venus is imported.
+    os.environ['VENUS_PORT'] = str(args.port)
+    os.environ['SINKS'] = args.sinks
+    os.environ.setdefault('NDJSON_PATH', 'bench-e2e.ndjson')
+    os.environ.setdefault('TRACE_SAMPLE_RATE', '0.01')
+    os.environ.setdefault('ENABLE_CONSUL_REFRESH', 'False')
+    os.environ.setdefault('START_LOG_LEVEL', 'WARNING')
+    os.environ['HEALTH_CHECK_PORT'] = str(portpicker.pick_unused_port())
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['QUERY_PORT'] = '0'
+
+    import logging
+    logging.basicConfig(level=os.environ['START_LOG_LEVEL'])
+
+    from venus import io
+    with io.zmq_context():
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
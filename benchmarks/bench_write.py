@@ -0,0 +1,80 @@
+"""
+Compare rows/sec of the COPY and executemany writers.
+
+Needs a running database with the venus migrations applied. The
+connection is configured with the usual DB_* env vars, e.g.:
+
+    $ DB_PORT=5432 python benchmarks/bench_write.py --rows 100000
+
+By default the rows go into a temporary table that copies ``logs``,
+including its indexes, since keeping those up to date is most of the
+cost of an insert. The temporary table is dropped when the connection
+closes, so nothing is left behind. Use ``--hypertable`` to write into
+``logs`` itself, which adds the TimescaleDB chunk routing overhead.
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+
+import asyncpg
+
+from venus.db import get_db_url, set_json_charset
+from venus.sinks import copy_records, insert_records
+
+
+BATCH_SIZES = (100, 1000, 10000)
+WRITERS = dict(copy=copy_records, insert=insert_records)
+
+
+def make_records(n):
+    data = json.dumps(dict(
+        name='bench',
+        msg='blah blah blah',
+        levelname='INFO',
+        levelno=20,
+        pathname='benchmarks/bench_write.py',
+        filename='bench_write.py',
+        lineno=42,
+        process=1234,
+        random_timing_data=1.23,
+    ))
+    now = datetime.now(tz=timezone.utc)
+    return [(now, 'blah blah blah', uuid.uuid4(), data) for _ in range(n)]
+
+
+async def run(args):
+    conn = await asyncpg.connect(get_db_url())
+    await set_json_charset(conn)
+    table = 'logs'
+    if not args.hypertable:
+        table = 'bench_logs'
+        await conn.execute(
+            f'CREATE TEMP TABLE {table} (LIKE logs INCLUDING ALL)')
+
+    records = make_records(args.rows)
+    print(f'{"writer":>8} {"batch":>8} {"rows/sec":>12}')
+    try:
+        for batch_size in BATCH_SIZES:
+            for name, writer in WRITERS.items():
+                t0 = time.perf_counter()
+                for i in range(0, len(records), batch_size):
+                    await writer(conn, records[i:i + batch_size], table=table)
+                elapsed = time.perf_counter() - t0
+                print(f'{name:>8} {batch_size:>8} {len(records) / elapsed:>12,.0f}')
+    finally:
+        if args.hypertable:
+            await conn.execute(
+                "DELETE FROM logs WHERE message = 'blah blah blah' "
+                "AND data->>'name' = 'bench'")
+        await conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rows', default=100000, type=int)
+    parser.add_argument('--hypertable', action='store_true',
+                        help='Write into the real logs hypertable.')
+    asyncio.run(run(parser.parse_args()))
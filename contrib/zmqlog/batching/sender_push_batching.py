@@ -0,0 +1,141 @@
+"""
+A PUSH logging handler that sends records in batches.
+
+Records are buffered, and sent as one ZMQ message holding a venus batch
+envelope when ``max_records`` have been buffered, or when the oldest
+buffered record is ``max_age`` seconds old, whichever comes first. This
+saves a send call and the ZMQ framing per record, and compresses much
+better than single records do (``compress='zstd'``).
+
+The envelope is ``b'VNB1'``, followed by each JSON record as a 4-byte
+big-endian length and the record itself. The level frame of a batch is
+the highest level among its records.
+
+Run venus, then:
+
+    $ python contrib/zmqlog/batching/sender_push_batching.py
+"""
+import logging
+import struct
+import threading
+import time
+from collections import defaultdict
+
+import logjson
+import zmq
+
+BATCH_MAGIC = b'VNB1'
+BATCH_LENGTH = struct.Struct('!I')
+
+
+class BatchingPUSHHandler(logging.Handler):
+
+    def __init__(self, sock: zmq.Socket, max_records=500, max_age=1.0,
+                 compress=None):
+        super().__init__()
+        self.socket = sock
+        self.max_records = max_records
+        self.max_age = max_age
+        self.compress = None
+        if compress == 'zstd':
+            import zstandard
+            self.compress = zstandard.ZstdCompressor().compress
+        elif compress == 'lz4':
+            import lz4.frame
+            self.compress = lz4.frame.compress
+        elif compress:
+            raise ValueError(f'Unknown compression: {compress}')
+        self.formatters = defaultdict(logjson.JSONFormatter)
+
+        self.parts = [BATCH_MAGIC]
+        self.count = 0
+        self.levelno = 0
+        self.levelname = ''
+        self.started = None
+
+        # Flushes on age. The socket is only ever used under the handler
+        # lock, so it is not used from two threads at the same time.
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.flush_on_age, daemon=True)
+        self.timer.start()
+
+    def format(self, record):
+        return self.formatters[record.levelno].format(record)
+
+    def emit(self, record):
+        # Called with the handler lock held.
+        try:
+            body = self.format(record).encode()
+        except Exception:
+            self.handleError(record)
+            return
+
+        if not self.count:
+            self.started = time.monotonic()
+        self.parts.append(BATCH_LENGTH.pack(len(body)))
+        self.parts.append(body)
+        self.count += 1
+        if record.levelno > self.levelno:
+            self.levelno, self.levelname = record.levelno, record.levelname
+        if self.count >= self.max_records:
+            self.send()
+
+    def send(self):
+        if not self.count:
+            return
+        payload = b''.join(self.parts)
+        if self.compress:
+            payload = self.compress(payload)
+        level = self.levelname.encode()
+        self.parts = [BATCH_MAGIC]
+        self.count = 0
+        self.levelno = 0
+        try:
+            self.socket.send_multipart([level, payload], flags=zmq.DONTWAIT)
+        except zmq.Again:
+            # The SNDHWM was reached. Drop the batch rather than block
+            # the application.
+            print('HWM reached, dropping a batch of log records')
+
+    def flush(self):
+        self.acquire()
+        try:
+            self.send()
+        finally:
+            self.release()
+
+    def flush_on_age(self):
+        while not self.closed.wait(self.max_age / 4):
+            self.acquire()
+            try:
+                if self.count and time.monotonic() - self.started >= self.max_age:
+                    self.send()
+            finally:
+                self.release()
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+        super().close()
+
+
+if __name__ == '__main__':
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.PUSH)
+    socket.connect('tcp://127.0.0.1:5049')
+
+    handler = BatchingPUSHHandler(socket, max_records=100, max_age=0.5,
+                                  compress='zstd')
+    handler.setLevel('INFO')
+
+    logging.basicConfig(level='DEBUG')
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+
+    for i in range(1000):
+        logger.info('blah %d', i)
+        time.sleep(0.01)
+
+    handler.close()
+    socket.close(linger=1000)
+    ctx.term()
@@ -0,0 +1,85 @@
+"""
+A PUSH logging handler that compresses the message bodies.
+
+Venus recognises zstd and lz4 frames by their magic number, so no
+change is needed on the receiving side beyond installing the
+decompressor (``pip install venus-bug-trap[compression]``). Bodies
+smaller than ``min_bytes`` are sent as they are, since compressing a
+short record on its own saves little.
+
+Run venus, then:
+
+    $ python contrib/zmqlog/compressed/sender_push_compressed.py
+"""
+import logging
+import time
+from collections import defaultdict
+
+import logjson
+import zmq
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class CompressingPUSHHandler(logging.Handler):
+    """Sends ``[level, body]`` on a PUSH socket, like the handler in
+    ``loghandlerzmq``, with the body compressed with ``method`` ("zstd"
+    or "lz4"). Messages are dropped if the socket's SNDHWM is reached,
+    rather than blocking the application."""
+
+    def __init__(self, sock: zmq.Socket, method='zstd', level=3,
+                 min_bytes=256):
+        super().__init__()
+        self.socket = sock
+        self.min_bytes = min_bytes
+        if method == 'zstd':
+            self.compress = zstandard.ZstdCompressor(level=level).compress
+        elif method == 'lz4':
+            self.compress = lambda data: lz4.frame.compress(
+                data, compression_level=level)
+        else:
+            raise ValueError(f'Unknown compression: {method}')
+        self.formatters = defaultdict(logjson.JSONFormatter)
+
+    def format(self, record):
+        return self.formatters[record.levelno].format(record)
+
+    def emit(self, record):
+        try:
+            body = self.format(record).encode()
+            if len(body) >= self.min_bytes:
+                body = self.compress(body)
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self.socket.send_multipart([record.levelname.encode(), body],
+                                       flags=zmq.DONTWAIT)
+        except zmq.Again:
+            self.handleError(record)
+
+
+if __name__ == '__main__':
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.PUSH)
+    socket.connect('tcp://127.0.0.1:5049')
+
+    handler = CompressingPUSHHandler(socket, method='zstd')
+    handler.setLevel('INFO')
+
+    logging.basicConfig(level='DEBUG')
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+
+    for i in range(100):
+        logger.info('blah %d', i, extra=dict(padding='x' * 500))
+        time.sleep(1)
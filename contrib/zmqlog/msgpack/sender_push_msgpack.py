@@ -0,0 +1,83 @@
+"""
+Sending log records to venus as MessagePack instead of JSON.
+
+`MsgpackFormatter` produces the same fields as ``logjson.JSONFormatter``,
+packed with msgpack. `MsgpackPUSHHandler` sends them with the content
+type frame that tells venus how to decode them:
+
+    [level, body, b'application/msgpack']
+
+Venus needs ``pip install venus-bug-trap[msgpack]``. Run it, then:
+
+    $ python contrib/zmqlog/msgpack/sender_push_msgpack.py
+"""
+import datetime
+import logging
+import time
+import traceback
+
+import msgpack
+import zmq
+
+CONTENT_TYPE = b'application/msgpack'
+
+
+class MsgpackFormatter(logging.Formatter):
+    """Returns bytes, not str."""
+
+    def format(self, record):
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = ''.join(
+                traceback.format_exception(*record.exc_info))
+            record.message += '\n' + record.exc_text
+        record.created_iso = datetime.datetime.fromtimestamp(
+            record.created, datetime.timezone.utc).isoformat()
+
+        d = dict(record.__dict__)
+        # This doesn't serialise well.
+        del d['exc_info']
+        # Anything else that msgpack cannot pack, e.g., objects in
+        # ``args``, becomes a string, as with ``json.dumps(default=str)``.
+        return msgpack.packb(d, default=str)
+
+
+class MsgpackPUSHHandler(logging.Handler):
+    """Messages are dropped if the socket's SNDHWM is reached, rather
+    than blocking the application."""
+
+    def __init__(self, sock: zmq.Socket):
+        super().__init__()
+        self.socket = sock
+        self.setFormatter(MsgpackFormatter())
+
+    def emit(self, record):
+        try:
+            body = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self.socket.send_multipart(
+                [record.levelname.encode(), body, CONTENT_TYPE],
+                flags=zmq.DONTWAIT)
+        except zmq.Again:
+            self.handleError(record)
+
+
+if __name__ == '__main__':
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.PUSH)
+    socket.connect('tcp://127.0.0.1:5049')
+
+    handler = MsgpackPUSHHandler(socket)
+    handler.setLevel('INFO')
+
+    logging.basicConfig(level='DEBUG')
+    logger = logging.getLogger()
+    logger.addHandler(handler)
+
+    for i in range(100):
+        logger.info('blah %d', i)
+        time.sleep(1)
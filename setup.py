@@ -16,7 +16,10 @@ extras_require = dict(
      dev=['wheel', 'logjson', 'alembic', 'bumpversion'],
      test=['pytest', 'pytest-cov', 'pytest-asyncio', 'dockerctx',
            'portpicker', 'alembic'],
-     doc=['sphinx', 'sphinxcontrib-fulltoc', 'sphinxcontrib-websupport']
+     doc=['sphinx', 'sphinxcontrib-fulltoc', 'sphinxcontrib-websupport'],
+     fast=['orjson'],
+     compression=['zstandard', 'lz4'],
+     msgpack=['msgpack'],
 )
 
 extras_require['all'] = list(
@@ -5,6 +5,7 @@ import os
 import pathlib
 import sys
 import uuid
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timezone
 
 import alembic.config
@@ -14,6 +15,7 @@ import pytest
 import sqlalchemy
 from asyncpg import Connection
 
+from venus import settings
 from venus.db import (
     init_database_pool,
     get_db_pool,
@@ -50,6 +52,23 @@ def loop():
     return l
 
 
+@contextmanager
+def _config_change(**values):
+    with ExitStack() as stack:
+        for name, value in values.items():
+            stack.enter_context(biodome.env_change(name, value))
+        settings.refresh_config()
+        yield settings.CONFIG
+    settings.refresh_config()
+
+
+@pytest.fixture(scope='session')
+def config_change():
+    """Change env vars, and the `settings.CONFIG` snapshot with them,
+    for the duration of a ``with`` block."""
+    return _config_change
+
+
 @pytest.fixture(scope='module')
 def db_pool(loop):
     """ This fixture will set the application-level DB
@@ -81,7 +100,7 @@ def db_fixture():
     db_host = 'localhost'
     db_port = biodome.environ.get('DEV_DBPORT', 0) or dockerctx.get_open_port()
     db_name = 'postgres'
-    image_name = 'timescale/timescaledb:latest-pg10'
+    image_name = 'timescale/timescaledb:latest-pg14'
 
     with dockerctx.new_container(
             image_name=image_name,
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import contextlib
+from datetime import datetime, timezone
+
+import pytest
+
+from venus import admin
+
+
+@pytest.fixture
+def parser():
+    parser = argparse.ArgumentParser()
+    admin.add_parser(parser.add_subparsers(dest='command'))
+    return parser
+
+
+def test_parse_compression(parser):
+    args = parser.parse_args(
+        ['admin', 'compression', '--segment-by', 'app, name', '--after', '3 days'])
+    assert args.table == 'logs'
+    assert args.segment_by == ['app', 'name']
+    assert args.order_by == ['time DESC']
+    assert args.after == '3 days'
+
+    args = parser.parse_args(['admin', 'compression', '--after', '3 days'])
+    assert args.segment_by is None
+
+    with pytest.raises(SystemExit):
+        parser.parse_args(['admin', 'compression', '--segment-by', "app'; --"])
+    with pytest.raises(SystemExit):
+        parser.parse_args(['admin', 'retention', '--table', 'span', '--off'])
+    with pytest.raises(SystemExit):
+        parser.parse_args(['admin', 'retention'])
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executed = []
+
+    async def execute(self, sql, *args):
+        self.executed.append(sql)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+def test_set_compression(loop):
+    conn = FakeConnection()
+    loop.run_until_complete(admin.set_compression(conn, 'logs', after='3 days'))
+    # The segmenting set by the migrations is left alone.
+    assert conn.executed[0] == (
+        "ALTER TABLE logs SET (timescaledb.compress, "
+        "timescaledb.compress_orderby = 'time DESC')")
+
+    conn = FakeConnection()
+    loop.run_until_complete(admin.set_compression(conn, 'logs', []))
+    assert conn.executed == [
+        "ALTER TABLE logs SET (timescaledb.compress, "
+        "timescaledb.compress_segmentby = '', "
+        "timescaledb.compress_orderby = 'time DESC')"]
+
+
+def test_main_unreachable(loop, parser, monkeypatch):
+    monkeypatch.setattr(admin.db, 'get_db_url',
+                        lambda: 'postgres://venus@127.0.0.1:1/venus')
+    try:
+        assert admin.main(parser.parse_args(['admin', 'report'])) == 1
+    finally:
+        # asyncio.run() leaves no current event loop behind.
+        asyncio.set_event_loop(loop)
+
+
+def test_format_report():
+    t = datetime(2019, 4, 7, tzinfo=timezone.utc)
+    rows = [
+        dict(chunk_name='_hyper_1_1_chunk', range_start=t,
+             compression_status='Compressed', before_bytes=10 * 2 ** 20,
+             after_bytes=2 ** 20),
+        dict(chunk_name='_hyper_1_2_chunk', range_start=t,
+             compression_status='Uncompressed', before_bytes=None,
+             after_bytes=None),
+    ]
+    report = admin.format_report(rows).splitlines()
+    assert report[1].split()[-5:] == ['10', 'MB', '1', 'MB', '10.0x']
+    assert report[2].split()[-3:] == ['-', '-', '-']
+    assert report[-1] == '2 chunks. Compressed chunks: 10 MB -> 1 MB (10.0x)'
+
+
+def test_compression_report(loop, randomly_generated_data, db_pool):
+    async def run():
+        async with db_pool.acquire() as conn:
+            await admin.set_retention(conn, 'logs', '3650 days')
+            await admin.set_chunk_interval(conn, 'logs', '1 day')
+            await conn.execute(
+                "SELECT compress_chunk(c) FROM show_chunks('logs') c")
+            return await admin.compression_report(conn, 'logs')
+
+    rows = loop.run_until_complete(run())
+    assert rows
+    assert all(r['compression_status'] == 'Compressed' for r in rows)
+    assert all(r['after_bytes'] for r in rows)
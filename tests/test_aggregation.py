@@ -0,0 +1,62 @@
+import json
+import random
+from datetime import datetime
+
+import pytest
+
+from venus.aggregation import Aggregator, Sketch
+
+
+def test_sketch_quantiles():
+    rng = random.Random(1)
+    values = [rng.lognormvariate(0, 2) for _ in range(10000)]
+    values += [-v for v in values[:1000]] + [0.0] * 500
+    sketch = Sketch(relative_accuracy=0.01)
+    for v in values:
+        sketch.add(v)
+
+    values.sort()
+    for q in (0.01, 0.05, 0.1, 0.5, 0.9, 0.99):
+        expected = values[int(q * (len(values) - 1))]
+        assert sketch.quantile(q) == pytest.approx(expected, rel=0.0201)
+    # Far fewer buckets than values.
+    assert len(sketch.positive) + len(sketch.negative) < 2000
+    assert Sketch().quantile(0.5) is None
+
+
+def test_aggregate_windows():
+    agg = Aggregator(window=10)
+    tags = (('route', '/'),)
+    agg.add([(100.0, 'latency', tags, 1.0),
+             (105.0, 'latency', tags, 3.0),
+             (109.9, 'latency', (), 5.0),
+             (110.0, 'latency', tags, 7.0)])
+    assert len(agg.series) == 3
+
+    # The window from 110 has not ended yet.
+    rows = sorted(agg.take(now=115.0), key=lambda r: r[3])
+    assert len(rows) == 2
+    time, name, tags_json, count, total, low, high, data = rows[1]
+    assert time == datetime.fromtimestamp(100)
+    assert name == 'latency'
+    assert json.loads(tags_json) == {'route': '/'}
+    assert (count, total, low, high) == (2, 4.0, 1.0, 3.0)
+    quantiles = json.loads(data)
+    assert set(quantiles) == {'p50', 'p90', 'p99'}
+    # Clamped to the extremes.
+    assert quantiles['p99'] <= 3.0
+    assert json.loads(rows[0][2]) == {}
+
+    assert len(agg.take()) == 1
+    assert not agg.series
+
+
+def test_max_series():
+    agg = Aggregator(window=10, max_series=2)
+    samples = [(100.0, f'm{i}', (), 1.0) for i in range(4)]
+    assert agg.add(samples) == 2
+    # Known series still get samples.
+    assert agg.add([(101.0, 'm0', (), 2.0)]) == 0
+    assert agg.series[(100.0, 'm0', ())].count == 2
+    agg.take()
+    assert agg.add(samples[2:]) == 0
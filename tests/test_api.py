@@ -0,0 +1,101 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+import portpicker
+import pytest
+
+from venus import api
+
+
+def test_logs_filters():
+    filters = api.logs_filters(dict(level='warning', start='2019-04-07T10:00:00Z',
+                                    contains='{"a": [1]}', app='billing'))
+    assert filters == dict(
+        min_levelno=30, start=datetime(2019, 4, 7, 10, tzinfo=timezone.utc),
+        contains='{"a": [1]}', app='billing')
+
+    for params in (dict(correlation_id='abc'), dict(end='yesterday'),
+                   dict(level='LOUD'), dict(contains='{'), dict(limit='0'),
+                   dict(limit='many')):
+        with pytest.raises(api.BadRequest):
+            api.logs_filters(params)
+            api.page_size(params)
+
+
+async def http_get(port, path, **params):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path}?{urlencode(params)} HTTP/1.1\r\n\r\n'.encode())
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return head.split(b' ')[1], body
+
+
+def test_stream_pages(loop, db_fixture, db_pool):
+    port = portpicker.pick_unused_port()
+    correlation_id = uuid.uuid4()
+    t = datetime(2019, 4, 8, 10, tzinfo=timezone.utc)
+    # Two records share a time, so the first page has 3 records.
+    times = [t, t - timedelta(seconds=1), t - timedelta(seconds=1),
+             t - timedelta(seconds=2)]
+    rows = [(time, f'record {i}', correlation_id, json.dumps(dict(i=i)))
+            for i, time in enumerate(times)]
+
+    async def run():
+        async with db_pool.acquire() as conn:
+            await conn.executemany(
+                'INSERT INTO logs (time, message, correlation_id, data) '
+                'VALUES ($1, $2, $3, $4)', rows)
+        server = loop.create_task(api.serve(port, host='127.0.0.1'))
+        await asyncio.sleep(0.5)
+        try:
+            first = await http_get(port, '/logs', limit=2,
+                                   correlation_id=str(correlation_id))
+            last = json.loads(first[1].splitlines()[-1])
+            second = await http_get(port, '/logs', limit=2, before=last['time'],
+                                    correlation_id=str(correlation_id))
+            contains = await http_get(port, '/logs', contains='{"i": 3}',
+                                      correlation_id=str(correlation_id))
+            bad = await http_get(port, '/logs', level='LOUD')
+            missing = await http_get(port, '/nothing')
+        finally:
+            server.cancel()
+            await asyncio.sleep(0.1)
+        return first, second, contains, bad, missing
+
+    first, second, contains, bad, missing = loop.run_until_complete(run())
+
+    def messages(response):
+        return [json.loads(line)['message'] for line in response[1].splitlines()]
+
+    assert first[0] == b'200'
+    assert messages(first) == ['record 0', 'record 1', 'record 2']
+    assert messages(second) == ['record 3']
+    assert json.loads(contains[1])['data'] == dict(i=3)
+    assert bad[0] == b'400'
+    assert missing[0] == b'404'
+
+
+def test_unavailable(loop, config_change):
+    class BusyPool:
+        async def acquire(self, timeout=None):
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError
+
+    async def run():
+        with config_change(QUERY_ACQUIRE_TIMEOUT_SECONDS=0.01):
+            server = await asyncio.start_server(
+                lambda r, w: api.handle(BusyPool(), r, w), host='127.0.0.1',
+                port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await http_get(port, '/logs', level='ERROR')
+            finally:
+                server.close()
+
+    status, body = loop.run_until_complete(run())
+    assert status == b'503'
+    assert body == b'Too many queries, try again later\n'
@@ -0,0 +1,125 @@
+import asyncio
+
+from venus import sinks
+from venus.db import write
+from venus.db.write import AdaptiveBatching, BatchPipeline
+from venus.decode import LOG_COLUMNS
+
+
+def feed(policy, rate, latency, seconds=10.0, step=0.5):
+    t = 0.0
+    while t < seconds:
+        t += step
+        policy.observe_arrivals(int(rate * step), t)
+        policy.observe_insert(policy.batch_size, latency)
+
+
+def test_adaptive_light_load(config_change):
+    with config_change(MIN_BATCH_SIZE=10, MAX_BATCH_SIZE=5000,
+                       MIN_BATCH_AGE_SECONDS=0.05, MAX_BATCH_AGE_SECONDS=5.0):
+        policy = AdaptiveBatching(max_inflight=4)
+        feed(policy, rate=2, latency=0.002)
+        # Inserts are fast, so there is no reason to hold rows back.
+        assert policy.flush_age == 0.05
+        assert policy.batch_size == 10
+
+
+def test_adaptive_heavy_load(config_change):
+    with config_change(MIN_BATCH_SIZE=10, MAX_BATCH_SIZE=5000,
+                       MIN_BATCH_AGE_SECONDS=0.05, MAX_BATCH_AGE_SECONDS=5.0):
+        policy = AdaptiveBatching(max_inflight=4)
+        feed(policy, rate=50000, latency=0.2)
+        snapshot = policy.snapshot()
+        assert 0.05 < policy.flush_age < 5.0
+        assert policy.batch_size == 5000
+        assert snapshot['arrival_rate'] > 40000
+
+
+def test_adaptive_bounds(config_change):
+    with config_change(MAX_BATCH_SIZE=100, MAX_BATCH_AGE_SECONDS=1.0):
+        policy = AdaptiveBatching(max_inflight=1)
+        feed(policy, rate=1000, latency=30.0)
+        assert policy.flush_age == 1.0
+        assert policy.batch_size == 100
+
+
+def test_adaptive_follows_config_changes(config_change):
+    policy = AdaptiveBatching(max_inflight=1)
+    feed(policy, rate=1000, latency=30.0)
+    with config_change(MAX_BATCH_SIZE=50, MAX_BATCH_AGE_SECONDS=0.5):
+        policy.on_config(None, None)
+        assert policy.flush_age == 0.5
+        assert policy.batch_size == 50
+
+
+class GatedSink(sinks.Sink):
+    """Holds every write until ``release`` is set, and fails the first
+    ``failures`` of them."""
+    name = 'gated'
+
+    def __init__(self, failures=0):
+        self.release = asyncio.Event()
+        self.failures = failures
+        self.active = 0
+        self.max_active = 0
+        self.written = []
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await self.release.wait()
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError('down')
+            self.written.append(list(records))
+        finally:
+            self.active -= 1
+
+
+def test_pipeline_inflight_limit(loop, monkeypatch):
+    sink = GatedSink()
+    monkeypatch.setattr(sinks, 'SINK', sink)
+
+    async def run():
+        pipeline = BatchPipeline(2)
+        await pipeline.submit([(0,)])
+        await pipeline.submit([(1,)])
+        third = loop.create_task(pipeline.submit([(2,)]))
+        await asyncio.sleep(0.05)
+        # The third batch waits for a free slot.
+        assert not third.done()
+        assert pipeline.inflight == 2
+        sink.release.set()
+        await third
+        await pipeline.drain()
+        return pipeline
+
+    pipeline = loop.run_until_complete(run())
+    assert sink.max_active == 2
+    assert pipeline.inflight == 0
+    assert pipeline.completed == 3
+    assert sink.written == [[(0,)], [(1,)], [(2,)]]
+
+
+def test_pipeline_retries_with_backoff(loop, monkeypatch, config_change):
+    sink = GatedSink(failures=3)
+    sink.release.set()
+    monkeypatch.setattr(sinks, 'SINK', sink)
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(write.asyncio, 'sleep', fake_sleep)
+    with config_change(WRITE_RETRY_MAX_SECONDS=3.0):
+        pipeline = BatchPipeline(1)
+        loop.run_until_complete(pipeline.write(0, [(0,)]))
+
+    # Doubling from one second, up to WRITE_RETRY_MAX_SECONDS.
+    assert delays == [1.0, 2.0, 3.0]
+    assert pipeline.failed_attempts == 3
+    assert pipeline.completed == 1
+    assert sink.written == [[(0,)]]
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from venus import codec
+
+
+@pytest.fixture(params=['json', 'orjson'])
+def each_codec(request):
+    if request.param == 'orjson' and not codec.orjson:
+        pytest.skip('orjson is not installed')
+    previous = codec.NAME
+    codec.use(request.param)
+    try:
+        yield request.param
+    finally:
+        codec.use(previous)
+
+
+def test_roundtrip(each_codec):
+    d = dict(a=1, b=[1.5, None, 'x'], c=dict(d='é'))
+    encoded = codec.dumps(d)
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == d
+    assert codec.loads(encoded.decode()) == d
+
+
+def test_non_standard_floats(each_codec):
+    # The stdlib json.dumps emits these by default, and orjson rejects
+    # them. The codec falls back to the stdlib.
+    d = codec.loads(b'{"a": NaN, "b": Infinity}')
+    assert d['a'] != d['a']
+    assert d['b'] == float('inf')
+
+
+def test_jsonb_binary(each_codec):
+    for value in (b'{"a": 1}', '{"a": 1}', dict(a=1)):
+        encoded = codec.encode_jsonb(value)
+        assert encoded[:1] == codec.JSONB_VERSION
+        assert json.loads(codec.decode_jsonb(encoded)) == dict(a=1)
@@ -0,0 +1,50 @@
+import json
+from collections import Counter
+
+import pytest
+
+from venus import compression
+from venus.decode import decode_chunk
+
+zstandard = pytest.importorskip('zstandard')
+lz4_frame = pytest.importorskip('lz4.frame')
+
+COMPRESSORS = dict(
+    zstd=lambda data: zstandard.ZstdCompressor().compress(data),
+    lz4=lz4_frame.compress,
+)
+
+
+def make_payload(i):
+    return json.dumps(dict(created=1554635562.8 + i, message=f'test {i}',
+                           padding='x' * 1000)).encode()
+
+
+@pytest.mark.parametrize('method', ['zstd', 'lz4'])
+def test_decompress(method):
+    data = make_payload(0)
+    compressed = COMPRESSORS[method](data)
+    assert len(compressed) < len(data)
+    assert compression.compression_of(compressed) == method
+    assert compression.decompress(compressed) == data
+    # Uncompressed payloads pass through.
+    assert compression.compression_of(data) == ''
+    assert compression.decompress(data) is data
+
+
+def test_decode_mixed_chunk():
+    payloads = [make_payload(0),
+                COMPRESSORS['zstd'](make_payload(1)),
+                COMPRESSORS['lz4'](make_payload(2)),
+                compression.ZSTD_MAGIC + b'garbage']
+    records, stats, _ = decode_chunk(payloads)
+    assert [r[1] for r in records] == ['test 0', 'test 1', 'test 2']
+    assert stats == Counter(compressed=2, decode_failures=1)
+
+
+@pytest.mark.parametrize('method', ['zstd', 'lz4'])
+def test_decompress_limit(method, config_change):
+    compressed = COMPRESSORS[method](b' ' * 10000)
+    with config_change(DECOMPRESS_MAX_BYTES=1000):
+        with pytest.raises(ValueError):
+            compression.decompress(compressed)
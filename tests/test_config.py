@@ -0,0 +1,26 @@
+import biodome
+
+from venus import settings
+
+
+def test_refresh_config():
+    changes = []
+    callback = lambda old, new: changes.append((old, new))
+    settings.subscribe(callback)
+    try:
+        before = settings.CONFIG
+        assert not settings.refresh_config()
+        assert settings.CONFIG is before
+
+        with biodome.env_change('DROP_FIELDS', ['a', 'b']):
+            assert settings.refresh_config()
+            assert settings.CONFIG.drop_fields == frozenset({'a', 'b'})
+            assert changes == [(before, settings.CONFIG)]
+            # The same values again: nothing happens.
+            assert not settings.refresh_config()
+            assert len(changes) == 1
+
+        assert settings.refresh_config()
+        assert settings.CONFIG == before
+    finally:
+        settings.unsubscribe(callback)
@@ -0,0 +1,202 @@
+import json
+import uuid
+
+import pytest
+
+from venus import codec
+from venus import decode
+from venus.decode import (CONTENT_TYPE_MSGPACK, decode_chunk, decode_message,
+                          encode_batch, record_columns, split_batch)
+from venus.models import Message
+
+
+def make_body(i):
+    return json.dumps(dict(created=1554635562.8 + i,
+                           message=f'test {i}')).encode()
+
+
+def test_batch_envelope():
+    bodies = [make_body(i) for i in range(5)]
+    payload = encode_batch(bodies)
+    split = split_batch(payload)
+    assert all(isinstance(b, memoryview) for b in split)
+    assert [bytes(b) for b in split] == bodies
+
+
+def test_truncated_batch():
+    payload = encode_batch([make_body(i) for i in range(3)])
+    assert len(split_batch(payload[:-5])) == 2
+    assert len(split_batch(payload + b'\x00\x00')) == 3
+
+
+def test_decode_mixed_chunk():
+    payloads = [make_body(0), encode_batch([make_body(1), b'{', make_body(2)]),
+                make_body(3)]
+    for name in ('json', 'orjson'):
+        previous = codec.NAME
+        codec.use(name)
+        try:
+            records, stats, _ = decode_chunk(payloads)
+        finally:
+            codec.use(previous)
+        assert [r[1] for r in records] == ['test 0', 'test 1', 'test 2', 'test 3']
+        assert stats['batches'] == 1
+        assert stats['batched_records'] == 3
+        assert stats['decode_failures'] == 1
+
+
+def test_invalid_fields():
+    bad = [dict(created='x'), dict(created=1e20),
+           dict(created=1554635562.8, correlation_id='not a uuid'),
+           dict(created=1554635562.8, correlation_id=7),
+           dict(created=1554635562.8, correlation_id=[1])]
+    payload = encode_batch([json.dumps(d).encode() for d in bad]
+                           + [make_body(0)])
+    records, stats, _ = decode_chunk([payload])
+    assert [r[1] for r in records] == ['test 0']
+    assert stats['decode_failures'] == 5
+
+
+def test_msgpack_records():
+    msgpack = pytest.importorskip('msgpack')
+    d = dict(created=1554635562.8, message='test', levelno=20,
+             args=[1, 'a'], extra=dict(a=None))
+    packed = msgpack.packb(d)
+    payloads = [packed, encode_batch([packed, packed]), b'\xc1', msgpack.packb([1])]
+    records, stats, _ = decode_chunk(payloads, [CONTENT_TYPE_MSGPACK] * 4)
+    assert len(records) == 3
+    assert records[0][1] == 'test'
+    assert json.loads(records[0][3]) == dict(args=[1, 'a'], extra=dict(a=None))
+    assert records[0][4] == 20
+    assert stats['decode_failures'] == 2
+
+    msg = Message(b'INFO', packed, CONTENT_TYPE_MSGPACK)
+    assert decode_message(msg) == records[0]
+
+
+def test_msgpack_bin_message():
+    msgpack = pytest.importorskip('msgpack')
+    payloads = [msgpack.packb(dict(created=1554635562.8, message=m))
+                for m in (b'hello "x', b'caf\xe9', 7, 'a\x00b')]
+    records, stats, _ = decode_chunk(payloads, [CONTENT_TYPE_MSGPACK] * 4)
+    assert [r[1] for r in records] == ['hello "x', 'caf\ufffd']
+    assert stats['decode_failures'] == 2
+
+
+def test_unknown_content_type():
+    records, stats, _ = decode_chunk([make_body(0)], [b'text/csv'])
+    assert records == []
+    assert stats['decode_failures'] == 1
+
+
+@pytest.fixture
+def promoted(config_change):
+    def _promoted(fields):
+        decode.promoted_fields.cache_clear()
+        return config_change(PROMOTED_FIELDS=fields)
+    yield _promoted
+    decode.promoted_fields.cache_clear()
+
+
+def test_promoted_fields(promoted):
+    with promoted(['levelno', 'name', 'app']):
+        assert record_columns() == (
+            'time', 'message', 'correlation_id', 'data', 'levelno', 'name', 'app')
+        body = json.dumps(dict(created=1554635562.8, message='test', levelno=20,
+                               name='venus.test', app=dict(id=1),
+                               pathname='x.py')).encode()
+        records, _, _ = decode_chunk([body])
+        *_, data, levelno, name, app = records[0]
+        # An app that is not a string cannot go in the TEXT column.
+        assert (levelno, name, app) == (20, 'venus.test', None)
+        assert json.loads(data) == dict(app=dict(id=1), pathname='x.py')
+
+        body = json.dumps(dict(created=1554635562.8, levelno=10 ** 6,
+                               name=None)).encode()
+        records, _, _ = decode_chunk([body])
+        assert records[0][4:] == (None, None, None)
+        assert json.loads(records[0][3]) == dict(levelno=10 ** 6)
+
+
+def test_promoted_fields_unknown(promoted):
+    with promoted(['levelno', 'funcName']):
+        with pytest.raises(ValueError):
+            record_columns()
+
+
+def test_routed_records():
+    correlation_id = str(uuid.uuid4())
+    span_id = str(uuid.uuid4())
+    bodies = [
+        dict(record_type='span', span_id=span_id, correlation_id=correlation_id,
+             description='GET /', time_start=1554635562.8, time_end=1554635563.0),
+        dict(record_type='context', correlation_id=correlation_id,
+             context=dict(user=42)),
+        dict(record_type='log', created=1554635562.8, message='test'),
+        dict(record_type='context', correlation_id=correlation_id, context=[1]),
+        dict(record_type='span', correlation_id=correlation_id),
+        # Not a type that is routed, so an ordinary log record.
+        dict(record_type='audit', created=1554635562.8, message='audit'),
+        dict(record_type=['span'], created=1554635562.8, message='list'),
+    ]
+    records, stats, routed = decode_chunk(
+        [encode_batch(json.dumps(b).encode() for b in bodies)])
+    assert [r[1] for r in records] == ['test', 'audit', 'list']
+    assert json.loads(records[0][3]) == dict(record_type='log')
+    assert json.loads(records[1][3]) == dict(record_type='audit')
+    assert stats['decode_failures'] == 2
+
+    (span,) = routed['span']
+    assert str(span[0]) == span_id
+    assert span[2] == 'GET /'
+    assert (span[4] - span[3]).total_seconds() == pytest.approx(0.2)
+    ((context_id, data, updated),) = routed['context']
+    assert str(context_id) == correlation_id
+    assert json.loads(data) == dict(user=42)
+    assert updated is None
+
+
+def test_invalid_routed_records():
+    span = dict(record_type='span', span_id=str(uuid.uuid4()),
+                time_start=1554635562.8, time_end=1554635563.0)
+    context = dict(record_type='context', correlation_id=str(uuid.uuid4()),
+                   context=dict(user=42))
+    bodies = [
+        dict(span, span_id=7),
+        dict(span, span_id=[1]),
+        dict(span, correlation_id=7),
+        dict(span, description=dict(a=1)),
+        dict(span, time_start='x'),
+        dict(span, time_start=1e300),
+        dict(span, time_end=-1e300),
+        dict(context, correlation_id=7),
+        dict(context, created=1e300),
+        span,
+        context,
+    ]
+    _, stats, routed = decode_chunk(
+        [encode_batch(json.dumps(b).encode() for b in bodies)])
+    assert stats['decode_failures'] == 9
+    assert len(routed['span']) == 1
+    assert len(routed['context']) == 1
+
+
+def test_metric_samples():
+    bodies = [
+        dict(record_type='metric', created=1554635562.8, name='latency',
+             value=0.25, tags=dict(route='/', status=200)),
+        dict(record_type='metric', created=1554635562.9, name='queue', value=3),
+        dict(record_type='metric', created=1554635562.9, name='x', value='3'),
+        dict(record_type='metric', created=1554635562.9, name='x', value=True),
+        dict(record_type='metric', created=1554635562.9, name='x', value=1,
+             tags=['a']),
+        dict(record_type='metric', name='x', value=1),
+        dict(record_type='metric', created=1e20, name='x', value=1),
+    ]
+    _, stats, routed = decode_chunk(
+        [encode_batch(json.dumps(b).encode() for b in bodies)])
+    assert stats['decode_failures'] == 5
+    assert routed['metric'] == [
+        (1554635562.8, 'latency', (('route', '/'), ('status', '200')), 0.25),
+        (1554635562.9, 'queue', (), 3.0),
+    ]
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from venus import sinks
+from venus.db import write
+from venus.decode import LOG_COLUMNS
+from venus.io import MessageQueue
+from venus.models import Message
+
+
+class SlowSink(sinks.Sink):
+    """Takes 0.1 s per batch, and remembers when each message went in."""
+    name = 'slow'
+
+    def __init__(self):
+        self.written = {}
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        await asyncio.sleep(0.1)
+        for record in records:
+            self.written[record[1]] = time.monotonic()
+
+
+def make_msg(level, i):
+    payload = json.dumps(dict(created=time.time(), message=f'{level} {i}'))
+    return Message(level.encode(), payload.encode())
+
+
+def test_high_priority_lane(loop, config_change):
+    sink = SlowSink()
+    q, high_q = MessageQueue(), MessageQueue()
+
+    async def run():
+        with config_change(MAX_BATCH_SIZE=10, MAX_INFLIGHT_BATCHES=1,
+                           HIGH_PRIORITY_MAX_BATCH_AGE_SECONDS=0.05):
+            sinks.SINK = sink
+            task = loop.create_task(write.collect(q, high_q))
+            # About 2 seconds' worth of INFO messages for the slow sink.
+            q.put_nowait([make_msg('INFO', i) for i in range(200)])
+            await asyncio.sleep(0.2)
+            t0 = time.monotonic()
+            high_q.put_nowait(make_msg('ERROR', 0))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return t0
+
+    t0 = loop.run_until_complete(run())
+    # The error went in within a batch age plus a write, not after the
+    # flood of INFO messages ahead of it.
+    assert sink.written['ERROR 0'] - t0 < 0.3
+    assert len([m for m in sink.written if m.startswith('INFO')]) < 200
+    assert sinks.SINK is None
+
+
+def test_split_priority(config_change):
+    from venus.decode import encode_batch
+    from venus.io import split_priority
+
+    single = make_msg('ERROR', 0)
+    small = Message(b'ERROR', encode_batch([single.message] * 3))
+    large = Message(b'ERROR', encode_batch([single.message] * 4))
+    info = make_msg('INFO', 0)
+    with config_change(HIGH_PRIORITY_MAX_ENVELOPE_RECORDS=3):
+        high, normal = split_priority([single, small, large, info])
+    assert high == [single, small]
+    assert normal == [large, info]
+
+
+def test_bad_chunk_is_skipped(loop, monkeypatch):
+    sink = SlowSink()
+    q = MessageQueue()
+    decode_chunk = write.decode_chunk
+
+    def flaky_decode_chunk(payloads, content_types=None):
+        if any(b'bad' in p for p in payloads):
+            raise AttributeError('bad')
+        return decode_chunk(payloads, content_types)
+
+    monkeypatch.setattr(write, 'decode_chunk', flaky_decode_chunk)
+
+    async def run():
+        sinks.SINK = sink
+        task = loop.create_task(write.collect(q))
+        q.put_nowait(make_msg('bad', 0))
+        q.put_nowait(make_msg('INFO', 0))
+        await asyncio.sleep(0.5)
+        assert not task.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    loop.run_until_complete(run())
+    assert list(sink.written) == ['INFO 0']
+
+
+def test_queue_counts_messages():
+    q = MessageQueue(maxsize=5)
+    q.put_nowait([make_msg('INFO', i) for i in range(3)])
+    assert q.qsize() == 3
+    q.put_nowait(make_msg('INFO', 3))
+    assert (q.qsize(), q.full()) == (4, False)
+    # A list may overshoot the bound by its own length.
+    q.put_nowait([make_msg('INFO', i) for i in range(2)])
+    assert (q.qsize(), q.full()) == (6, True)
+    with pytest.raises(asyncio.QueueFull):
+        q.put_nowait(make_msg('INFO', 5))
+    assert len(q.get_nowait()) == 3
+    assert q.qsize() == 3
+
+
+def test_pull_sock_drain_max(loop, config_change):
+    import zmq
+    from venus import io
+
+    address = 'inproc://test-drain-max'
+    q = MessageQueue(maxsize=100)
+
+    async def run():
+        with config_change(RECV_DRAIN_MAX=3, TRACE_SAMPLE_RATE=0):
+            push = io.CONTEXT.socket(zmq.PUSH)
+            push.connect(address)
+            # All waiting on the socket before the first receive.
+            for i in range(7):
+                msg = make_msg('INFO', i)
+                await push.send_multipart([msg.level, msg.message])
+            task = loop.create_task(io.pull_sock(q, address))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            push.close(0)
+
+    with io.zmq_context():
+        loop.run_until_complete(run())
+
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait())
+    assert [len(item) for item in items] == [3, 3, 1]
+    assert [json.loads(m.message)['message'] for item in items
+            for m in item] == [f'INFO {i}' for i in range(7)]
@@ -0,0 +1,55 @@
+import asyncio
+
+import portpicker
+
+from venus import metrics
+
+
+def test_render():
+    c = metrics.Counter('test_things_total', 'Things.', labelnames=['level'])
+    c.inc(level='INFO')
+    c.inc(2, level='INFO')
+    c.inc(level='DEBUG')
+    assert c.value(level='INFO') == 3
+
+    h = metrics.Histogram('test_seconds', 'Seconds.', buckets=(0.1, 1.0))
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5.0)
+
+    text = metrics.render()
+    assert 'test_things_total{level="INFO"} 3' in text
+    assert 'test_things_total{level="DEBUG"} 1' in text
+    assert 'test_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_seconds_bucket{le="1.0"} 2' in text
+    assert 'test_seconds_bucket{le="+Inf"} 3' in text
+    assert 'test_seconds_count 3' in text
+
+
+def test_quantile():
+    h = metrics.Histogram('test_quantile_seconds', 'Seconds.',
+                          buckets=(1.0, 2.0, 3.0, 4.0))
+    for i in range(100):
+        h.observe(0.5 if i < 50 else 3.5)
+    assert h.count() == 100
+    assert 0.0 < h.quantile(0.25) <= 1.0
+    assert 3.0 < h.quantile(0.99) <= 4.0
+
+
+def test_serve(loop):
+    port = portpicker.pick_unused_port()
+
+    async def scrape():
+        server = loop.create_task(metrics.serve(port, host='127.0.0.1'))
+        await asyncio.sleep(0.1)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+            return await reader.read()
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+    response = loop.run_until_complete(scrape())
+    assert response.startswith(b'HTTP/1.1 200 OK')
+    assert b'venus_messages_received_total' in response
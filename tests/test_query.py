@@ -0,0 +1,66 @@
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from venus.db import query
+
+
+def test_level_number():
+    assert query.level_number('error') == 40
+    assert query.level_number('25') == 25
+    assert query.level_number(10) == 10
+    with pytest.raises(ValueError):
+        query.level_number('LOUD')
+
+
+def test_rollup_for():
+    assert query.rollup_for(timedelta(minutes=1)) == 'logs_1m'
+    assert query.rollup_for(timedelta(minutes=90)) == 'logs_1m'
+    assert query.rollup_for(timedelta(hours=2)) == 'logs_1h'
+    assert query.rollup_for(timedelta(days=1)) == 'logs_1h'
+    with pytest.raises(ValueError):
+        query.rollup_for(timedelta(seconds=30))
+
+
+def test_log_volume(loop, db_fixture, db_pool):
+    t = datetime(2019, 4, 7, 10, 0, 30, tzinfo=timezone.utc)
+    rows = [
+        (t, 'a', uuid.uuid4(), json.dumps({}), 20, 'venus.test', 'volume'),
+        (t, 'b', uuid.uuid4(), json.dumps({}), 40, 'venus.test', 'volume'),
+        (t + timedelta(minutes=1), 'c', uuid.uuid4(), json.dumps({}), 40,
+         'venus.test', 'volume'),
+    ]
+
+    async def run():
+        async with db_pool.acquire() as conn:
+            await conn.executemany(
+                'INSERT INTO logs (time, message, correlation_id, data, '
+                'levelno, name, app) VALUES ($1, $2, $3, $4, $5, $6, $7)', rows)
+            await conn.execute(
+                "CALL refresh_continuous_aggregate('logs_1m', NULL, NULL)")
+            by_minute = await query.log_volume(
+                conn, t - timedelta(hours=1), t + timedelta(hours=1),
+                app='volume')
+            errors = await query.log_volume(
+                conn, t - timedelta(hours=1), t + timedelta(hours=1),
+                bucket=timedelta(minutes=5), group_by=(), min_levelno=40,
+                app='volume')
+            return by_minute, errors
+
+    by_minute, errors = loop.run_until_complete(run())
+    assert [(r['levelno'], r['records']) for r in by_minute] == [
+        (20, 1), (40, 1), (40, 1)]
+    assert [r['records'] for r in errors] == [2]
+
+
+def test_logs_query():
+    sql, args = query.logs_query()
+    assert sql.endswith('FROM logs ORDER BY time DESC')
+    assert args == []
+
+    t = datetime(2019, 4, 7, tzinfo=timezone.utc)
+    sql, args = query.logs_query(start=t, min_levelno=30, contains='{"a": 1}')
+    assert 'WHERE time >= $1 AND levelno >= $2 AND data @> $3::jsonb ' in sql
+    assert args == [t, 30, '{"a": 1}']
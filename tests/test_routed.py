@@ -0,0 +1,149 @@
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from venus.db import routed
+from venus.decode import CONTEXT_COLUMNS
+
+
+class FakeWriter(routed.TableWriter):
+    def __init__(self, fail=0):
+        super().__init__('context', CONTEXT_COLUMNS, 'correlation_id',
+                         update=True)
+        self.fail = fail
+        self.written = []
+
+    async def write(self, records):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError('down')
+        self.written.append(records)
+
+
+def test_insert_sql():
+    assert routed.insert_sql('context', CONTEXT_COLUMNS, 'correlation_id', True,
+                             newer='updated') == (
+        'INSERT INTO context (correlation_id, data, updated) VALUES ($1, $2, $3) '
+        'ON CONFLICT (correlation_id) DO UPDATE SET data = EXCLUDED.data, '
+        'updated = EXCLUDED.updated WHERE EXCLUDED.updated IS NULL '
+        'OR context.updated IS NULL OR EXCLUDED.updated >= context.updated')
+    assert routed.insert_sql('span', ('span_id', 'x'), 'span_id', False).endswith(
+        'ON CONFLICT (span_id) DO NOTHING')
+
+
+def test_coalesce_and_retry(loop, config_change):
+    a, b = uuid.uuid4(), uuid.uuid4()
+
+    async def run():
+        with config_change(MAX_BATCH_SIZE=3, MAX_BATCH_AGE_SECONDS=0.05,
+                           WRITE_RETRY_MAX_SECONDS=0.01):
+            writer = FakeWriter(fail=1)
+            task = loop.create_task(writer.run())
+            writer.add([(a, b'1'), (b, b'1'), (a, b'2')])
+            await asyncio.sleep(0.02)
+            # The first write failed. Meanwhile, a newer state for b.
+            writer.add([(b, b'2')])
+            await asyncio.sleep(0.2)
+            writer.add([(a, b'3')])
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return writer.written
+
+    written = loop.run_until_complete(run())
+    assert written == [[(a, b'2'), (b, b'2')], [(a, b'3')]]
+
+
+def test_buffer_limit(loop, config_change):
+    async def run():
+        with config_change(MAX_BATCH_SIZE=2, ROUTED_BUFFER_BATCHES=2):
+            writer = FakeWriter()
+            writer.add([(uuid.uuid4(), b'{}') for _ in range(6)])
+            return writer
+
+    writer = loop.run_until_complete(run())
+    assert len(writer.batch) == 4
+    assert writer.full.is_set()
+
+
+def test_write_routed(loop, db_fixture, db_pool):
+    correlation_id = uuid.uuid4()
+    span_id = uuid.uuid4()
+    t = datetime(2019, 4, 7, tzinfo=timezone.utc)
+    span = (span_id, correlation_id, 'GET /', t, t + timedelta(seconds=1))
+
+    async def run():
+        await routed.write_routed(dict(
+            span=[span, span],
+            context=[(correlation_id, b'{"v": 1}', t),
+                     (correlation_id, b'{"v": 2}', t + timedelta(seconds=1))],
+            metric=[(t.timestamp(), str(span_id), (('a', '1'),), v)
+                    for v in (1.0, 2.0)],
+        ))
+        # Replayed, e.g., from the spill log.
+        await routed.write_routed(dict(
+            span=[span], context=[(correlation_id, b'{"v": 1}', t)]))
+        async with db_pool.acquire() as conn:
+            spans = await conn.fetch(
+                'SELECT * FROM span WHERE correlation_id = $1', correlation_id)
+            context = await conn.fetchval(
+                'SELECT data FROM context WHERE correlation_id = $1',
+                correlation_id)
+            metric = await conn.fetchrow(
+                'SELECT * FROM metric WHERE name = $1', str(span_id))
+        return spans, context, metric
+
+    spans, context, metric = loop.run_until_complete(run())
+    assert [r['description'] for r in spans] == ['GET /']
+    assert json.loads(context) == dict(v=2)
+    assert (metric['count'], metric['sum'], metric['max']) == (2, 3.0, 2.0)
+    assert json.loads(metric['tags']) == dict(a='1')
+
+
+class FakeMetricWriter(routed.MetricWriter):
+    def __init__(self, fail=0):
+        super().__init__()
+        self.fail = fail
+        self.written = []
+
+    async def write(self, rows):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError('down')
+        self.written.append(rows)
+
+
+def test_metric_writer(loop, config_change):
+    async def run():
+        with config_change(METRIC_WINDOW_SECONDS=10, METRIC_MAX_SERIES=2):
+            writer = FakeMetricWriter(fail=1)
+            writer.add([(100.0, 'a', (), 1.0), (101.0, 'a', (), 2.0),
+                        (102.0, 'b', (), 1.0), (103.0, 'c', (), 1.0)])
+            assert not await writer.flush(now=105.0 + 10)
+            assert writer.pending
+            # Kept, and written with the next window.
+            writer.add([(111.0, 'c', (), 1.0)])
+            assert await writer.flush(now=125.0)
+            return writer.written
+
+    (rows,) = loop.run_until_complete(run())
+    assert [(r[1], r[3], r[4]) for r in rows] == [
+        ('a', 2, 3.0), ('b', 1, 1.0), ('c', 1, 1.0)]
+
+
+def test_metric_writer_run(loop, config_change):
+    async def run():
+        with config_change(METRIC_WINDOW_SECONDS=0.1):
+            writer = FakeMetricWriter()
+            task = loop.create_task(writer.run())
+            writer.add([(0.0, 'old', (), 1.0)])
+            await asyncio.sleep(0.15)
+            # Written at shutdown, though its window has not ended.
+            writer.add([(time.time() + 3600, 'future', (), 1.0)])
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return writer.written
+
+    written = loop.run_until_complete(run())
+    assert [[r[1] for r in rows] for rows in written] == [['old'], ['future']]
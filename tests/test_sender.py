@@ -34,13 +34,13 @@ def run_app(port, iterations, delay=0.2, env=None):
     return proc
 
 
-def test_send_logs(db_fixture, db_pool_session, venus_runner):
+def test_send_logs(db_fixture, db_pool_session, venus_runner, config_change):
     loop, port = venus_runner
 
     message_uuids = [str(uuid4()) for i in range(10)]
     env = dict(SENDER_ITEMS=str(message_uuids))
 
-    with biodome.env_change('MAX_BATCH_SIZE', 1):
+    with config_change(MAX_BATCH_SIZE=1):
         proc = run_app(port, iterations=10, env=env)
         loop.run_until_complete(asyncio.sleep(3))
         if proc.poll() is None:
@@ -61,7 +61,7 @@ def test_send_logs(db_fixture, db_pool_session, venus_runner):
         assert logged_message_ids.issuperset(message_uuids)
 
 
-def test_send_double(db_fixture, db_pool_session, venus_runner):
+def test_send_double(db_fixture, db_pool_session, venus_runner, config_change):
     loop, port = venus_runner
 
     message_uuids1 = [str(uuid4()) for i in range(10)]
@@ -69,7 +69,7 @@ def test_send_double(db_fixture, db_pool_session, venus_runner):
     env1 = dict(SENDER_ITEMS=str(message_uuids1))
     env2 = dict(SENDER_ITEMS=str(message_uuids2))
 
-    with biodome.env_change('MAX_BATCH_SIZE', 1):
+    with config_change(MAX_BATCH_SIZE=1):
         proc1 = run_app(port, iterations=10, env=env1)
         proc2 = run_app(port, iterations=10, env=env2)
         loop.run_until_complete(asyncio.sleep(3))
@@ -94,7 +94,7 @@ def test_send_double(db_fixture, db_pool_session, venus_runner):
         assert logged_message_ids.issuperset(message_uuids2)
 
 
-def test_extra(db_fixture, db_pool_session, venus_runner):
+def test_extra(db_fixture, db_pool_session, venus_runner, config_change):
     loop, port = venus_runner
 
     messages = [
@@ -106,7 +106,7 @@ def test_extra(db_fixture, db_pool_session, venus_runner):
     ]
     env = dict(SENDER_ITEMS=repr(messages))
 
-    with biodome.env_change('MAX_BATCH_SIZE', 1):
+    with config_change(MAX_BATCH_SIZE=1):
         proc = run_app(port, iterations=10, delay=0.2, env=env)
         loop.run_until_complete(asyncio.sleep(3))
         if proc.poll() is None:
@@ -132,5 +132,6 @@ def test_extra(db_fixture, db_pool_session, venus_runner):
 
     data = json.loads(rec['data'])
     assert data['filename'] == 'sender.py'
-    assert data['pathname'] == 'tests/sender.py'
+    assert rec['pathname'] == 'tests/sender.py'
+    assert 'pathname' not in data
     assert data['random_timing_data'] == 1.23
@@ -0,0 +1,43 @@
+from venus import metrics
+from venus.io.shedding import LevelShedder
+from venus.models import Message
+
+LEVELS = [b'DEBUG', b'INFO', b'WARNING', b'ERROR', b'CRITICAL']
+
+
+def make_msgs(n):
+    return [Message(level, b'{}') for level in LEVELS for _ in range(n)]
+
+
+def count(msgs, level):
+    return sum(1 for m in msgs if m.level == level)
+
+
+def test_shedding(config_change):
+    with config_change(SHED_DEBUG_WATERMARK=0.5, SHED_INFO_WATERMARK=0.8):
+        shedder = LevelShedder(maxsize=1000)
+        msgs = make_msgs(100)
+
+        # Below the watermarks, everything is admitted.
+        assert shedder.admit(msgs, depth=400) is msgs
+
+        # Between them, DEBUG is sampled down.
+        before = metrics.MESSAGES_SHED.value(level='DEBUG')
+        admitted = shedder.admit(msgs, depth=750)
+        assert count(admitted, b'DEBUG') == 50
+        assert count(admitted, b'INFO') == 100
+        assert metrics.MESSAGES_SHED.value(level='DEBUG') - before == 50
+
+        # Above both, INFO too.
+        admitted = shedder.admit(msgs, depth=900)
+        assert count(admitted, b'DEBUG') == 20
+        assert count(admitted, b'INFO') == 50
+
+        # At a full queue, only WARNING and above.
+        admitted = shedder.admit(msgs, depth=1000)
+        assert [count(admitted, level) for level in LEVELS] == [0, 0, 100, 100, 100]
+
+
+def test_no_shedding_without_bound():
+    msgs = make_msgs(10)
+    assert LevelShedder(maxsize=0).admit(msgs, depth=10 ** 6) is msgs
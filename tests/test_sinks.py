@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import gzip
+import json
+import uuid
+from datetime import datetime, timezone
+
+from venus import sinks
+from venus.decode import LOG_COLUMNS
+
+
+def test_ndjson_sink(loop, tmp_path):
+    path = tmp_path / 'out.ndjson'
+    sink = sinks.NdjsonSink(str(path))
+    cid = uuid.uuid4()
+    now = datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    records = [
+        (now, 'hello', cid, b'{"a":1}'),
+        (now, 'there', None, '{"b":2}'),
+    ]
+    loop.run_until_complete(sink.write(records, LOG_COLUMNS))
+    loop.run_until_complete(sink.close())
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert lines == [
+        dict(time=now.isoformat(), message='hello', correlation_id=str(cid),
+             data=dict(a=1)),
+        dict(time=now.isoformat(), message='there', correlation_id=None,
+             data='{"b":2}'),
+    ]
+
+
+def test_null_sink(loop):
+    sink = sinks.open_sink('null')
+    loop.run_until_complete(sink.write([(1, 2, 3, 4)]))
+
+
+def test_ndjson_rotation(loop, tmp_path):
+    path = tmp_path / 'out.ndjson'
+    sink = sinks.NdjsonSink(str(path), rotate_bytes=100, compress=True)
+    records = [(None, f'message {i}', None, b'{}') for i in range(10)]
+
+    async def run():
+        for i in range(0, 10, 2):
+            await sink.write(records[i:i + 2])
+        await sink.close()
+
+    loop.run_until_complete(run())
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert all(f.startswith('out.') and f.endswith('.ndjson.gz') for f in files)
+    assert len(files) > 1
+    lines = []
+    for f in sorted(tmp_path.iterdir()):
+        lines.extend(gzip.decompress(f.read_bytes()).splitlines())
+    assert sorted(json.loads(line)['message'] for line in lines) == sorted(
+        r[1] for r in records)
+
+
+class SlowSink(sinks.Sink):
+    name = 'slow'
+
+    def __init__(self):
+        self.written = []
+        self.release = asyncio.Event()
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        await self.release.wait()
+        self.written.append(records)
+
+
+class ListSink(sinks.Sink):
+    name = 'list'
+
+    def __init__(self):
+        self.written = []
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        self.written.append(list(records))
+
+
+def test_fanout_secondary_does_not_stall_primary(loop):
+    primary = ListSink()
+    slow = SlowSink()
+    sink = sinks.FanoutSink(primary, [sinks.BufferedSink(slow, maxsize=2)])
+
+    async def run():
+        for i in range(5):
+            records = [(i,)]
+            await asyncio.wait_for(sink.write(records), timeout=1)
+            # The writer clears its batch after a successful write.
+            records.clear()
+        assert len(primary.written) == 5
+        slow.release.set()
+        await sink.close()
+
+    loop.run_until_complete(run())
+    # One batch was taken by the writer task, two were buffered, and the
+    # other two were dropped.
+    assert slow.written == [[(0,)], [(1,)], [(2,)]]
+
+
+class FakeConnection:
+    """Records which writer was used, as (method, table, rows)."""
+    def __init__(self):
+        self.calls = []
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.calls.append(('copy', table, list(records)))
+
+    async def executemany(self, sql, records):
+        self.calls.append(('insert', sql.split()[2], list(records)))
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self
+
+
+def test_postgres_write_mode(loop, monkeypatch, config_change):
+    conn = FakeConnection()
+    monkeypatch.setattr(sinks, 'get_db_pool', lambda: conn)
+    records = [(1, 'a'), (2, 'b')]
+    sink = sinks.PostgresSink()
+    for mode in ('copy', 'insert'):
+        with config_change(DB_WRITE_MODE=mode, SPILL_DRAIN_BATCH_SIZE=1):
+            conn.calls.clear()
+            loop.run_until_complete(sink.write(records, ('time', 'message')))
+            loop.run_until_complete(
+                sink.write_many({('time', 'message'): records}))
+            assert conn.calls == [
+                (mode, 'logs', records),
+                (mode, 'logs', records[:1]),
+                (mode, 'logs', records[1:]),
+            ]
+
+
+def test_write_modes_same_rows(loop, db_fixture, db_pool):
+    from venus import codec
+
+    t = datetime(2019, 4, 7, tzinfo=timezone.utc)
+    records = [
+        (t, 'test', uuid.uuid4(), codec.dumps(dict(a=1, b=[None, 'x']))),
+        (t, 'café', None, codec.dumps({})),
+        (t, None, uuid.uuid4(), codec.dumps(dict(nested=dict(c=1.5)))),
+    ]
+
+    async def run():
+        async with db_pool.acquire() as conn:
+            rows = {}
+            for name, writer in (('copy', sinks.copy_records),
+                                 ('insert', sinks.insert_records)):
+                table = f'modes_{name}'
+                await conn.execute(
+                    f'CREATE TEMP TABLE {table} (LIKE logs INCLUDING ALL)')
+                await writer(conn, records, table=table)
+                rows[name] = await conn.fetch(
+                    f'SELECT * FROM {table} ORDER BY data')
+                await conn.execute(f'DROP TABLE {table}')
+            return rows
+
+    rows = loop.run_until_complete(run())
+    assert len(rows['copy']) == 3
+    assert [dict(r) for r in rows['copy']] == [dict(r) for r in rows['insert']]
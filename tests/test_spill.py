@@ -0,0 +1,213 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from venus import sinks
+from venus.db import spill
+from venus.decode import LOG_COLUMNS
+from venus.models import Message
+
+
+def make_records(n):
+    t = datetime.now(tz=timezone.utc)
+    return [(t, f'message {i}', uuid4(), b'{"a": 1}') for i in range(n)]
+
+
+def test_spill_roundtrip(tmp_path):
+    s = spill.SpillLog(tmp_path)
+    records = make_records(3)
+    s.append_records(records, LOG_COLUMNS)
+    s.append_message(Message(b'INFO', b'{"created": 1}'))
+    s.append_message(Message(b'WARNING', b'\x81\xa1a\x01', b'application/msgpack'))
+
+    # The active segment is not available for draining until rotated.
+    assert s.closed_segments() == []
+    s.rotate()
+    [path] = s.closed_segments()
+
+    entries = list(spill.read_segment(path))
+    assert [kind for kind, _ in entries] == [b'R', b'M', b'T']
+
+    columns, decoded = spill.decode_records(entries[0][1])
+    assert tuple(columns) == LOG_COLUMNS
+    assert decoded == records
+    # "data" is still JSON, not a string of it.
+    line = json.loads(sinks.ndjson_line(columns, decoded[0]))
+    assert line['data'] == {'a': 1}
+
+    msg = spill.decode_message(entries[1][1])
+    assert msg == Message(b'INFO', b'{"created": 1}')
+    msg = spill.decode_message(entries[2][1], b'T')
+    assert msg == Message(b'WARNING', b'\x81\xa1a\x01', b'application/msgpack')
+
+    s.remove(path)
+    assert s.segment_paths() == []
+    assert s.total_bytes == 0
+
+
+def test_spill_str_data():
+    # As written by older versions.
+    payload = json.dumps(dict(columns=LOG_COLUMNS,
+                              records=[[None, 'm', None, '{"a": 1}']]))
+    _, records = spill.decode_records(payload.encode())
+    assert records == [(None, 'm', None, b'{"a": 1}')]
+
+
+def test_spill_rotation_and_replay(tmp_path):
+    s = spill.SpillLog(tmp_path, segment_bytes=100)
+    for i in range(5):
+        s.append_records(make_records(1), LOG_COLUMNS)
+    s.close()
+    assert len(s.segment_paths()) == 5
+
+    # A new instance, as after a restart, picks up the old segments and
+    # never appends to them.
+    s2 = spill.SpillLog(tmp_path, segment_bytes=100)
+    assert len(s2.closed_segments()) == 5
+    s2.append_records(make_records(1), LOG_COLUMNS)
+    assert len(s2.closed_segments()) == 6
+
+
+def test_spill_torn_tail(tmp_path):
+    s = spill.SpillLog(tmp_path)
+    s.append_records(make_records(2), LOG_COLUMNS)
+    s.append_records(make_records(2), LOG_COLUMNS)
+    s.close()
+    [path] = s.segment_paths()
+    with open(path, 'r+b') as f:
+        f.truncate(path.stat().st_size - 10)
+
+    assert len(list(spill.read_segment(path))) == 1
+
+
+def test_spill_max_bytes(tmp_path):
+    s = spill.SpillLog(tmp_path, max_bytes=500)
+    results = [s.append_records(make_records(1), LOG_COLUMNS) for i in range(5)]
+    assert results[0]
+    assert not results[-1]
+    assert s.dropped_entries > 0
+
+
+def test_spilled_batch_is_not_committed(loop, tmp_path, monkeypatch):
+    from venus import metrics
+    from venus.db import write
+    from venus.decode import record_columns
+
+    class FailingSink(sinks.Sink):
+        name = 'failing'
+
+        async def write(self, records, columns=LOG_COLUMNS):
+            raise ConnectionError('down')
+
+    monkeypatch.setattr(sinks, 'SINK', FailingSink())
+    spill.open_spill(tmp_path)
+    padding = (None,) * (len(record_columns()) - len(LOG_COLUMNS))
+    records = [r + padding for r in make_records(3)]
+    written = metrics.RECORDS_WRITTEN.value()
+    spilled = metrics.RECORDS_SPILLED.value()
+    try:
+        pipeline = write.BatchPipeline(1)
+        loop.run_until_complete(pipeline.write(0, records))
+    finally:
+        spill.close_spill()
+
+    assert metrics.RECORDS_WRITTEN.value() == written
+    assert metrics.RECORDS_SPILLED.value() == spilled + 3
+    assert pipeline.failed_attempts == 1
+
+
+def test_undecodable_segment_is_quarantined(loop, tmp_path, monkeypatch,
+                                            config_change):
+    from venus.db import write
+
+    class ListSink(sinks.Sink):
+        name = 'list'
+
+        def __init__(self):
+            self.written = []
+
+        async def write_many(self, batches):
+            self.written.extend(batches.items())
+
+    sink = ListSink()
+    monkeypatch.setattr(sinks, 'SINK', sink)
+    spill.open_spill(tmp_path)
+    s = spill.get_spill()
+    s.append(spill.KIND_RECORDS, b'{not json')
+    s.rotate()
+    s.append_records(make_records(2), LOG_COLUMNS)
+    s.rotate()
+
+    async def run():
+        with config_change(SINKS='null', SPILL_DRAIN_INTERVAL_SECONDS=0.01):
+            task = loop.create_task(write.drain_spill())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        spill.close_spill()
+
+    # The good segment after the bad one was drained.
+    [(columns, records)] = sink.written
+    assert len(records) == 2
+    assert [p.name for p in tmp_path.iterdir()] == [
+        'segment-000000000000.spill.bad']
+
+
+def test_rejected_segment_is_quarantined(loop, tmp_path, monkeypatch,
+                                         config_change):
+    import asyncpg
+    from venus.db import write
+
+    class RejectingSink(sinks.Sink):
+        """Rejects batches of one record, and cannot connect while
+        ``down`` is set."""
+        name = 'rejecting'
+
+        def __init__(self):
+            self.down = False
+            self.written = []
+
+        async def write_many(self, batches):
+            if self.down:
+                raise ConnectionRefusedError('down')
+            if any(len(records) == 1 for records in batches.values()):
+                raise asyncpg.DataError('invalid input syntax')
+            self.written.extend(batches.items())
+
+    sink = RejectingSink()
+    monkeypatch.setattr(sinks, 'SINK', sink)
+    spill.open_spill(tmp_path)
+    s = spill.get_spill()
+    s.append_records(make_records(1), LOG_COLUMNS)
+    s.rotate()
+    s.append_records(make_records(2), LOG_COLUMNS)
+    s.rotate()
+
+    async def run(seconds=0.1):
+        with config_change(SINKS='null', SPILL_DRAIN_INTERVAL_SECONDS=0.01):
+            task = loop.create_task(write.drain_spill())
+            await asyncio.sleep(seconds)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    try:
+        sink.down = True
+        loop.run_until_complete(run())
+        # Nothing is set aside while the database cannot be reached.
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            'segment-000000000000.spill', 'segment-000000000001.spill']
+        sink.down = False
+        spill.open_spill(tmp_path)
+        loop.run_until_complete(run())
+    finally:
+        spill.close_spill()
+
+    [(columns, records)] = sink.written
+    assert len(records) == 2
+    assert [p.name for p in tmp_path.iterdir()] == [
+        'segment-000000000000.spill.bad']
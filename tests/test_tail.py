@@ -0,0 +1,77 @@
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+
+import biodome
+import portpicker
+import zmq
+
+from venus import io
+from venus.decode import LOG_COLUMNS
+from venus.io import tail
+
+COLUMNS = LOG_COLUMNS + ('levelno', 'name')
+
+
+def make_record(levelno, name, correlation_id=None):
+    return (datetime(2019, 4, 7, tzinfo=timezone.utc), 'test', correlation_id,
+            b'{"a":1}', levelno, name)
+
+
+def test_subscriptions():
+    assert tail.subscriptions() == [b'lvl:']
+    assert tail.subscriptions(correlation_id='abc') == [b'cid:abc']
+    assert tail.subscriptions(level='error') == [b'lvl:ERROR:', b'lvl:CRITICAL:']
+    assert tail.subscriptions(logger_name='app.db')[0] == b'lvl:DEBUG:app.db'
+    assert tail.level_topic(40, 'app.db') == b'lvl:ERROR:app.db'
+    assert tail.level_topic(None, None) == b'lvl:-:-'
+
+
+def test_default_address():
+    parser = argparse.ArgumentParser()
+    tail.add_parser(parser.add_subparsers())
+    args = parser.parse_args(['tail'])
+    with biodome.env_change('TAIL_PORT', 0):
+        assert tail.default_address() is None
+        # Fails, rather than waiting for records that never come.
+        assert tail.main(args) == 1
+    with biodome.env_change('TAIL_PORT', 5051):
+        assert tail.default_address() == 'tcp://localhost:5051'
+
+
+def test_publish():
+    port = portpicker.pick_unused_port()
+    correlation_id = uuid.uuid4()
+    with biodome.env_change('TAIL_PORT', port), io.zmq_context():
+        tail.open_publisher(COLUMNS)
+        publisher = tail.get_publisher()
+        ctx = zmq.Context()
+        sub = ctx.socket(zmq.SUB)
+        sub.connect(f'tcp://127.0.0.1:{port}')
+        sub.setsockopt(zmq.SUBSCRIBE, b'lvl:ERROR:')
+        sub.setsockopt(zmq.SUBSCRIBE, f'cid:{correlation_id}'.encode())
+        try:
+            deadline = time.monotonic() + 5
+            while len(publisher.prefixes) < 2 and time.monotonic() < deadline:
+                publisher.update_subscriptions()
+                time.sleep(0.01)
+
+            publisher.publish([
+                make_record(20, 'app'),
+                make_record(40, 'app.db'),
+                make_record(20, 'app', correlation_id),
+            ])
+            received = [sub.recv_multipart() for _ in range(2)]
+            assert not sub.poll(100)
+        finally:
+            sub.close(0)
+            ctx.term()
+            tail.close_publisher()
+
+    assert received[0][0] == b'lvl:ERROR:app.db'
+    assert received[1][0] == f'cid:{correlation_id}'.encode()
+    record = json.loads(received[1][1])
+    assert record['data'] == dict(a=1)
+    assert record['correlation_id'] == str(correlation_id)
@@ -0,0 +1,33 @@
+import time
+
+from venus import metrics, tracing
+from venus.models import Message
+
+
+def make_msgs(n):
+    created = time.time()
+    return [Message(b'INFO', f'{{"created": {created}}}'.encode())
+            for _ in range(n)]
+
+
+def test_sampler_stride():
+    sampler = tracing.Sampler(0.1)
+    chunks = [make_msgs(n) for n in (3, 15, 1, 7, 4)]
+    for chunk in chunks:
+        sampler.sample(chunk)
+
+    msgs = [m for chunk in chunks for m in chunk]
+    traced = [i for i, m in enumerate(msgs) if m.trace is not None]
+    assert traced == [9, 19, 29]
+
+
+def test_record():
+    [msg] = make_msgs(1)
+    tracing.Sampler(1.0).sample([msg])
+    for stage in tracing.STAGES[1:]:
+        msg.trace.stamp(stage)
+
+    before = metrics.END_TO_END_LAG_SECONDS.count()
+    tracing.record([msg.trace])
+    assert metrics.END_TO_END_LAG_SECONDS.count() == before + 1
+    assert metrics.TRACE_STAGE_SECONDS.count(stage='committed') > 0
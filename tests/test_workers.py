@@ -0,0 +1,46 @@
+import asyncio
+
+from venus import workers
+
+
+def test_supervise_restarts_dead_worker(loop, tmp_path, config_change):
+    # Nothing binds the address, so the worker just waits for messages.
+    address = f'ipc://{tmp_path}/venus-test.ipc'
+
+    async def run(pool):
+        first = pool.processes[0]
+        assert pool.health() == 'ok'
+        first.kill()
+        await loop.run_in_executor(None, first.join, 10)
+        assert pool.health() == 'degraded: 1/1 workers not alive (0)'
+
+        task = loop.create_task(workers.supervise(pool))
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.1)
+                if pool.restarts:
+                    break
+            second = pool.processes[0]
+            assert pool.restarts == 1
+            assert second.pid != first.pid
+            # It keeps running, rather than failing on startup.
+            await asyncio.sleep(2)
+            assert pool.health() == 'ok'
+            assert pool.restarts == 1
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return second
+
+    # The spawned workers inherit these through the environment.
+    with config_change(SINKS='null', WORKER_METRICS_PORT=0,
+                       WORKER_SUPERVISE_INTERVAL_SECONDS=0.1):
+        pool = workers.WorkerPool(1, address)
+        pool.start()
+        try:
+            second = loop.run_until_complete(run(pool))
+        finally:
+            pool.stop()
+
+    # Cancelling `supervise` stopped the restarted worker.
+    assert not second.is_alive()
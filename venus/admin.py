@@ -0,0 +1,200 @@
+"""
+``venus admin``: managing how the hypertables are stored.
+
+These change the TimescaleDB settings of the ``logs`` and ``metric``
+hypertables, as set up by the migrations, and report on the compression
+achieved. They connect with the usual ``DB_*`` env vars, and need to run
+as the owner of the tables.
+
+    $ venus admin compression --table logs --segment-by app,name --after '3 days'
+    $ venus admin retention --table logs --drop-after '90 days'
+    $ venus admin chunk-interval --table logs '1 day'
+    $ venus admin report --table logs
+
+Intervals are anything that Postgres accepts as an ``interval``.
+"""
+import argparse
+import asyncio
+import logging
+import re
+from typing import List, Optional, Sequence
+
+import asyncpg
+from asyncpg import Connection
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+HYPERTABLES = ('logs', 'metric')
+
+# Values for the compression settings cannot be query parameters.
+COLUMN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+ORDER_BY = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*( (ASC|DESC))?$', re.IGNORECASE)
+
+
+def split_columns(value: str, pattern=COLUMN) -> List[str]:
+    columns = [c.strip() for c in value.split(',') if c.strip()]
+    for c in columns:
+        if not pattern.match(c):
+            raise ValueError(f'Not a column: {c!r}')
+    return columns
+
+
+async def set_compression(conn: Connection, table: str,
+                          segment_by: Optional[Sequence[str]] = None,
+                          order_by: Sequence[str] = ('time DESC',),
+                          after: Optional[str] = None):
+    """Set how chunks of ``table`` are compressed, and compress them
+    once they are older than ``after``. Without ``segment_by``, the
+    current segmenting is kept; an empty one removes it. The settings
+    cannot be changed while any chunks are compressed."""
+    options = ['timescaledb.compress']
+    if segment_by is not None:
+        options.append(
+            f"timescaledb.compress_segmentby = '{', '.join(segment_by)}'")
+    options.append(f"timescaledb.compress_orderby = '{', '.join(order_by)}'")
+    async with conn.transaction():
+        await conn.execute(f'ALTER TABLE {table} SET ({", ".join(options)})')
+        if after:
+            await conn.execute(
+                'SELECT remove_compression_policy($1, if_exists => true)', table)
+            await conn.execute(
+                'SELECT add_compression_policy($1, $2::interval)', table, after)
+
+
+async def set_retention(conn: Connection, table: str, after: Optional[str]):
+    """Drop chunks of ``table`` once they are older than ``after``, or
+    stop doing so if ``after`` is None."""
+    async with conn.transaction():
+        await conn.execute(
+            'SELECT remove_retention_policy($1, if_exists => true)', table)
+        if after:
+            await conn.execute(
+                'SELECT add_retention_policy($1, $2::interval)', table, after)
+
+
+async def set_chunk_interval(conn: Connection, table: str, interval: str):
+    """Only chunks created from now on have the new interval."""
+    await conn.execute(
+        'SELECT set_chunk_time_interval($1, $2::interval)', table, interval)
+
+
+async def compression_report(conn: Connection, table: str) -> List[asyncpg.Record]:
+    """Sizes before and after compression, per chunk. These are NULL
+    for chunks that are not compressed."""
+    return await conn.fetch("""
+        SELECT
+          s.chunk_name,
+          c.range_start,
+          c.range_end,
+          s.compression_status,
+          s.before_compression_total_bytes AS before_bytes,
+          s.after_compression_total_bytes AS after_bytes
+        FROM chunk_compression_stats($1) s
+        JOIN timescaledb_information.chunks c
+          ON c.chunk_schema = s.chunk_schema AND c.chunk_name = s.chunk_name
+        ORDER BY c.range_start
+    """, table)
+
+
+def format_bytes(n: Optional[int]) -> str:
+    if n is None:
+        return '-'
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if n < 1024:
+            return f'{n:.0f} {unit}'
+        n /= 1024
+    return f'{n:.1f} TB'
+
+
+def format_ratio(before: Optional[int], after: Optional[int]) -> str:
+    if not before or not after:
+        return '-'
+    return f'{before / after:.1f}x'
+
+
+def format_report(rows: Sequence) -> str:
+    lines = [f'{"chunk":<28} {"from":<25} {"status":<14} '
+             f'{"before":>10} {"after":>10} {"ratio":>7}']
+    before = after = 0
+    for r in rows:
+        lines.append(
+            f'{r["chunk_name"]:<28} {r["range_start"].isoformat():<25} '
+            f'{r["compression_status"]:<14} {format_bytes(r["before_bytes"]):>10} '
+            f'{format_bytes(r["after_bytes"]):>10} '
+            f'{format_ratio(r["before_bytes"], r["after_bytes"]):>7}'
+        )
+        if r['after_bytes']:
+            before += r['before_bytes']
+            after += r['after_bytes']
+    lines.append(f'{len(rows)} chunks. Compressed chunks: '
+                 f'{format_bytes(before)} -> {format_bytes(after)} '
+                 f'({format_ratio(before, after)})')
+    return '\n'.join(lines)
+
+
+async def run(args: argparse.Namespace):
+    conn = await asyncpg.connect(db.get_db_url())
+    try:
+        if args.admin_command == 'compression':
+            await set_compression(conn, args.table, args.segment_by,
+                                  args.order_by, args.after)
+        elif args.admin_command == 'retention':
+            await set_retention(conn, args.table, args.drop_after)
+        elif args.admin_command == 'chunk-interval':
+            await set_chunk_interval(conn, args.table, args.interval)
+        elif args.admin_command == 'report':
+            print(format_report(await compression_report(conn, args.table)))
+    finally:
+        await conn.close()
+
+
+def main(args: argparse.Namespace):
+    try:
+        asyncio.run(run(args))
+    except (asyncpg.PostgresError, OSError) as e:
+        # OSError: the database cannot be reached.
+        logger.error(f'{type(e).__name__}: {e}')
+        return 1
+    return 0
+
+
+def column_list(pattern=COLUMN):
+    def parse(value):
+        try:
+            return split_columns(value, pattern)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return parse
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser(
+        'admin', help='Manage compression, retention and chunking.')
+    parser.set_defaults(func=main)
+    commands = parser.add_subparsers(dest='admin_command', required=True)
+
+    def command(name, help):
+        p = commands.add_parser(name, help=help)
+        p.add_argument('--table', choices=HYPERTABLES, default='logs')
+        return p
+
+    p = command('compression', 'Set how chunks are compressed, and when.')
+    p.add_argument('--segment-by', type=column_list(),
+                   help='Comma-separated columns with few distinct values. '
+                        'Left as it is if not given; "" removes it.')
+    p.add_argument('--order-by', type=column_list(ORDER_BY),
+                   default=['time DESC'])
+    p.add_argument('--after', help='Compress chunks older than this.')
+
+    p = command('retention', 'Drop chunks once they are old enough.')
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument('--drop-after', help='Drop chunks older than this.')
+    group.add_argument('--off', action='store_true',
+                       help='Remove the retention policy.')
+
+    p = command('chunk-interval', 'Set the time interval of new chunks.')
+    p.add_argument('interval')
+
+    command('report', 'Show the compression ratio of each chunk.')
@@ -0,0 +1,139 @@
+"""
+In-memory aggregation of metric samples.
+
+Samples are grouped into series by metric name and tags, and into
+windows of ``METRIC_WINDOW_SECONDS`` by their ``created`` time. Each
+series keeps the count, sum, min and max of its samples in the window,
+and a `Sketch` for approximate quantiles, so the memory needed does not
+grow with the number of samples. The number of series held at once is
+limited to ``METRIC_MAX_SERIES``; samples of new series beyond that are
+dropped.
+"""
+import math
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from . import codec
+from .decode import Tags
+
+SeriesKey = Tuple[float, str, Tags]
+
+# Column order of the rows written to the ``metric`` table.
+METRIC_COLUMNS = ('time', 'name', 'tags', 'count', 'sum', 'min', 'max', 'data')
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Sketch:
+    """Approximate quantiles with a bounded relative error, in the manner
+    of DDSketch: values are counted in buckets whose bounds grow
+    geometrically, so any quantile is within ``relative_accuracy`` of
+    the true value. The number of buckets depends on the range of the
+    values, not on how many there are."""
+    __slots__ = ('gamma', 'log_gamma', 'positive', 'negative', 'zeros', 'count')
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive: Dict[int, int] = defaultdict(int)
+        self.negative: Dict[int, int] = defaultdict(int)
+        self.zeros = 0
+        self.count = 0
+
+    def index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def add(self, value: float):
+        self.count += 1
+        if value > 0:
+            self.positive[self.index(value)] += 1
+        elif value < 0:
+            self.negative[self.index(-value)] += 1
+        else:
+            self.zeros += 1
+
+    def value(self, index: int) -> float:
+        # The middle of the bucket, in relative terms.
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self.value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self.value(index)
+        return self.value(max(self.positive))  # pragma: no cover
+
+
+class Series:
+    __slots__ = ('count', 'sum', 'min', 'max', 'sketch')
+
+    def __init__(self, relative_accuracy: float):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = Sketch(relative_accuracy)
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sketch.add(value)
+
+    def quantiles(self) -> Dict[str, float]:
+        # The sketch may overshoot the extremes slightly.
+        return {f'p{q * 100:g}': min(self.max, max(self.min, self.sketch.quantile(q)))
+                for q in QUANTILES}
+
+
+class Aggregator:
+    def __init__(self, window: float, max_series: Optional[int] = None,
+                 relative_accuracy: float = 0.01):
+        self.window = window
+        self.max_series = max_series
+        self.relative_accuracy = relative_accuracy
+        self.series: Dict[SeriesKey, Series] = {}
+
+    def add(self, samples: Sequence[Tuple[float, str, Tags, float]]) -> int:
+        """Add samples of ``(created, name, tags, value)``. Returns the
+        number that were dropped, because they would be a new series
+        beyond ``max_series``, if that is given."""
+        dropped = 0
+        for created, name, tags, value in samples:
+            key = (created - created % self.window, name, tags)
+            series = self.series.get(key)
+            if series is None:
+                if (self.max_series is not None
+                        and len(self.series) >= self.max_series):
+                    dropped += 1
+                    continue
+                series = self.series[key] = Series(self.relative_accuracy)
+            series.add(value)
+        return dropped
+
+    def take(self, now: float = None) -> List[Tuple]:
+        """Remove the series of the windows that ended before ``now``,
+        or all of them, and return them as rows of `METRIC_COLUMNS`."""
+        keys = [k for k in self.series
+                if now is None or k[0] + self.window <= now]
+        return [row(key, self.series.pop(key)) for key in keys]
+
+
+def row(key: SeriesKey, series: Series) -> Tuple:
+    start, name, tags = key
+    return (datetime.fromtimestamp(start), name, codec.dumps(dict(tags)),
+            series.count, series.sum, series.min, series.max,
+            codec.dumps(series.quantiles()))
+
@@ -0,0 +1,270 @@
+"""
+HTTP query API.
+
+``GET /logs`` streams the records that match the query parameters as
+NDJSON, newest first:
+
+- ``correlation_id``
+- ``start``, ``end``: ISO 8601 times, ``start <= time < end``
+- ``level``: the minimum level, as a name or a number
+- ``name``, ``app``: exact matches on the promoted columns
+- ``contains``: JSON that ``data`` must contain, e.g., ``{"user": 42}``
+- ``limit``: the page size, see `venus.db.query.stream_logs`
+- ``before``: the time of the last record of the previous page
+
+``GET /volume`` returns record counts per time bucket from the rollups:
+
+- ``start``, ``end``: by default, the last hour
+- ``bucket``: the bucket width in seconds, 60 by default
+- ``group_by``: comma-separated, any of levelno, name and app
+- ``level``, ``name``, ``app``: filters, as above
+
+The queries run on a pool of their own, so they do not take
+connections from the writers. Nothing is sent until the query has
+produced its first row, so that a query that fails or times out gets a
+proper error status. After that, the records are written at the pace
+of the client, up to ``QUERY_IDLE_TIMEOUT_SECONDS`` per write.
+"""
+import asyncio
+import json
+import logging
+from asyncio import StreamReader, StreamWriter
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlsplit
+from uuid import UUID
+
+import asyncpg
+
+from . import db
+from . import metrics
+from . import settings
+from .db import query
+from .sinks import ndjson_line
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Unavailable(Exception):
+    pass
+
+
+def parse_time(value: str) -> datetime:
+    try:
+        # Python before 3.11 does not take "Z".
+        t = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise BadRequest(f'Not an ISO 8601 time: {value}')
+    return t if t.tzinfo else t.replace(tzinfo=timezone.utc)
+
+
+def parse_int(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(f'Not an integer: {value}')
+
+
+def logs_filters(params: Dict[str, str]) -> Dict:
+    filters = {}
+    if 'correlation_id' in params:
+        try:
+            filters['correlation_id'] = UUID(params['correlation_id'])
+        except ValueError:
+            raise BadRequest(f'Not a UUID: {params["correlation_id"]}')
+    for key in ('start', 'end', 'before'):
+        if key in params:
+            filters[key] = parse_time(params[key])
+    if 'level' in params:
+        try:
+            filters['min_levelno'] = query.level_number(params['level'])
+        except ValueError as e:
+            raise BadRequest(str(e))
+    for key in ('name', 'app'):
+        if key in params:
+            filters[key] = params[key]
+    if 'contains' in params:
+        try:
+            json.loads(params['contains'])
+        except ValueError:
+            raise BadRequest('"contains" is not valid JSON')
+        filters['contains'] = params['contains']
+    return filters
+
+
+def page_size(params: Dict[str, str]) -> int:
+    limit = parse_int(params.get('limit', str(settings.QUERY_DEFAULT_LIMIT())))
+    if not 0 < limit <= settings.QUERY_MAX_LIMIT():
+        raise BadRequest(f'"limit" must be from 1 to {settings.QUERY_MAX_LIMIT()}')
+    return limit
+
+
+def record_line(record: asyncpg.Record) -> bytes:
+    # The JSONB codec returns the JSON text of "data", which is embedded
+    # as it is.
+    values = [v.encode() if k == 'data' else v for k, v in record.items()]
+    return ndjson_line(record.keys(), values)
+
+
+@asynccontextmanager
+async def acquire(pool: asyncpg.pool.Pool):
+    try:
+        conn = await pool.acquire(
+            timeout=settings.QUERY_ACQUIRE_TIMEOUT_SECONDS())
+    except asyncio.TimeoutError:
+        raise Unavailable('Too many queries, try again later')
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+async def get_logs(pool: asyncpg.pool.Pool, params: Dict[str, str],
+                   writer: StreamWriter):
+    filters = logs_filters(params)
+    limit = page_size(params)
+    started = False
+
+    async def emit(record):
+        nonlocal started
+        if not started:
+            write_headers(writer, '200 OK')
+            started = True
+        writer.write(record_line(record))
+        # Waits for a slow client, rather than buffering, but not for
+        # ever, since this holds a connection and a transaction.
+        await asyncio.wait_for(writer.drain(),
+                               settings.QUERY_IDLE_TIMEOUT_SECONDS())
+
+    async with acquire(pool) as conn:
+        try:
+            n = await query.stream_logs(conn, emit, limit, **filters)
+        except asyncpg.QueryCanceledError:
+            if started:
+                raise
+            raise Unavailable('The query took too long')
+    if not started:
+        write_headers(writer, '200 OK')
+    metrics.QUERY_RECORDS.inc(n)
+
+
+async def get_volume(pool: asyncpg.pool.Pool, params: Dict[str, str],
+                     writer: StreamWriter):
+    end = parse_time(params['end']) if 'end' in params \
+        else datetime.now(timezone.utc)
+    start = parse_time(params['start']) if 'start' in params \
+        else end - timedelta(hours=1)
+    bucket = timedelta(seconds=parse_int(params.get('bucket', '60')))
+    group_by = [c for c in params.get('group_by', 'levelno').split(',') if c]
+    filters = {k: v for k, v in logs_filters(params).items()
+               if k in ('min_levelno', 'name', 'app')}
+
+    async with acquire(pool) as conn:
+        try:
+            rows = await query.log_volume(conn, start, end, bucket, group_by,
+                                          **filters)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        except asyncpg.QueryCanceledError:
+            raise Unavailable('The query took too long')
+    write_headers(writer, '200 OK')
+    writer.write(b''.join(ndjson_line(r.keys(), r.values()) for r in rows))
+
+
+ROUTES = {
+    '/logs': get_logs,
+    '/volume': get_volume,
+}
+
+
+def write_headers(writer: StreamWriter, status: str,
+                  content_type: str = 'application/x-ndjson'):
+    # Without a Content-Length, the end of the body is where the
+    # connection is closed.
+    writer.write(
+        f'HTTP/1.1 {status}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Connection: close\r\n\r\n'.encode()
+    )
+
+
+def write_error(writer: StreamWriter, status: str, message: str):
+    write_headers(writer, status, 'text/plain; charset=utf-8')
+    writer.write(message.encode() + b'\n')
+
+
+async def handle(pool: asyncpg.pool.Pool, reader: StreamReader,
+                 writer: StreamWriter):
+    status = '200'
+    path = ''
+    try:
+        request_line = await reader.readline()
+        # Skip the headers; there is no request body for a GET.
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        url = urlsplit(parts[1]) if len(parts) >= 2 else None
+        path = url.path if url else ''
+        route = ROUTES.get(path)
+        if parts[:1] != ['GET'] or not route:
+            status = '404'
+            write_error(writer, '404 Not Found', 'Not found')
+            path = 'other'
+        else:
+            params = dict(parse_qsl(url.query))
+            try:
+                await route(pool, params, writer)
+            except BadRequest as e:
+                status = '400'
+                write_error(writer, '400 Bad Request', str(e))
+            except Unavailable as e:
+                status = '503'
+                write_error(writer, '503 Service Unavailable', str(e))
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        status = 'disconnected'
+    except asyncio.TimeoutError:
+        # The client stopped reading.
+        status = 'timeout'
+    except Exception:
+        # Once the records are streaming, all that can be done is to
+        # cut the response short.
+        status = '500'
+        logger.exception('Error in the query API:')
+    finally:
+        metrics.QUERY_REQUESTS.inc(path=path, status=status)
+        writer.close()
+
+
+async def serve(port: int, host: str = '0.0.0.0'):
+    """Long-running task serving the query API."""
+    timeout = int(settings.QUERY_STATEMENT_TIMEOUT_SECONDS() * 1000)
+    idle_timeout = int(settings.QUERY_IDLE_TIMEOUT_SECONDS() * 1000)
+    pool = await db.create_pool(
+        max_size=settings.QUERY_POOL_SIZE(),
+        server_settings=dict(
+            statement_timeout=str(timeout),
+            # A backstop, in case the client timeout above does not fire.
+            idle_in_transaction_session_timeout=str(2 * idle_timeout),
+        ),
+    )
+
+    async def connection(reader: StreamReader, writer: StreamWriter):
+        await handle(pool, reader, writer)
+
+    logger.info('Starting up the query API on %s:%s', host, port)
+    server = await asyncio.start_server(connection, host=host, port=port)
+
+    try:
+        while True:
+            await asyncio.sleep(1)
+    except asyncio.CancelledError:
+        logger.warning('Shutting down the query API.')
+        server.close()
+        await server.wait_closed()
+        await pool.close()
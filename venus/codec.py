@@ -0,0 +1,89 @@
+"""
+JSON codec used on the ingest hot path and by the DB connections.
+
+If orjson is installed it is used, otherwise the stdlib json module.
+``JSON_CODEC`` can force one or the other. `dumps` always returns
+bytes, which can go straight into the binary JSONB codec without a
+round trip through str.
+"""
+import json
+import logging
+
+from . import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# The version byte that prefixes JSONB values in the binary format.
+JSONB_VERSION = b'\x01'
+
+
+def json_loads(data):
+    if isinstance(data, memoryview):
+        # The stdlib does not take these; orjson does.
+        data = bytes(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+
+def orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # orjson is stricter than the stdlib, e.g., it rejects the
+        # NaN and Infinity that json.dumps emits by default. Those are
+        # rare enough to just retry.
+        return json_loads(data)
+
+
+def orjson_dumps(obj) -> bytes:
+    return orjson.dumps(obj)
+
+
+def use(name: str):
+    """Select the codec by name: "orjson", "json" or "auto"."""
+    global NAME, loads, dumps
+    if name == 'auto':
+        name = 'orjson' if orjson else 'json'
+    if name == 'orjson' and not orjson:
+        logger.warning('orjson is not installed. Using the stdlib json codec.')
+        name = 'json'
+
+    NAME = name
+    if name == 'orjson':
+        loads, dumps = orjson_loads, orjson_dumps
+    else:
+        loads, dumps = json_loads, json_dumps
+
+
+def dumps_str(obj) -> str:
+    return dumps(obj).decode()
+
+
+def encode_jsonb(value) -> bytes:
+    """Binary JSONB encoder. Already-encoded JSON, as bytes or str, is
+    passed through as is."""
+    if isinstance(value, bytes):
+        return JSONB_VERSION + value
+    if isinstance(value, str):
+        return JSONB_VERSION + value.encode()
+    return JSONB_VERSION + dumps(value)
+
+
+def decode_jsonb(data: bytes) -> str:
+    """Binary JSONB decoder. Returns the JSON text, the same as the
+    default asyncpg codec does."""
+    return data[1:].decode()
+
+
+NAME: str = None
+loads = None
+dumps = None
+use(settings.JSON_CODEC())
@@ -0,0 +1,72 @@
+"""
+Compressed message bodies.
+
+A sender may compress the JSON body of a message with zstd or lz4 (in
+the lz4 *frame* format). There is no extra header: the standard magic
+number at the start of each frame format says which one was used, and
+neither can be the start of a JSON document, so compressed and plain
+messages can be mixed freely on the same socket.
+
+The decompressors are optional dependencies (``pip install
+venus-bug-trap[compression]``). A compressed message that cannot be
+decompressed, because the library is missing or the data is bad, is
+counted as a decode failure. Decompressed bodies are limited to
+``DECOMPRESS_MAX_BYTES``, to guard against decompression bombs.
+"""
+from . import settings
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+
+
+def compression_of(payload: bytes) -> str:
+    """Returns "zstd", "lz4", or "" for an uncompressed payload."""
+    prefix = payload[:4]
+    if prefix == ZSTD_MAGIC:
+        return 'zstd'
+    if prefix == LZ4_MAGIC:
+        return 'lz4'
+    return ''
+
+
+def decompress(payload: bytes, method: str = None) -> bytes:
+    """Raises ValueError if the payload cannot be decompressed."""
+    method = method if method is not None else compression_of(payload)
+    if not method:
+        return payload
+
+    limit = settings.CONFIG.decompress_max_bytes
+    try:
+        if method == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstandard is not installed')
+            # A stream reader copes with frames that do not record their
+            # content size, and stops at the limit.
+            with zstandard.ZstdDecompressor().stream_reader(payload) as reader:
+                data = reader.read(limit + 1)
+        elif method == 'lz4':
+            if lz4 is None:
+                raise ValueError('lz4 is not installed')
+            data = lz4.frame.LZ4FrameDecompressor().decompress(
+                payload, max_length=limit + 1)
+        else:
+            raise ValueError(f'Unknown compression: {method}')
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f'Could not decompress {method} payload: {e}') from e
+
+    if len(data) > limit:
+        raise ValueError(f'Decompressed {method} payload is larger than '
+                         f'{limit} bytes')
+    return data
@@ -1,12 +1,15 @@
 import asyncio
-import json
 import logging
-from typing import Awaitable
+from typing import Awaitable, Dict
 
 import asyncpg
 import asyncpg.pool
 import biodome
 
+from .. import codec
+from .. import settings
+from ..decode import ROUTED_RECORD_TYPES
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,39 +23,62 @@ get_db_host = biodome.environ.get_callable('DB_HOST', 'localhost')
 get_db_port = biodome.environ.get_callable('DB_PORT', 5432)
 
 
-def create_pool() -> Awaitable[asyncpg.pool.Pool]:
-    """ Helper to implicitly use the env vars """
-    db_url = (
-        f'postgres://{get_db_username()}:{get_db_password()}'
-        f'@{get_db_host()}:{get_db_port()}/{get_db_name()}'
-    )
-    db_url_safe = (
-        f'postgres://{get_db_username()}:XXXXXXXXX'
+def get_db_url(safe=False) -> str:
+    """ Build the connection URL from the env vars. With ``safe=True``
+    the password is masked so that the URL can be logged. """
+    password = 'XXXXXXXXX' if safe else get_db_password()
+    return (
+        f'postgres://{get_db_username()}:{password}'
         f'@{get_db_host()}:{get_db_port()}/{get_db_name()}'
     )
-    logging.debug(f'Connecting to database: {db_url_safe}')
+
+
+def create_pool(max_size: int = None,
+                server_settings: Dict[str, str] = None
+                ) -> Awaitable[asyncpg.pool.Pool]:
+    """ Helper to implicitly use the env vars. The default ``max_size``
+    suits the writers. """
+    db_url = get_db_url()
+    logging.debug(f'Connecting to database: {get_db_url(safe=True)}')
     # Create the pool with no connections pre-initialised. This allows us
     # to create the pool instance outside of the main application loop.
     # If min_size > 0, and a connection create attempt (made while creating
     # the pool instance) failed, it would prevent the main application loop
     # from coming up.
+    if max_size is None:
+        # One connection per in-flight batch of each lane, one per writer
+        # of the routed records, one for the spill drain, plus one spare.
+        max_size = (settings.MAX_INFLIGHT_BATCHES()
+                    + settings.HIGH_PRIORITY_INFLIGHT_BATCHES()
+                    + len(ROUTED_RECORD_TYPES) + 1 + 1)
     return asyncpg.create_pool(db_url, init=set_json_charset, min_size=0,
-                               # There is only one writer.
-                               max_size=2)
+                               max_size=max_size,
+                               server_settings=server_settings)
 
 
 async def set_json_charset(connection):
     """
     Allow asyncpg to encode/decode JSONB types with the ::json suffix in
     queries. Used in create_pool.
+
+    JSONB values are sent in the binary format. Records from `collect`
+    carry their JSON already encoded as bytes, and these go to the
+    server without a round trip through str.
     """
 
     await connection.set_type_codec(
         'json',
-        encoder=json.dumps,
-        decoder=json.loads,
+        encoder=codec.dumps_str,
+        decoder=codec.loads,
         schema='pg_catalog'
     )
+    await connection.set_type_codec(
+        'jsonb',
+        encoder=codec.encode_jsonb,
+        decoder=codec.decode_jsonb,
+        schema='pg_catalog',
+        format='binary'
+    )
 
 
 async def init_database_pool():
@@ -0,0 +1,140 @@
+"""
+Reading from the database.
+
+Records are streamed from a server-side cursor, newest first, so that a
+large result is never held in memory as a whole. Log volume, i.e. the
+number of records per time bucket by level, logger name and app, is
+read from the ``logs_1m`` and ``logs_1h`` continuous aggregates rather
+than from the raw ``logs`` rows.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple, Union
+from uuid import UUID
+
+import asyncpg
+from asyncpg import Connection
+
+from ..decode import LOG_COLUMNS, PROMOTABLE_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# All the columns of ``logs``, in the order they are returned.
+QUERY_COLUMNS = LOG_COLUMNS + tuple(PROMOTABLE_FIELDS)
+
+# Continuous aggregates of ``logs``, from the widest bucket.
+ROLLUPS = (
+    (timedelta(hours=1), 'logs_1h'),
+    (timedelta(minutes=1), 'logs_1m'),
+)
+# The columns that the rollups are grouped by.
+VOLUME_COLUMNS = ('levelno', 'name', 'app')
+
+
+def level_number(level: Union[int, str]) -> int:
+    """``'ERROR'``, ``'40'`` and ``40`` are all 40."""
+    if isinstance(level, int):
+        return level
+    if level.isdigit():
+        return int(level)
+    number = logging.getLevelName(level.upper())
+    if not isinstance(number, int):
+        raise ValueError(f'Unknown level: {level}')
+    return number
+
+
+def logs_query(correlation_id: Optional[UUID] = None,
+               start: Optional[datetime] = None,
+               end: Optional[datetime] = None,
+               before: Optional[datetime] = None,
+               min_levelno: Optional[int] = None,
+               name: Optional[str] = None,
+               app: Optional[str] = None,
+               contains: Optional[str] = None) -> Tuple[str, List[Any]]:
+    """The query for the records that match all the given filters,
+    newest first, and its arguments. ``contains`` is JSON that ``data``
+    must contain, as with the ``@>`` operator."""
+    args = []
+    where = []
+    for condition, value in (('correlation_id = {}', correlation_id),
+                             ('time >= {}', start),
+                             ('time < {}', end),
+                             ('time < {}', before),
+                             ('levelno >= {}', min_levelno),
+                             ('name = {}', name),
+                             ('app = {}', app),
+                             ('data @> {}::jsonb', contains)):
+        if value is not None:
+            args.append(value)
+            where.append(condition.format(f'${len(args)}'))
+
+    sql = f'SELECT {", ".join(QUERY_COLUMNS)} FROM logs'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql + ' ORDER BY time DESC', args
+
+
+async def stream_logs(conn: Connection,
+                      emit: Callable[[asyncpg.Record], Awaitable[None]],
+                      limit: int, prefetch: int = 500, **filters) -> int:
+    """Pass the records that match ``filters`` (see `logs_query`) to
+    ``emit`` one at a time, reading ``prefetch`` rows at a time from a
+    server-side cursor. Returns the number of records.
+
+    This is one page of the results. It ends after ``limit`` records,
+    but never between two records with the same time, so that the time
+    of the last record can be the ``before`` of the next page."""
+    sql, args = logs_query(**filters)
+    n = 0
+    last_time = None
+    async with conn.transaction(readonly=True):
+        async for record in conn.cursor(sql, *args, prefetch=prefetch):
+            if n >= limit and record['time'] != last_time:
+                break
+            await emit(record)
+            n += 1
+            last_time = record['time']
+    return n
+
+
+def rollup_for(bucket: timedelta) -> str:
+    """The widest rollup that ``bucket`` is a whole multiple of."""
+    for width, view in ROLLUPS:
+        if bucket >= width and bucket % width == timedelta(0):
+            return view
+    raise ValueError(f'The bucket must be a whole number of minutes: {bucket}')
+
+
+async def log_volume(conn: Connection, start: datetime, end: datetime,
+                     bucket: timedelta = timedelta(minutes=1),
+                     group_by: Sequence[str] = ('levelno',),
+                     min_levelno: Optional[int] = None,
+                     name: Optional[str] = None,
+                     app: Optional[str] = None) -> List[asyncpg.Record]:
+    """Count records per ``bucket`` from ``start`` until ``end``, by the
+    ``group_by`` columns (any of `VOLUME_COLUMNS`). Each row has
+    ``bucket``, the ``group_by`` columns, and ``records``."""
+    for column in group_by:
+        if column not in VOLUME_COLUMNS:
+            raise ValueError(f'Cannot group by {column!r}')
+
+    args = [bucket, start, end]
+    where = ['bucket >= $2', 'bucket < $3']
+    for column, op, value in (('levelno', '>=', min_levelno),
+                              ('name', '=', name),
+                              ('app', '=', app)):
+        if value is not None:
+            args.append(value)
+            where.append(f'{column} {op} ${len(args)}')
+
+    columns = ''.join(f', {c}' for c in group_by)
+    # By position, since the output column "bucket" hides the input one.
+    positions = ', '.join(str(i + 1) for i in range(len(group_by) + 1))
+    return await conn.fetch(f"""
+        SELECT time_bucket($1, bucket) AS bucket{columns},
+               sum(records)::bigint AS records
+        FROM {rollup_for(bucket)}
+        WHERE {' AND '.join(where)}
+        GROUP BY {positions}
+        ORDER BY {positions}
+    """, *args)
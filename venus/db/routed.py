@@ -0,0 +1,274 @@
+"""
+Writers for the records that are not log records: spans, context and
+metric samples, see ``record_type`` in `venus.decode`.
+
+Each table has a batch of its own, which is written by a task of its
+own, so these never hold up the logs or each other. A batch is written
+once it has ``MAX_BATCH_SIZE`` records, or ``MAX_BATCH_AGE_SECONDS``
+after its first record arrived, like the logs. Context records are
+coalesced per correlation_id within a batch, so that only the latest
+state is written, once.
+
+Metric samples are aggregated instead, see `venus.aggregation`, and a
+row per series is written to ``metric`` when each window has ended.
+
+Failed writes are retried. Meanwhile, new records are kept up to
+``ROUTED_BUFFER_BATCHES`` batches' worth, and after that the oldest are
+dropped.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .. import metrics
+from .. import settings
+from ..aggregation import METRIC_COLUMNS, Aggregator
+from ..decode import (CONTEXT_COLUMNS, RECORD_TYPE_CONTEXT, RECORD_TYPE_METRIC,
+                      RECORD_TYPE_SPAN, SPAN_COLUMNS)
+from ..sinks import write_records
+from . import get_db_pool
+
+logger = logging.getLogger(__name__)
+
+
+def insert_sql(table: str, columns: Sequence[str], key: str,
+               update: bool, newer: str = None) -> str:
+    """With ``newer``, a timestamp column, a row is not replaced by an
+    older one, e.g., from the spill log. Rows without the timestamp are
+    not compared."""
+    names = ', '.join(columns)
+    placeholders = ', '.join(f'${i + 1}' for i in range(len(columns)))
+    if update:
+        others = ', '.join(f'{c} = EXCLUDED.{c}' for c in columns if c != key)
+        conflict = f'DO UPDATE SET {others}'
+        if newer:
+            conflict += (f' WHERE EXCLUDED.{newer} IS NULL'
+                         f' OR {table}.{newer} IS NULL'
+                         f' OR EXCLUDED.{newer} >= {table}.{newer}')
+    else:
+        conflict = 'DO NOTHING'
+    return (f'INSERT INTO {table} ({names}) VALUES ({placeholders}) '
+            f'ON CONFLICT ({key}) {conflict}')
+
+
+class TableWriter:
+    """Batches of records for one table, keyed by the ``key`` column.
+    Spans are only ever inserted once; with ``update``, a record
+    replaces the previous one with the same key."""
+    def __init__(self, table: str, columns: Sequence[str], key: str,
+                 update: bool = False, newer: str = None):
+        self.table = table
+        self.sql = insert_sql(table, columns, key, update, newer)
+        self.key_index = columns.index(key)
+        # Insertion-ordered, so the oldest records are dropped first.
+        self.batch: Dict = {}
+        self.batch_started: Optional[float] = None
+        self.full = asyncio.Event()
+
+    def coalesce(self, records: List[Tuple], into: Dict = None) -> Dict:
+        """The latest record per key, oldest first."""
+        into = {} if into is None else into
+        for record in records:
+            key = record[self.key_index]
+            # Moved to the end, as the latest.
+            into.pop(key, None)
+            into[key] = record
+        return into
+
+    def add(self, records: List[Tuple]):
+        if not self.batch:
+            self.batch_started = asyncio.get_event_loop().time()
+        self.coalesce(records, self.batch)
+
+        config = settings.CONFIG
+        limit = config.routed_buffer_batches * config.max_batch_size
+        while len(self.batch) > limit:
+            del self.batch[next(iter(self.batch))]
+            metrics.ROUTED_RECORDS_DROPPED.inc(table=self.table)
+        if len(self.batch) >= settings.CONFIG.max_batch_size:
+            self.full.set()
+
+    def rows(self, records: List[Tuple]) -> List[Tuple]:
+        return list(self.coalesce(records).values())
+
+    async def write(self, records: List[Tuple]):
+        async with get_db_pool().acquire() as conn:
+            await conn.executemany(self.sql, records)
+
+    async def flush(self) -> bool:
+        """Write the current batch. Returns False if that failed, in
+        which case the records go back into the batch, ahead of the
+        ones that arrived since."""
+        records = list(self.batch.values())[:settings.CONFIG.max_batch_size]
+        for record in records:
+            del self.batch[record[self.key_index]]
+        try:
+            await self.write(records)
+        except asyncio.CancelledError:
+            self.put_back(records)
+            raise
+        except Exception:
+            metrics.DB_ERRORS.inc()
+            logger.exception('Error while writing %d records to %s',
+                             len(records), self.table)
+            self.put_back(records)
+            return False
+        metrics.ROUTED_RECORDS_WRITTEN.inc(len(records), table=self.table)
+        self.batch_started = asyncio.get_event_loop().time()
+        return True
+
+    def put_back(self, records: List[Tuple]):
+        newer, self.batch = self.batch, {}
+        self.add(records)
+        self.add(list(newer.values()))
+
+    async def run(self):
+        """Long-running task that writes the batches."""
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        try:
+            while True:
+                timeout = settings.CONFIG.max_batch_age_seconds
+                if self.batch:
+                    timeout = max(0.0, self.batch_started + timeout - loop.time())
+                try:
+                    await asyncio.wait_for(self.full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.full.clear()
+                if not self.batch:
+                    continue
+                if await self.flush():
+                    attempt = 0
+                    if len(self.batch) >= settings.CONFIG.max_batch_size:
+                        self.full.set()
+                else:
+                    attempt += 1
+                    await asyncio.sleep(min(
+                        settings.CONFIG.write_retry_max_seconds,
+                        0.5 * 2 ** attempt))
+        except asyncio.CancelledError:
+            while self.batch:
+                if not await self.flush():
+                    logger.error('Could not write %d records to %s at '
+                                 'shutdown', len(self.batch), self.table)
+                    break
+
+
+def new_aggregator(max_series: Optional[int]) -> Aggregator:
+    return Aggregator(float(settings.METRIC_WINDOW_SECONDS()), max_series,
+                      settings.METRIC_RELATIVE_ACCURACY())
+
+
+class MetricWriter:
+    """Aggregates metric samples, and writes the series of each window
+    ``METRIC_LATENESS_SECONDS`` after it ends. The rows of failed writes
+    are written along with the next ones."""
+    table = 'metric'
+
+    def __init__(self):
+        self.aggregator = new_aggregator(settings.METRIC_MAX_SERIES())
+        self.pending: List[Tuple] = []
+
+    def add(self, samples: List[Tuple]):
+        dropped = self.aggregator.add(samples)
+        metrics.METRIC_SAMPLES_AGGREGATED.inc(len(samples) - dropped)
+        if dropped:
+            metrics.METRIC_SAMPLES_DROPPED.inc(dropped)
+        metrics.METRIC_SERIES.set(len(self.aggregator.series))
+
+    def rows(self, samples: List[Tuple]) -> List[Tuple]:
+        aggregator = new_aggregator(None)
+        aggregator.add(samples)
+        return aggregator.take()
+
+    async def write(self, rows: List[Tuple]):
+        async with get_db_pool().acquire() as conn:
+            await write_records(conn, rows, table=self.table,
+                                columns=METRIC_COLUMNS)
+
+    async def flush(self, now: float = None) -> bool:
+        """Write the windows that ended before ``now``, or all of them.
+        Returns False if that failed, in which case the rows are kept."""
+        rows = self.pending + self.aggregator.take(now)
+        self.pending = []
+        metrics.METRIC_SERIES.set(len(self.aggregator.series))
+        if not rows:
+            return True
+        try:
+            await self.write(rows)
+        except asyncio.CancelledError:
+            self.pending = rows
+            raise
+        except Exception:
+            metrics.DB_ERRORS.inc()
+            logger.exception('Error while writing %d rows to %s', len(rows),
+                             self.table)
+            config = settings.CONFIG
+            limit = config.routed_buffer_batches * config.max_batch_size
+            if len(rows) > limit:
+                metrics.ROUTED_RECORDS_DROPPED.inc(len(rows) - limit,
+                                                   table=self.table)
+            self.pending = rows[-limit:]
+            return False
+        metrics.ROUTED_RECORDS_WRITTEN.inc(len(rows), table=self.table)
+        return True
+
+    async def run(self):
+        """Long-running task that writes the windows as they end."""
+        attempt = 0
+        try:
+            while True:
+                if attempt:
+                    await asyncio.sleep(min(
+                        settings.CONFIG.write_retry_max_seconds,
+                        0.5 * 2 ** attempt))
+                else:
+                    await asyncio.sleep(min(1.0, self.aggregator.window))
+                # The windows are by the "created" times of the samples.
+                now = time.time() - settings.METRIC_LATENESS_SECONDS()
+                attempt = 0 if await self.flush(now) else attempt + 1
+        except asyncio.CancelledError:
+            # The current windows too, so that nothing is lost. If these
+            # get more samples after a restart, there will be two rows
+            # for them.
+            if not await self.flush():
+                logger.error('Could not write %d rows to %s at shutdown',
+                             len(self.pending), self.table)
+
+
+class RoutedWriters:
+    """The writers by record type."""
+    def __init__(self):
+        self.writers = {
+            RECORD_TYPE_SPAN: TableWriter('span', SPAN_COLUMNS, 'span_id'),
+            RECORD_TYPE_CONTEXT: TableWriter(
+                'context', CONTEXT_COLUMNS, 'correlation_id', update=True,
+                newer='updated'),
+            RECORD_TYPE_METRIC: MetricWriter(),
+        }
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(w.run()) for w in self.writers.values()]
+
+    def add(self, routed: Dict[str, List[Tuple]]):
+        for record_type, records in routed.items():
+            self.writers[record_type].add(records)
+
+    async def stop(self):
+        """Write whatever is left."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+async def write_routed(routed: Dict[str, List[Tuple]]):
+    """Write at once, e.g., the records from the spill log. Raises if
+    any write fails."""
+    writers = RoutedWriters().writers
+    for record_type, records in routed.items():
+        writer = writers[record_type]
+        await writer.write(writer.rows(records))
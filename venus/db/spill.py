@@ -0,0 +1,234 @@
+"""
+Append-only, segment-rotated spill log on local disk.
+
+When the receive queue is full, or a batch cannot be written to the
+database, the data is appended here instead of being dropped. A
+background task (see `venus.db.write.drain_spill`) moves the closed
+segments back into the database once it is reachable again. Any
+segments left over from a previous run are picked up at startup.
+
+Each entry in a segment is::
+
+    kind (1 byte) | payload length (4 bytes, big-endian) | payload
+
+where kind is ``R`` for a batch of decoded records, and ``M`` (or ``T``,
+with a content type) for a raw message that was never decoded. A torn
+entry at the end of a segment, e.g. after a crash, is ignored.
+"""
+import json
+import logging
+import os
+import struct
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List, Tuple, Sequence
+from uuid import UUID
+
+from .. import settings
+from ..models import Message
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!cI')
+LEVEL_HEADER = struct.Struct('!H')
+KIND_RECORDS = b'R'
+KIND_MESSAGE = b'M'
+KIND_TYPED_MESSAGE = b'T'
+MESSAGE_KINDS = (KIND_MESSAGE, KIND_TYPED_MESSAGE)
+SEGMENT_PREFIX = 'segment-'
+QUARANTINE_SUFFIX = '.bad'
+SEGMENT_SUFFIX = '.spill'
+
+
+SPILL: 'SpillLog' = None
+
+
+class SpillLog:
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024,
+                 max_bytes=1024 ** 3, fsync=False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.spilled_entries = 0
+        self.dropped_entries = 0
+
+        existing = self.segment_paths()
+        self.seq = segment_seq(existing[-1]) + 1 if existing else 0
+        self.total_bytes = sum(p.stat().st_size for p in existing)
+        self.active = None
+        self.active_bytes = 0
+        if existing:
+            logger.warning('Found %d spill segment(s) (%d bytes) from a '
+                           'previous run in %s. These will be replayed.',
+                           len(existing), self.total_bytes, self.directory)
+
+    def segment_paths(self) -> List[Path]:
+        return sorted(self.directory.glob(f'{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}'))
+
+    def active_path(self) -> Path:
+        return self.directory / f'{SEGMENT_PREFIX}{self.seq:012d}{SEGMENT_SUFFIX}'
+
+    def closed_segments(self) -> List[Path]:
+        """Segments that are no longer being appended to, oldest first."""
+        active = self.active_path() if self.active else None
+        return [p for p in self.segment_paths() if p != active]
+
+    def append_records(self, records: List, columns: Sequence[str]):
+        payload = json.dumps(
+            dict(columns=list(columns), records=records),
+            default=encode_value
+        ).encode()
+        return self.append(KIND_RECORDS, payload)
+
+    def append_message(self, msg: Message):
+        payload = LEVEL_HEADER.pack(len(msg.level)) + msg.level
+        if msg.content_type:
+            payload += (LEVEL_HEADER.pack(len(msg.content_type))
+                        + msg.content_type + msg.message)
+            return self.append(KIND_TYPED_MESSAGE, payload)
+        return self.append(KIND_MESSAGE, payload + msg.message)
+
+    def append(self, kind: bytes, payload: bytes) -> bool:
+        size = HEADER.size + len(payload)
+        if self.total_bytes + size > self.max_bytes:
+            self.dropped_entries += 1
+            logger.error('Spill log is full (%d bytes). Dropping data.',
+                         self.total_bytes)
+            return False
+
+        if self.active is None:
+            self.active = open(self.active_path(), 'ab')
+            self.active_bytes = 0
+
+        self.active.write(HEADER.pack(kind, len(payload)))
+        self.active.write(payload)
+        self.active.flush()
+        if self.fsync:
+            os.fsync(self.active.fileno())
+
+        self.active_bytes += size
+        self.total_bytes += size
+        self.spilled_entries += 1
+        if self.active_bytes >= self.segment_bytes:
+            self.rotate()
+        return True
+
+    def rotate(self):
+        """Close the active segment so that it can be drained."""
+        if self.active is None:
+            return
+        self.active.close()
+        self.active = None
+        self.seq += 1
+
+    def remove(self, path: Path):
+        self.total_bytes -= path.stat().st_size
+        path.unlink()
+
+    def quarantine(self, path: Path) -> Path:
+        """Rename a segment that cannot be decoded or written, so that
+        it is no longer drained, but is kept for inspection. It no longer counts
+        towards ``max_bytes``."""
+        self.total_bytes -= path.stat().st_size
+        target = path.with_name(path.name + QUARANTINE_SUFFIX)
+        path.rename(target)
+        return target
+
+    def close(self):
+        self.rotate()
+
+
+def segment_seq(path: Path) -> int:
+    return int(path.name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def read_segment(path: Path) -> Iterator[Tuple[bytes, bytes]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        kind, length = HEADER.unpack_from(data, pos)
+        pos += HEADER.size
+        if pos + length > len(data):
+            break
+        yield kind, data[pos:pos + length]
+        pos += length
+
+    if pos != len(data):
+        logger.warning('Ignoring %d bytes of torn data at the end of %s',
+                       len(data) - pos, path)
+
+
+def decode_records(payload: bytes) -> Tuple[List[str], List[Tuple]]:
+    d = json.loads(payload, object_hook=decode_value)
+    records = [tuple(r) for r in d['records']]
+    if 'data' in d['columns']:
+        # Older segments have the JSON of "data" as a str.
+        i = d['columns'].index('data')
+        records = [r[:i] + (r[i].encode(),) + r[i + 1:]
+                   if isinstance(r[i], str) else r for r in records]
+    return d['columns'], records
+
+
+def decode_message(payload: bytes, kind: bytes = KIND_MESSAGE) -> Message:
+    (level_size,) = LEVEL_HEADER.unpack_from(payload)
+    start = LEVEL_HEADER.size
+    level = payload[start:start + level_size]
+    start += level_size
+    content_type = b''
+    if kind == KIND_TYPED_MESSAGE:
+        (type_size,) = LEVEL_HEADER.unpack_from(payload, start)
+        start += LEVEL_HEADER.size
+        content_type = payload[start:start + type_size]
+        start += type_size
+    return Message(level, payload[start:], content_type)
+
+
+def encode_value(v):
+    if isinstance(v, datetime):
+        return {'$datetime': v.isoformat()}
+    if isinstance(v, UUID):
+        return {'$uuid': str(v)}
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        # Already-encoded JSON, which must stay bytes, see `ndjson_line`.
+        return {'$json': bytes(v).decode()}
+    raise TypeError(f'Cannot spill value of type {type(v)}')
+
+
+def decode_value(d):
+    if '$datetime' in d:
+        return datetime.fromisoformat(d['$datetime'])
+    if '$uuid' in d:
+        return UUID(d['$uuid'])
+    if '$json' in d:
+        return d['$json'].encode()
+    return d
+
+
+def open_spill(directory=None):
+    """Set the module-level spill log, if one is configured. Each
+    process must have its own directory."""
+    global SPILL
+    directory = directory or settings.SPILL_DIR()
+    if directory and SPILL is None:
+        SPILL = SpillLog(
+            directory,
+            segment_bytes=settings.SPILL_SEGMENT_BYTES(),
+            max_bytes=settings.SPILL_MAX_BYTES(),
+            fsync=settings.SPILL_FSYNC(),
+        )
+        logger.info('Spilling to %s', SPILL.directory)
+
+
+def close_spill():
+    global SPILL
+    if SPILL:
+        SPILL.close()
+        SPILL = None
+
+
+def get_spill() -> SpillLog:
+    return SPILL
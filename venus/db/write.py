@@ -1,91 +1,559 @@
 from __future__ import annotations
 import logging
 import asyncio
-import json
-from datetime import datetime
-from typing import List, Dict
-from uuid import UUID
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Union
 
-from asyncpg import Connection
 import aiodec
+import asyncpg
 
+from .. import metrics
 from .. import settings
-from . import get_db_pool
+from .. import tracing
+from . import routed
+from . import spill
+from .. import sinks
+from ..io import tail
+from ..decode import (RECORD_TYPE_METRIC, decode_chunk, init_worker,
+                      record_columns)
 from ..models import Message
+from ..tracing import Trace
 
 logger = logging.getLogger(__name__)
 
 
-async def collect(q: asyncio.Queue[Message]):
+async def collect(q: asyncio.Queue[Union[Message, List[Message]]],
+                  high_q: asyncio.Queue = None):
+    """Decode the messages from the queue and write them in batches.
+    Items on the queue may be single messages or lists of them.
+
+    Messages of the ``HIGH_PRIORITY_LEVELS`` may arrive on ``high_q``
+    instead. That lane is collected separately, see `collect_lane`, so
+    that they are not held up behind a flood of lower-level messages.
+
+    Span, context and metric records go to their own writers, see
+    `venus.db.routed`. These, the sinks and the live tail publisher are
+    closed once all the lanes are done."""
+    writers = None
+    if 'postgres' in sinks.sink_names():
+        writers = routed.RoutedWriters()
+        writers.start()
+    try:
+        if high_q is None:
+            await collect_lane(q, writers=writers)
+        else:
+            await asyncio.gather(
+                collect_lane(q, writers=writers),
+                collect_lane(high_q, high_priority=True, writers=writers))
+    finally:
+        if writers:
+            await writers.stop()
+        await sinks.close_sink()
+        tail.close_publisher()
+
+
+async def collect_lane(q: asyncio.Queue, high_priority=False,
+                       writers: routed.RoutedWriters = None):
+    """Collect one lane. The high-priority lane has its own pipeline, so
+    it never waits for a writer slot of the normal lane, and its batches
+    are flushed after ``HIGH_PRIORITY_MAX_BATCH_AGE_SECONDS`` at most.
+    It is always decoded inline.
+
+    With ``DECODE_WORKERS`` > 0, the normal lane is decoded in a process
+    pool. Chunks of messages are submitted as they arrive, and the
+    decoded chunks are taken back in the same order."""
+    global BATCHING
+    if high_priority:
+        policy = HighPriorityBatching()
+        pipeline = BatchPipeline(settings.HIGH_PRIORITY_INFLIGHT_BATCHES(),
+                                 policy)
+        n_decode_workers = 0
+    else:
+        if settings.ADAPTIVE_BATCHING():
+            BATCHING = AdaptiveBatching(settings.MAX_INFLIGHT_BATCHES())
+        else:
+            BATCHING = BatchingPolicy()
+        policy = BATCHING
+        pipeline = BatchPipeline(settings.MAX_INFLIGHT_BATCHES(), policy)
+        metrics.BATCHING_BATCH_SIZE.set_function(lambda: policy.batch_size)
+        metrics.BATCHING_FLUSH_AGE.set_function(lambda: policy.flush_age)
+        metrics.INFLIGHT_BATCHES.set_function(lambda: pipeline.inflight)
+        n_decode_workers = settings.DECODE_WORKERS()
+    settings.subscribe(policy.on_config)
+    traced = settings.TRACE_SAMPLE_RATE() > 0
+    publisher = tail.get_publisher()
+    executor = None
+    if n_decode_workers > 0:
+        executor = ProcessPoolExecutor(
+            n_decode_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+        )
+        # Holds the futures of submitted chunks, oldest first. The bound
+        # keeps a few chunks per worker in flight.
+        decoded = asyncio.Queue(maxsize=2 * n_decode_workers)
+        feeder = asyncio.get_event_loop().create_task(
+            submit_decode(q, decoded, executor, traced))
+        q = decoded
+
+    loop = asyncio.get_event_loop()
     batch = []
+    # Sampled traces of the messages in this batch. See `venus.tracing`.
+    batch_traces = []
+    # The flush deadline is counted from the first record in the batch.
+    batch_started = None
     try:
         while True:
+            timeout = policy.flush_age
+            if batch:
+                timeout = max(0.0, batch_started + timeout - loop.time())
             try:
-                msg = await asyncio.wait_for(
-                    q.get(), timeout=settings.MAX_BATCH_AGE_SECONDS())
+                item = await asyncio.wait_for(q.get(), timeout=timeout)
             except asyncio.TimeoutError:
                 if batch:
-                    await write_and_clear(batch, len(batch))
+                    await pipeline.submit(batch, batch_traces)
+                    batch, batch_traces = [], []
                 continue
 
-            try:
-                logger.debug(f'Got message in collect: {msg}')
-                d = json.loads(msg.message)
-            except json.JSONDecodeError:
-                logger.exception(f'JSON decoding failed on: {msg.message}')
-                continue
+            records, traces, others = await decode_or_skip(item, traced)
+            route(writers, others)
+            if publisher:
+                publisher.publish(records)
+            batch_traces.extend(traces)
+            policy.observe_arrivals(len(records), loop.time())
+            for record in records:
+                if not batch:
+                    batch_started = loop.time()
+                batch.append(record)
 
-            # The received JSON will be saved into the DB, but we extract
-            # a few fields that will be used often in queries.
-            # TODO: currently the DB type is TIMESTAMPTZ. Might need TIMESTAMP
-            time = extract_safe(d, 'created', datetime.fromtimestamp)
-            if not time:
-                logger.info('Message does not have a "created" field. Dropping.')
-                continue
+                if len(batch) >= policy.batch_size:
+                    await pipeline.submit(batch, batch_traces)
+                    batch, batch_traces = [], []
+    except asyncio.CancelledError:
+        if executor:
+            feeder.cancel()
+            while not q.empty():
+                records, traces, others = await decode_or_skip(
+                    q.get_nowait(), traced)
+                route(writers, others)
+                batch.extend(records)
+                batch_traces.extend(traces)
+            executor.shutdown(wait=False)
+        if batch:
+            await pipeline.submit(batch, batch_traces)
+        await pipeline.drain()
+        settings.unsubscribe(policy.on_config)
 
-            message = extract_safe(d, 'message')
-            correlation_id = extract_safe(d, 'correlation_id', UUID)
 
-            # Besides the ones extracted above, we also remove a few more
-            # that we don't care about.
-            remove_unwanted_keys(d)
-            data = json.dumps(d)
+async def decode_item(item, traced=False
+                      ) -> Tuple[List[Tuple], List[Trace], Dict[str, List]]:
+    """An item is either a (future, traces) pair from the decode process
+    pool, or messages that still need decoding. Returns the log records,
+    the traces of the sampled messages among them, and the other records
+    by their type."""
+    if isinstance(item, tuple):
+        future, traces = item
+        records, stats, others = await future
+    else:
+        msgs = item if isinstance(item, list) else [item]
+        traces = trace_list(msgs) if traced else []
+        tracing.stamp_all(traces, 'dequeued')
+        records, stats, others = decode_chunk(
+            [msg.message for msg in msgs], [msg.content_type for msg in msgs])
+
+    tracing.stamp_all(traces, 'decoded')
+    if stats:
+        metrics.DECODE_FAILURES.inc(stats['decode_failures'])
+        metrics.MISSING_CREATED.inc(stats['missing_created'])
+        metrics.MESSAGES_COMPRESSED.inc(stats['compressed'])
+        metrics.BATCH_MESSAGES.inc(stats['batches'])
+        metrics.BATCHED_RECORDS.inc(stats['batched_records'])
+    return records, traces, others
 
-            batch.append(
-                (time, message, correlation_id, data)
-            )
 
-            if len(batch) >= settings.MAX_BATCH_SIZE():
-                await write_and_clear(batch, len(batch))
+async def decode_or_skip(item, traced=False
+                         ) -> Tuple[List[Tuple], List[Trace], Dict[str, List]]:
+    """Like `decode_item`, but a chunk that fails in a way that
+    `decode_chunk` does not handle is logged and dropped, rather than
+    ending the lane."""
+    try:
+        return await decode_item(item, traced)
     except asyncio.CancelledError:
-        if batch:
-            await write_and_clear(batch, len(batch))
+        raise
+    except Exception:
+        metrics.DECODE_FAILURES.inc(len(item) if isinstance(item, list) else 1)
+        logger.exception('Dropping a chunk that could not be decoded')
+        return [], [], {}
+
+
+def route(writers: routed.RoutedWriters, others: Dict[str, List]):
+    if not others:
+        return
+    if writers:
+        writers.add(others)
+        return
+    for record_type, records in others.items():
+        metrics.ROUTED_RECORDS_DROPPED.inc(len(records), table=record_type)
+
+
+def trace_list(msgs: List[Message]) -> List[Trace]:
+    return [msg.trace for msg in msgs if msg.trace is not None]
+
+
+async def submit_decode(q: asyncio.Queue, decoded: asyncio.Queue,
+                        executor: ProcessPoolExecutor, traced=False):
+    """Long-running task that sends chunks of raw message bodies to the
+    process pool, and places the futures on ``decoded`` in order."""
+    loop = asyncio.get_event_loop()
+    chunk_size = settings.DECODE_CHUNK_SIZE()
+    while True:
+        payloads = []
+        content_types = []
+        traces = []
+        while True:
+            item = await q.get()
+            msgs = item if isinstance(item, list) else [item]
+            payloads.extend(msg.message for msg in msgs)
+            content_types.extend(msg.content_type for msg in msgs)
+            if traced:
+                traces.extend(trace_list(msgs))
+            if len(payloads) >= chunk_size or q.empty():
+                break
+
+        tracing.stamp_all(traces, 'dequeued')
+        for i in range(0, len(payloads), chunk_size):
+            future = loop.run_in_executor(
+                executor, decode_chunk, payloads[i:i + chunk_size],
+                content_types[i:i + chunk_size])
+            # The traces go with the first chunk.
+            await decoded.put((future, traces if i == 0 else []))
+
+
+class BatchPipeline:
+    """Write batches concurrently, each on its own pooled connection.
+
+    At most ``max_inflight`` batches are committing at any time. When
+    all the slots are taken, `submit` waits, which stalls `collect`
+    and lets the receive queue absorb the burst. """
+    def __init__(self, max_inflight: int, policy: BatchingPolicy = None):
+        self.max_inflight = max_inflight
+        self.policy = policy or BatchingPolicy()
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.pending: Dict[int, asyncio.Task] = {}
+        self.batch_ids = itertools.count()
+        self.completed = 0
+        self.failed_attempts = 0
+
+    @property
+    def inflight(self) -> int:
+        return len(self.pending)
+
+    async def submit(self, records: List, traces: List[Trace] = ()):
+        """Hand the batch over to a writer task. The caller must not
+        touch ``records`` afterwards."""
+        await self.semaphore.acquire()
+        batch_id = next(self.batch_ids)
+        task = asyncio.get_event_loop().create_task(
+            self.write(batch_id, records, traces))
+        self.pending[batch_id] = task
+        task.add_done_callback(lambda t: self.done(batch_id))
+
+    def done(self, batch_id: int):
+        del self.pending[batch_id]
+        self.semaphore.release()
+
+    async def write(self, batch_id: int, records: List,
+                    traces: List[Trace] = ()):
+        size = len(records)
+        attempt = 0
+        loop = asyncio.get_event_loop()
+        tracing.stamp_all(traces, 'flush_start')
+        while True:
+            attempt += 1
+            t0 = loop.time()
+            outcome = await write_and_clear(records, size)
+            if outcome == COMMITTED:
+                elapsed = loop.time() - t0
+                self.policy.observe_insert(size, elapsed)
+                metrics.RECORDS_WRITTEN.inc(size)
+                metrics.BATCH_SIZE.observe(size)
+                metrics.INSERT_SECONDS.observe(elapsed)
+                tracing.stamp_all(traces, 'committed')
+                tracing.record(traces)
+                break
+            self.failed_attempts += 1
+            if outcome == SPILLED:
+                # Written later by `drain_spill`, which is not traced.
+                break
+            await asyncio.sleep(
+                min(settings.CONFIG.write_retry_max_seconds, 0.5 * 2 ** attempt))
+
+        self.completed += 1
+        logger.debug('Batch %d (%d records) %s after %d attempt(s). '
+                     '%d batches in flight.',
+                     batch_id, size, outcome, attempt, self.inflight - 1)
+
+    async def drain(self):
+        """Wait for all the in-flight batches to be committed."""
+        if self.pending:
+            await asyncio.gather(*self.pending.values(),
+                                 return_exceptions=True)
+
+
+class BatchingPolicy:
+    """Static batch size and flush deadline, straight from the settings."""
+    @property
+    def batch_size(self) -> int:
+        return settings.CONFIG.max_batch_size
 
+    @property
+    def flush_age(self) -> float:
+        return settings.CONFIG.max_batch_age_seconds
 
-def remove_unwanted_keys(data: Dict):
-    for key in settings.DROP_FIELDS():
-        data.pop(key, None)
+    def observe_arrivals(self, n: int, now: float):
+        pass
+
+    def observe_insert(self, size: int, seconds: float):
+        pass
+
+    def on_config(self, old: settings.Config, new: settings.Config):
+        """Subscriber for changes of the settings."""
+        pass
+
+    def snapshot(self) -> Dict:
+        return dict(adaptive=False, batch_size=self.batch_size,
+                    flush_age=self.flush_age)
+
+
+class HighPriorityBatching(BatchingPolicy):
+    """The high-priority lane has a shorter flush deadline."""
+    @property
+    def flush_age(self) -> float:
+        config = settings.CONFIG
+        return min(config.high_priority_max_batch_age_seconds,
+                   config.max_batch_age_seconds)
+
+    def snapshot(self) -> Dict:
+        return dict(super().snapshot(), high_priority=True)
+
+
+class AdaptiveBatching(BatchingPolicy):
+    """Tune the batch size and flush deadline from the observed arrival
+    rate and insert latency.
+
+    The flush deadline is twice the time a batch insert takes, divided
+    over the in-flight writer slots, so that the writers are kept at no
+    more than about half of their capacity. Under light load inserts are
+    fast, and rows are written soon after they arrive. The batch size is
+    the number of records expected to arrive within one deadline, so
+    that under heavy load fewer, larger batches are written.
+
+    Both are kept within the MIN_/MAX_ BATCH_SIZE and BATCH_AGE_SECONDS
+    bounds. The arrival rate and latency are smoothed with an EWMA."""
+    ALPHA = 0.2
+    # Minimum time between arrival-rate samples.
+    RATE_INTERVAL = 0.25
+
+    def __init__(self, max_inflight: int):
+        self.max_inflight = max_inflight
+        self.arrival_rate = 0.0
+        self.insert_latency = 0.0
+        self.arrivals = 0
+        self.rate_started = None
+        self._batch_size = settings.CONFIG.min_batch_size
+        self._flush_age = settings.CONFIG.min_batch_age_seconds
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    @property
+    def flush_age(self) -> float:
+        return self._flush_age
+
+    def observe_arrivals(self, n: int, now: float):
+        if self.rate_started is None:
+            self.rate_started = now
+        self.arrivals += n
+        elapsed = now - self.rate_started
+        if elapsed < self.RATE_INTERVAL:
+            return
+        self.arrival_rate = ewma(self.arrival_rate, self.arrivals / elapsed,
+                                 self.ALPHA)
+        self.arrivals = 0
+        self.rate_started = now
+        self.update()
+
+    def observe_insert(self, size: int, seconds: float):
+        self.insert_latency = ewma(self.insert_latency, seconds, self.ALPHA)
+        self.update()
+
+    def on_config(self, old, new):
+        # The bounds may have changed.
+        self.update()
+
+    def update(self):
+        old = self._batch_size, self._flush_age
+        config = settings.CONFIG
+        self._flush_age = clamp(
+            2 * self.insert_latency / self.max_inflight,
+            config.min_batch_age_seconds, config.max_batch_age_seconds
+        )
+        self._batch_size = int(clamp(
+            self.arrival_rate * self._flush_age,
+            config.min_batch_size, config.max_batch_size
+        ))
+        if (self._batch_size, self._flush_age) != old:
+            logger.debug('Adaptive batching: %s', self.snapshot())
+
+    def snapshot(self) -> Dict:
+        return dict(adaptive=True, batch_size=self._batch_size,
+                    flush_age=self._flush_age, arrival_rate=self.arrival_rate,
+                    insert_latency=self.insert_latency)
+
+
+def ewma(current: float, sample: float, alpha: float) -> float:
+    if not current:
+        return sample
+    return alpha * sample + (1 - alpha) * current
+
+
+def clamp(value, lower, upper):
+    return max(lower, min(upper, value))
+
+
+# The policy used by the running `collect`, for inspection.
+BATCHING: BatchingPolicy = None
+
+
+# Outcomes of `write_and_clear`.
+COMMITTED = 'committed'
+SPILLED = 'spilled'
+FAILED = 'failed'
 
 
 @aiodec.astopwatch(message_template='Inserting $size records took $time_ sec')
-async def write_and_clear(records: List, size: int):
+async def write_and_clear(records: List, size: int) -> str:
+    """Write the records to the sink, or else to the spill log. The
+    records are cleared unless the outcome is FAILED."""
     try:
-        pool = get_db_pool()
-        async with pool.acquire() as conn:  # type: Connection
-            # TODO: keep track of https://github.com/MagicStack/asyncpg/pull/295
-            # TODO: `executemany` performance is being optimized.
-            logger.debug(f'Writing records to DB: {records}')
-            await conn.executemany('INSERT INTO logs VALUES ($1, $2, $3, $4)',
-                                   records)
+        await sinks.get_sink().write(records, record_columns())
     except Exception as e:
-        logger.exception('Error while writing records. The pending record '
-                         'set will not be cleared.')
-    else:
-        records.clear()
+        metrics.DB_ERRORS.inc()
+        spill_log = spill.get_spill()
+        if spill_log and spill_log.append_records(records, record_columns()):
+            logger.exception('Error while writing records. %d records were '
+                             'spilled to disk.', len(records))
+            metrics.BATCHES_SPILLED.inc()
+            metrics.RECORDS_SPILLED.inc(len(records))
+            records.clear()
+            return SPILLED
+        logger.exception('Error while writing records. The pending '
+                         'record set will not be cleared.')
+        return FAILED
+    records.clear()
+    return COMMITTED
+
+
+async def drain_spill():
+    """Long-running task that moves spilled data back into the database.
+
+    Closed segments are written oldest first, each one inside a single
+    transaction, and only deleted after the commit. This also replays
+    any segments left behind by a previous run. A segment that cannot
+    be decoded, or that the database rejects, is set aside, see
+    `SpillLog.quarantine`, rather than holding up the ones after it.
+    Other errors, such as losing the connection, stop the round, and
+    the segment is tried again in the next one."""
+    spill_log = spill.get_spill()
+    try:
+        while True:
+            if not spill_log.closed_segments():
+                # Nothing waiting: make whatever is in the active
+                # segment available for the next round.
+                spill_log.rotate()
+            for path in spill_log.closed_segments():
+                try:
+                    batches, others = read_spilled(path)
+                except Exception:
+                    logger.exception('Could not decode spill segment %s. '
+                                     'Setting it aside.', path)
+                    spill_log.quarantine(path)
+                    continue
+                try:
+                    n = await write_segment(path, batches, others)
+                except Exception as e:
+                    if is_rejected(e):
+                        logger.exception('Spill segment %s was rejected. '
+                                         'Setting it aside.', path)
+                        spill_log.quarantine(path)
+                        continue
+                    logger.exception('Could not drain spill segment %s. '
+                                     'Will try again later.', path)
+                    break
+                spill_log.remove(path)
+                logger.info('Drained %d records from spill segment %s',
+                            n, path)
+            await asyncio.sleep(settings.SPILL_DRAIN_INTERVAL_SECONDS())
+    except asyncio.CancelledError:
+        spill.close_spill()
+
+
+def is_rejected(e: Exception) -> bool:
+    """Whether writing the same data again would fail in the same way:
+    the server refused the data itself, or it could not be encoded.
+    Errors of the connection, or of the server's current state, may
+    pass."""
+    if isinstance(e, (asyncpg.PostgresConnectionError,
+                      asyncpg.OperatorInterventionError,
+                      asyncpg.InsufficientResourcesError,
+                      asyncpg.TransactionRollbackError)):
+        return False
+    # asyncpg raises a ValueError when a value cannot be encoded.
+    return isinstance(e, (asyncpg.PostgresError, ValueError, TypeError))
+
 
+def read_spilled(path) -> Tuple[Dict[Tuple, List], Dict[str, List]]:
+    """The log records of a segment, by their columns, and the other
+    records by their type."""
+    batches: Dict[Tuple, List] = {}
+    others: Dict[str, List] = {}
+    for kind, payload in spill.read_segment(path):
+        if kind == spill.KIND_RECORDS:
+            columns, records = spill.decode_records(payload)
+            batches.setdefault(tuple(columns), []).extend(records)
+        elif kind in spill.MESSAGE_KINDS:
+            # A message may hold a batch of records.
+            msg = spill.decode_message(payload, kind)
+            records, _, routed_records = decode_chunk([msg.message],
+                                                      [msg.content_type])
+            batches.setdefault(record_columns(), []).extend(records)
+            for record_type, records in routed_records.items():
+                others.setdefault(record_type, []).extend(records)
+        else:
+            raise ValueError(f'Unknown kind of spill entry: {kind!r}')
+    return batches, others
 
-def extract_safe(d, key, constructor=lambda x: x):
-    if key not in d:
-        return None
 
-    return constructor(d.pop(key))
+async def write_segment(path, batches: Dict[Tuple, List],
+                        others: Dict[str, List]) -> int:
+    # Spans are only inserted once, and a context only replaces an older
+    # one, so these can be written again when the logs cannot be written
+    # and the whole segment is tried again later. Metric rows would be
+    # duplicated, so they go last, and only once.
+    postgres = 'postgres' in sinks.sink_names()
+    samples = others.pop(RECORD_TYPE_METRIC, None)
+    if others and postgres:
+        await routed.write_routed(others)
+    await sinks.get_sink().write_many(batches)
+    if samples and postgres:
+        try:
+            await routed.write_routed({RECORD_TYPE_METRIC: samples})
+        except Exception:
+            logger.exception('Dropping %d metric samples from spill segment '
+                             '%s', len(samples), path)
+            metrics.ROUTED_RECORDS_DROPPED.inc(len(samples),
+                                               table=RECORD_TYPE_METRIC)
+    return sum(len(records) for records in batches.values())
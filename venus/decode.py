@@ -0,0 +1,408 @@
+"""
+Turning raw messages into record tuples that are ready to insert.
+
+This is pure CPU work with no asyncio or DB dependencies, so that it
+can run either inline in `venus.db.write.collect` or in a process pool
+(see ``DECODE_WORKERS``).
+"""
+import functools
+import itertools
+import logging
+import math
+import struct
+import sys
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from . import codec
+from . import settings
+from .compression import compression_of, decompress
+from .models import Message
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Column order of the record tuples, before the promoted fields, see
+# `record_columns`.
+LOG_COLUMNS = ('time', 'message', 'correlation_id', 'data')
+
+# A record may be something other than a log record, according to its
+# ``record_type`` field. These are returned separately by `decode_chunk`,
+# as tuples with these columns. Any other ``record_type`` is just a field
+# of a log record.
+RECORD_TYPE_LOG = 'log'
+RECORD_TYPE_SPAN = 'span'
+RECORD_TYPE_CONTEXT = 'context'
+RECORD_TYPE_METRIC = 'metric'
+ROUTED_RECORD_TYPES = (RECORD_TYPE_SPAN, RECORD_TYPE_CONTEXT, RECORD_TYPE_METRIC)
+SPAN_COLUMNS = ('span_id', 'correlation_id', 'description', 'time_start',
+                'time_end')
+CONTEXT_COLUMNS = ('correlation_id', 'data', 'updated')
+# Metric samples are aggregated before anything is written, see
+# `venus.aggregation`.
+METRIC_SAMPLE_COLUMNS = ('created', 'name', 'tags', 'value')
+
+# Tags, as sorted (key, value) pairs, so that they can be part of a key.
+Tags = Tuple[Tuple[str, str], ...]
+
+# Start of a message body that holds a batch of records, see `split_batch`.
+BATCH_MAGIC = b'VNB1'
+BATCH_LENGTH = struct.Struct('!I')
+
+# Values of the optional content-type frame. Without the frame, records
+# are JSON. For a batch envelope, this is the type of the records in it.
+CONTENT_TYPE_JSON = b'application/json'
+CONTENT_TYPE_MSGPACK = b'application/msgpack'
+
+
+def as_smallint(value) -> int:
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(f'Not an integer: {value!r}')
+    if not -32768 <= value <= 32767:
+        raise ValueError(f'Out of range for SMALLINT: {value}')
+    return value
+
+
+def as_text(value) -> str:
+    # msgpack may give bytes, for a bin value.
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode('utf-8', errors='replace')
+    if not isinstance(value, str):
+        raise TypeError(f'Not a string: {value!r}')
+    # Postgres TEXT cannot hold NUL characters; JSONB escapes them.
+    if '\x00' in value:
+        raise ValueError('Contains a NUL character')
+    return value
+
+
+def as_uuid(value) -> UUID:
+    # UUID() fails with AttributeError on anything but a string.
+    if not isinstance(value, str):
+        raise TypeError(f'Not a string: {value!r}')
+    return UUID(value)
+
+
+# The record fields that may be promoted to typed columns of ``logs``,
+# with the conversion of each. These columns are added by a migration;
+# ``PROMOTED_FIELDS`` chooses which of them are filled in.
+PROMOTABLE_FIELDS: Dict[str, Callable[[Any], Any]] = {
+    'levelno': as_smallint,
+    'name': as_text,
+    'pathname': as_text,
+    'hostname': as_text,
+    'app': as_text,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def promoted_fields() -> Tuple[Tuple[str, Callable[[Any], Any]], ...]:
+    """The promoted fields and their conversions, from
+    ``PROMOTED_FIELDS``. This is read once, because it fixes the shape
+    of the record tuples."""
+    fields = []
+    for name in settings.PROMOTED_FIELDS():
+        if name not in PROMOTABLE_FIELDS:
+            raise ValueError(
+                f'Cannot promote {name!r}, only: {", ".join(PROMOTABLE_FIELDS)}')
+        if name not in dict(fields):
+            fields.append((name, PROMOTABLE_FIELDS[name]))
+    return tuple(fields)
+
+
+def record_columns() -> Tuple[str, ...]:
+    """Column order of the record tuples: `LOG_COLUMNS`, then the
+    promoted fields."""
+    return LOG_COLUMNS + tuple(name for name, _ in promoted_fields())
+
+
+def decode_message(msg: Message) -> Optional[Tuple]:
+    return decode_payload(msg.message, content_type=msg.content_type)
+
+
+def decode_payload(payload: bytes, stats: Counter = None,
+                   content_type: bytes = b'') -> Optional[Tuple]:
+    """Turn a raw message into a record tuple, ordered as `record_columns`.
+    The payload may be compressed, see `venus.compression`, but must
+    hold a single log record. Returns None if the message cannot be
+    used. The reason is counted in ``stats``, if given."""
+    stats = Counter() if stats is None else stats
+    bodies = unpack(payload, stats)
+    if len(bodies) != 1:
+        return None
+    return decode_record(bodies[0], stats, content_type)
+
+
+def unpack(payload: bytes, stats: Counter) -> Sequence[bytes]:
+    """Decompress a message body, and split it into the JSON records it
+    holds: one, or many if it is a batch envelope. The records of a
+    batch are memoryviews into the payload, not copies."""
+    method = compression_of(payload)
+    if method:
+        try:
+            payload = decompress(payload, method)
+        except ValueError:
+            logger.exception('Could not decompress a message')
+            stats['decode_failures'] += 1
+            return ()
+        stats['compressed'] += 1
+
+    if payload[:len(BATCH_MAGIC)] != BATCH_MAGIC:
+        return (payload,)
+
+    bodies = split_batch(payload)
+    stats['batches'] += 1
+    stats['batched_records'] += len(bodies)
+    return bodies
+
+
+def split_batch(payload: bytes) -> List[memoryview]:
+    """The envelope is ``BATCH_MAGIC``, followed by each record as a
+    4-byte big-endian length and that many bytes of JSON. A truncated
+    record at the end is dropped and logged."""
+    view = memoryview(payload)
+    end = len(view)
+    i = len(BATCH_MAGIC)
+    bodies = []
+    while i < end:
+        if i + BATCH_LENGTH.size > end:
+            break
+        (size,) = BATCH_LENGTH.unpack_from(view, i)
+        i += BATCH_LENGTH.size
+        if i + size > end:
+            break
+        bodies.append(view[i:i + size])
+        i += size
+    else:
+        return bodies
+
+    logger.error('Batch envelope is truncated after %d records', len(bodies))
+    return bodies
+
+
+def envelope_records(payload: bytes) -> Optional[int]:
+    """The number of records in a message body, found without copying
+    it, or None if it is compressed."""
+    if compression_of(payload):
+        return None
+    if payload[:len(BATCH_MAGIC)] != BATCH_MAGIC:
+        return 1
+    n = 0
+    i = len(BATCH_MAGIC)
+    while i + BATCH_LENGTH.size <= len(payload):
+        (size,) = BATCH_LENGTH.unpack_from(payload, i)
+        i += BATCH_LENGTH.size + size
+        n += 1
+    return n
+
+
+def encode_batch(bodies: Iterable[bytes]) -> bytes:
+    """The inverse of `split_batch`. Used by senders (and tests)."""
+    parts = [BATCH_MAGIC]
+    for body in bodies:
+        parts.append(BATCH_LENGTH.pack(len(body)))
+        parts.append(body)
+    return b''.join(parts)
+
+
+def decode_record(body: bytes, stats: Counter, content_type: bytes = b'',
+                  routed: Dict[str, List[Tuple]] = None) -> Optional[Tuple]:
+    """Decode a single JSON or msgpack record, see `decode_payload`.
+    Records that are not log records go into ``routed``, by their
+    ``record_type``, and None is returned."""
+    try:
+        d = load_body(body, content_type)
+        record_type = d.get('record_type', RECORD_TYPE_LOG)
+        # Only the routed types are taken out. Any other value, even an
+        # unhashable one such as a list, leaves this a log record, with
+        # ``record_type`` kept as a field.
+        if record_type in ROUTED_RECORD_TYPES:
+            del d['record_type']
+            record = decode_routed(record_type, d)
+        else:
+            record_type = RECORD_TYPE_LOG
+    except (ValueError, TypeError, KeyError):
+        logger.exception(f'Decoding failed on: {bytes(body)}')
+        stats['decode_failures'] += 1
+        return None
+
+    if record_type != RECORD_TYPE_LOG:
+        if routed is not None:
+            routed.setdefault(record_type, []).append(record)
+        return None
+
+    # The received JSON will be saved into the DB, but we extract
+    # a few fields that will be used often in queries.
+    # TODO: currently the DB type is TIMESTAMPTZ. Might need TIMESTAMP
+    try:
+        time = extract_safe(d, 'created', datetime.fromtimestamp)
+        correlation_id = extract_safe(d, 'correlation_id', as_uuid)
+        message = d.get('message')
+        if message is not None:
+            message = as_text(message)
+    except (TypeError, ValueError, OverflowError, OSError):
+        # E.g. a "created" that is not a number, or out of range, a
+        # "correlation_id" that is not a UUID string, or a "message"
+        # that cannot go in a TEXT column.
+        logger.exception(f'Decoding failed on: {bytes(body)}')
+        stats['decode_failures'] += 1
+        return None
+    if not time:
+        logger.info('Message does not have a "created" field. Dropping.')
+        stats['missing_created'] += 1
+        return None
+
+    d.pop('message', None)
+    promoted = tuple(promote(d, name, convert)
+                     for name, convert in promoted_fields())
+
+    # Besides the ones extracted above, we also remove a few more
+    # that we don't care about.
+    remove_unwanted_keys(d)
+    try:
+        data = codec.dumps(d)
+    except TypeError:
+        # Only possible for msgpack, e.g., binary values.
+        logger.exception('Record cannot be stored as JSON')
+        stats['decode_failures'] += 1
+        return None
+
+    return (time, message, correlation_id, data) + promoted
+
+
+def decode_routed(record_type: str, d: Dict) -> Tuple:
+    """Raises ValueError, TypeError or KeyError for an invalid record.
+
+    A span has ``span_id``, ``correlation_id``, ``description``, and
+    ``time_start`` and ``time_end`` as seconds since the epoch, like
+    ``created``. A context has ``correlation_id``, the ``context``
+    itself, a mapping, and optionally ``created``. A metric sample has
+    ``created``, ``name``, a numeric ``value``, and optionally ``tags``,
+    a mapping."""
+    if record_type == RECORD_TYPE_SPAN:
+        description = d.get('description')
+        return (
+            as_uuid(d['span_id']),
+            extract_safe(d, 'correlation_id', as_uuid),
+            None if description is None else as_text(description),
+            datetime.fromtimestamp(sample_time(d['time_start'])),
+            datetime.fromtimestamp(sample_time(d['time_end'])),
+        )
+    if record_type == RECORD_TYPE_CONTEXT:
+        if not isinstance(d['context'], dict):
+            raise TypeError('The context must be a mapping')
+        updated = None
+        if d.get('created') is not None:
+            updated = datetime.fromtimestamp(sample_time(d['created']))
+        return as_uuid(d['correlation_id']), codec.dumps(d['context']), updated
+    if record_type == RECORD_TYPE_METRIC:
+        return (sample_time(d['created']), str(d['name']),
+                sample_tags(d.get('tags')), sample_value(d['value']))
+    raise ValueError(f'Unknown record type: {record_type}')
+
+
+def sample_tags(tags) -> Tags:
+    """Tag values that are not strings are made strings."""
+    if tags is None:
+        return ()
+    if not isinstance(tags, dict):
+        raise TypeError('The tags must be a mapping')
+    return tuple(sorted((str(k), str(v)) for k, v in tags.items()))
+
+
+def sample_value(value) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f'Not a number: {value!r}')
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f'Not a finite number: {value}')
+    return value
+
+
+def sample_time(created) -> float:
+    created = sample_value(created)
+    try:
+        # The window of the sample is written as a timestamp.
+        datetime.fromtimestamp(created)
+    except (OverflowError, OSError) as e:
+        raise ValueError(f'Not a valid time: {created}') from e
+    return created
+
+
+def load_body(body: bytes, content_type: bytes = b'') -> Dict:
+    """Parse a record according to its content type. Raises ValueError
+    if that is not possible, or if the record is not a mapping."""
+    if not content_type or content_type == CONTENT_TYPE_JSON:
+        d = codec.loads(body)
+    elif content_type == CONTENT_TYPE_MSGPACK:
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        try:
+            d = msgpack.unpackb(body, raw=False, strict_map_key=False)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f'Invalid msgpack: {e}') from e
+    else:
+        raise ValueError(f'Unknown content type: {content_type}')
+
+    if not isinstance(d, dict):
+        raise ValueError(f'Record is a {type(d).__name__}, not a mapping')
+    return d
+
+
+def decode_chunk(payloads: List[bytes], content_types: Sequence[bytes] = None
+                 ) -> Tuple[List[Tuple], Counter, Dict[str, List[Tuple]]]:
+    """Decode a chunk of raw message bodies, keeping their order.
+    ``content_types``, if given, has the content type of each payload.
+    This is the unit of work sent to the decode process pool. Returns
+    the log records, the counts of the messages that were dropped, and
+    the other records by their type."""
+    records = []
+    stats = Counter()
+    routed = {}
+    if content_types is None:
+        content_types = itertools.repeat(b'')
+    for payload, content_type in zip(payloads, content_types):
+        for body in unpack(payload, stats):
+            record = decode_record(body, stats, content_type, routed)
+            if record is not None:
+                records.append(record)
+    return records, stats, routed
+
+
+def init_worker():
+    """Initializer for the decode process pool."""
+    logging.basicConfig(level=settings.START_LOG_LEVEL, stream=sys.stdout)
+
+
+def remove_unwanted_keys(data: Dict):
+    for key in settings.CONFIG.drop_fields:
+        data.pop(key, None)
+
+
+def promote(d: Dict, key: str, convert: Callable[[Any], Any]):
+    """Like `extract_safe`, but a value that cannot be converted for its
+    column is left in ``d``, so that it is still kept in ``data``."""
+    value = d.get(key)
+    if value is None:
+        d.pop(key, None)
+        return None
+    try:
+        value = convert(value)
+    except (TypeError, ValueError):
+        return None
+    del d[key]
+    return value
+
+
+def extract_safe(d, key, constructor=lambda x: x):
+    if key not in d:
+        return None
+
+    return constructor(d.pop(key))
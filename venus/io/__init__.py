@@ -3,11 +3,16 @@ import asyncio
 import zmq
 
 from contextlib import contextmanager
-from typing import List
+from typing import List, Optional, Tuple
 from zmq.asyncio import Context, Socket
 
+from .. import metrics
 from .. import settings
+from .. import tracing
 from .. import models
+from ..db import spill
+from ..decode import envelope_records
+from .shedding import LevelShedder
 
 """
 ZMQ socket options:
@@ -63,10 +68,13 @@ def apply_tcp_sock_options(sock: Socket):
     sock.setsockopt(zmq.LINGER, 1)
 
 
-async def zmq_connection_manager(pull_queue: asyncio.Queue):
+async def zmq_connection_manager(pull_queue: asyncio.Queue,
+                                 address: str = None, bind: bool = True,
+                                 high_queue: asyncio.Queue = None):
     loop = asyncio.get_event_loop()
     logger.debug('Starting pull socket')
-    pull_task = loop.create_task(pull_sock(pull_queue))
+    pull_task = loop.create_task(
+        pull_sock(pull_queue, address, bind, high_queue))
 
     try:
         await pull_task
@@ -75,34 +83,133 @@ async def zmq_connection_manager(pull_queue: asyncio.Queue):
                     "shutdown time.")
 
 
-async def pull_sock(q: asyncio.Queue) -> None:
+class MessageQueue(asyncio.Queue):
+    """A queue whose size is counted in messages rather than items. An
+    item may be a single `models.Message` or a list of them, so the
+    ``maxsize`` bound holds either way (a list may overshoot it by its
+    own length)."""
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.depth = 0
+
+    def _put(self, item):
+        super()._put(item)
+        self.depth += len(item) if isinstance(item, list) else 1
+
+    def _get(self):
+        item = super()._get()
+        self.depth -= len(item) if isinstance(item, list) else 1
+        return item
+
+    def qsize(self) -> int:
+        return self.depth
+
+
+def make_high_priority_queue() -> Optional[MessageQueue]:
+    """Returns None if there are no ``HIGH_PRIORITY_LEVELS``."""
+    if not settings.HIGH_PRIORITY_LEVELS():
+        return None
+    q = MessageQueue(maxsize=settings.HIGH_PRIORITY_QUEUE_SIZE())
+    metrics.HIGH_PRIORITY_QUEUE_DEPTH.set_function(q.qsize)
+    return q
+
+
+async def pull_sock(q: asyncio.Queue, address: str = None,
+                    bind: bool = True, high_q: asyncio.Queue = None) -> None:
     """This routine exists for one purpose only, and that is to place
-    incoming IO messages onto the given queue."""
+    incoming IO messages onto the given queue.
+
+    By default the socket binds to ``VENUS_PORT``. Ingest workers
+    instead connect to the address of the front-end device.
+
+    After each wakeup, up to ``RECV_DRAIN_MAX`` messages that are
+    already waiting on the socket are received without blocking, and
+    the whole list is placed on the queue as a single item. With
+    ``RECV_DRAIN_MAX=1``, messages are queued one at a time.
+
+    If ``high_q`` is given, messages of the ``HIGH_PRIORITY_LEVELS`` go
+    there instead. As the (normal) queue fills up, DEBUG and INFO
+    messages are shed, see `venus.io.shedding`."""
     sock: Socket = CONTEXT.socket(zmq.PULL)
     apply_tcp_sock_options(sock)
-    logger.info(f'Venus binding on port {settings.VENUS_PORT()}')
-    sock.bind(f'tcp://*:{settings.VENUS_PORT():d}')
+    if address is None:
+        address = f'tcp://*:{settings.VENUS_PORT():d}'
+    if bind:
+        logger.info(f'Venus binding on {address}')
+        sock.bind(address)
+    else:
+        logger.info(f'Venus connecting to {address}')
+        sock.connect(address)
+    drain_max = settings.RECV_DRAIN_MAX()
+    sampler = tracing.make_sampler()
+    shedder = LevelShedder(q.maxsize)
 
     try:
         logger.debug('Waiting for data on pull socket')
         while True:
-            raw: List[bytes] = await sock.recv_multipart()
-            logger.debug(f'Received a message! {raw}')
-            try:
-                msg = models.Message(*raw)
-            except TypeError:
-                logger.exception(f'Unexpected message received: {raw}')
-                continue
-
-            # Cannot block on the queue. Backpressure cannot be
-            # applied for this application, because the source of
-            # the data is application logging and that cannot be
-            # slowed down. We have to drop, thus, use the nowait
-            # version.
-            try:
-                q.put_nowait(msg)
-            except asyncio.QueueFull:
-                logger.error(f'Receive queue full. Dropping message: {msg}')
+            raws: List[List[bytes]] = [await sock.recv_multipart()]
+            while len(raws) < drain_max:
+                try:
+                    raws.append(await sock.recv_multipart(flags=zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+
+            metrics.MESSAGES_RECEIVED.inc(len(raws))
+            msgs = []
+            for raw in raws:
+                try:
+                    msgs.append(models.Message(*raw))
+                except TypeError:
+                    logger.exception(f'Unexpected message received: {raw}')
+
+            if high_q is not None:
+                high, msgs = split_priority(msgs)
+                if high:
+                    enqueue(high_q, high, drain_max, sampler)
+
+            msgs = shedder.admit(msgs, q.qsize())
+            if msgs:
+                enqueue(q, msgs, drain_max, sampler)
     finally:
         logger.info('Closing push sock')
         sock.close(1)
+
+
+def split_priority(msgs: List[models.Message]
+                   ) -> Tuple[List[models.Message], List[models.Message]]:
+    """The messages for the high-priority lane, and the others. A batch
+    envelope is tagged with the highest level in it, so only small ones
+    go to the high-priority lane; a large one, which is mostly lower
+    levels, would crowd out the records that the lane is for."""
+    high_levels = settings.CONFIG.high_priority_levels
+    max_records = settings.CONFIG.high_priority_max_envelope_records
+    high, normal = [], []
+    for m in msgs:
+        n = envelope_records(m.message) if m.level in high_levels else None
+        if n is not None and n <= max_records:
+            high.append(m)
+        else:
+            normal.append(m)
+    return high, normal
+
+
+def enqueue(q: asyncio.Queue, msgs: List[models.Message], drain_max: int,
+            sampler: tracing.Sampler = None):
+    if sampler:
+        sampler.sample(msgs)
+
+    # Cannot block on the queue. Backpressure cannot be
+    # applied for this application, because the source of
+    # the data is application logging and that cannot be
+    # slowed down. We have to drop, thus, use the nowait
+    # version.
+    try:
+        q.put_nowait(msgs if drain_max > 1 else msgs[0])
+    except asyncio.QueueFull:
+        spill_log = spill.get_spill()
+        for msg in msgs:
+            if spill_log and spill_log.append_message(msg):
+                metrics.MESSAGES_SPILLED.inc()
+                continue
+            metrics.MESSAGES_DROPPED.inc()
+            logger.error(f'Receive queue full. Dropping message: {msg}')
@@ -0,0 +1,66 @@
+"""
+Level-aware load shedding on the receive side.
+
+Only the ``level`` frame of each message is looked at, so nothing has
+to be decoded. As the receive queue fills past ``SHED_DEBUG_WATERMARK``,
+the share of DEBUG messages that is admitted falls linearly from all of
+them to none at a full queue; likewise INFO past ``SHED_INFO_WATERMARK``.
+WARNING and above, and any other levels, are always admitted, so the
+space that is left in the queue goes to them.
+
+Which messages are kept is deterministic: every message of a level
+adds the current keep ratio to a credit, and is admitted when the
+credit reaches one.
+"""
+from typing import Dict, List
+
+from .. import metrics
+from .. import settings
+from ..models import Message
+
+DEBUG = b'DEBUG'
+INFO = b'INFO'
+
+
+class LevelShedder:
+    def __init__(self, maxsize: int):
+        # A queue with no bound never sheds.
+        self.maxsize = maxsize
+        self.credit: Dict[bytes, float] = {DEBUG: 0.0, INFO: 0.0}
+
+    def keep_ratio(self, depth: int, watermark: float) -> float:
+        start = watermark * self.maxsize
+        if depth < start:
+            return 1.0
+        return max(0.0, (self.maxsize - depth) / max(1.0, self.maxsize - start))
+
+    def admit(self, msgs: List[Message], depth: int) -> List[Message]:
+        """Returns the messages to queue, given the current queue depth."""
+        config = settings.CONFIG
+        lowest = min(config.shed_debug_watermark, config.shed_info_watermark)
+        if not self.maxsize or depth < lowest * self.maxsize:
+            return msgs
+
+        ratios = {
+            DEBUG: self.keep_ratio(depth, config.shed_debug_watermark),
+            INFO: self.keep_ratio(depth, config.shed_info_watermark),
+        }
+        admitted = []
+        shed = dict.fromkeys(ratios, 0)
+        for msg in msgs:
+            ratio = ratios.get(msg.level, 1.0)
+            if ratio >= 1.0:
+                admitted.append(msg)
+                continue
+            credit = self.credit[msg.level] + ratio
+            if credit >= 1.0:
+                credit -= 1.0
+                admitted.append(msg)
+            else:
+                shed[msg.level] += 1
+            self.credit[msg.level] = credit
+
+        for level, n in shed.items():
+            if n:
+                metrics.MESSAGES_SHED.inc(n, level=level.decode())
+        return admitted
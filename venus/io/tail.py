@@ -0,0 +1,251 @@
+"""
+Live tail: the decoded records are republished on a ZMQ socket, so that
+new logs can be watched without querying the database.
+
+With ``TAIL_PORT`` set, each record is sent as ``[topic, json]`` once
+for each of these topics:
+
+- ``lvl:<LEVELNAME>:<logger name>``, e.g. ``lvl:ERROR:app.db``
+- ``cid:<correlation_id>``, if the record has one
+
+Clients use a SUB socket, and subscribe to topic prefixes, e.g.
+``lvl:ERROR:`` for all errors, or ``cid:5c0a...`` for one request. The
+level and logger name come from the promoted ``levelno`` and ``name``
+columns, see ``PROMOTED_FIELDS``; without them, both are ``-``.
+
+The socket is an XPUB, so venus knows which prefixes are subscribed,
+and does not even encode the records that nobody is waiting for.
+Sending never blocks: a subscriber that does not keep up loses messages
+once ``TAIL_SNDHWM`` are queued for it.
+
+With ``INGEST_WORKERS``, each worker connects its socket to a proxy in
+the main process, which binds ``TAIL_PORT``.
+
+``venus tail`` is a client that prints the records as they arrive.
+"""
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import zmq
+import zmq.devices
+
+from .. import metrics
+from .. import settings
+from ..sinks import ndjson_line
+
+logger = logging.getLogger(__name__)
+
+LEVEL_PREFIX = b'lvl:'
+CORRELATION_PREFIX = b'cid:'
+# Subscription messages received by an XPUB socket.
+SUBSCRIBE = b'\x01'
+UNSUBSCRIBE = b'\x00'
+
+
+def tail_address() -> str:
+    """The address of the proxy in the main process, for the workers."""
+    path = Path(settings.WORKER_IPC_DIR()) / f'venus-{os.getpid()}-tail.ipc'
+    return f'ipc://{path}'
+
+
+def level_topic(levelno: Optional[int], name: Optional[str]) -> bytes:
+    levelname = logging.getLevelName(levelno) if levelno is not None else '-'
+    return b'%s%s:%s' % (LEVEL_PREFIX, levelname.encode(),
+                         (name or '-').encode())
+
+
+class Publisher:
+    def __init__(self, sock: zmq.Socket, columns: Sequence[str]):
+        self.sock = sock
+        self.columns = columns
+        self.levelno_index = columns.index('levelno') if 'levelno' in columns else None
+        self.name_index = columns.index('name') if 'name' in columns else None
+        self.correlation_index = columns.index('correlation_id')
+        # The subscribed prefixes.
+        self.prefixes: Set[bytes] = set()
+
+    def update_subscriptions(self):
+        while True:
+            try:
+                event = self.sock.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if event[:1] == SUBSCRIBE:
+                self.prefixes.add(event[1:])
+            elif event[:1] == UNSUBSCRIBE:
+                self.prefixes.discard(event[1:])
+
+    def wanted(self, topic: bytes) -> bool:
+        return any(topic.startswith(prefix) for prefix in self.prefixes)
+
+    def topics(self, record: Tuple) -> List[bytes]:
+        levelno = record[self.levelno_index] if self.levelno_index is not None else None
+        name = record[self.name_index] if self.name_index is not None else None
+        topics = [level_topic(levelno, name)]
+        correlation_id = record[self.correlation_index]
+        if correlation_id is not None:
+            topics.append(CORRELATION_PREFIX + str(correlation_id).encode())
+        return topics
+
+    def publish(self, records: List[Tuple]):
+        self.update_subscriptions()
+        if not self.prefixes:
+            return
+
+        n = 0
+        for record in records:
+            body = None
+            for topic in self.topics(record):
+                if not self.wanted(topic):
+                    continue
+                if body is None:
+                    body = ndjson_line(self.columns, record)
+                try:
+                    self.sock.send_multipart([topic, body], flags=zmq.NOBLOCK)
+                except zmq.Again:  # pragma: no cover
+                    pass
+                n += 1
+        metrics.TAIL_MESSAGES_PUBLISHED.inc(n)
+
+    def close(self):
+        self.sock.close(0)
+
+
+PUBLISHER: Optional[Publisher] = None
+
+
+def open_publisher(columns: Sequence[str], address: str = None):
+    """Bind ``TAIL_PORT``, or connect to the proxy at ``address``. Does
+    nothing if ``TAIL_PORT`` is 0."""
+    global PUBLISHER
+    from . import CONTEXT
+
+    if not settings.TAIL_PORT():
+        return
+    # A plain socket, not an asyncio one, since it is only ever used
+    # without blocking.
+    sock = zmq.Context.shadow(CONTEXT.underlying).socket(zmq.XPUB)
+    sock.setsockopt(zmq.SNDHWM, settings.TAIL_SNDHWM())
+    sock.setsockopt(zmq.LINGER, 0)
+    if address:
+        sock.connect(address)
+    else:
+        address = f'tcp://{settings.TAIL_HOST()}:{settings.TAIL_PORT():d}'
+        logger.info(f'Live tail publishing on {address}')
+        sock.bind(address)
+    PUBLISHER = Publisher(sock, tuple(columns))
+
+
+def get_publisher() -> Optional[Publisher]:
+    return PUBLISHER
+
+
+def close_publisher():
+    global PUBLISHER
+    if PUBLISHER:
+        PUBLISHER.close()
+        PUBLISHER = None
+
+
+def start_proxy(address: str) -> Optional[zmq.devices.ThreadDevice]:
+    """Forward from the workers, which connect to ``address``, to the
+    subscribers on ``TAIL_PORT``. Subscriptions go the other way."""
+    if not settings.TAIL_PORT():
+        return None
+    device = zmq.devices.ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
+    device.bind_in(address)
+    device.bind_out(f'tcp://{settings.TAIL_HOST()}:{settings.TAIL_PORT():d}')
+    device.setsockopt_out(zmq.SNDHWM, settings.TAIL_SNDHWM())
+    device.setsockopt_in(zmq.LINGER, 0)
+    device.setsockopt_out(zmq.LINGER, 0)
+    device.start()
+    logger.info('Live tail forwarding from %s to port %d', address,
+                settings.TAIL_PORT())
+    return device
+
+
+# The level names in topics, for subscribing to a minimum level.
+LEVEL_NAMES = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+def subscriptions(level: str = None, logger_name: str = None,
+                  correlation_id: str = None) -> List[bytes]:
+    """The topic prefixes for the records of ``correlation_id``, or of
+    ``level`` and above from ``logger_name`` (and its children)."""
+    from ..db.query import level_number
+
+    if correlation_id:
+        return [CORRELATION_PREFIX + correlation_id.encode()]
+    if level is None and logger_name is None:
+        return [LEVEL_PREFIX]
+
+    if level is None:
+        names = LEVEL_NAMES + ('-',)
+    else:
+        minimum = level_number(level)
+        names = tuple(n for n in LEVEL_NAMES if level_number(n) >= minimum)
+    suffix = (logger_name or '').encode()
+    return [b'%s%s:%s' % (LEVEL_PREFIX, n.encode(), suffix) for n in names]
+
+
+def format_record(record: Dict) -> str:
+    levelno = record.get('levelno')
+    levelname = logging.getLevelName(levelno) if levelno is not None else '-'
+    return (f'{record["time"]} {levelname:<8} {record.get("name") or "-"}: '
+            f'{record["message"]}')
+
+
+def default_address() -> Optional[str]:
+    """The local venus, according to ``TAIL_PORT``, or None if that
+    does not publish."""
+    port = settings.TAIL_PORT()
+    if not port:
+        return None
+    return f'tcp://localhost:{port:d}'
+
+
+def main(args: argparse.Namespace):
+    address = args.address or default_address()
+    if not address:
+        logger.error('Live tail is disabled, since TAIL_PORT is not set. '
+                     'Set it, or give the --address of a venus that '
+                     'publishes.')
+        return 1
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.SUB)
+    sock.connect(address)
+    for prefix in subscriptions(args.level, args.logger, args.correlation_id):
+        sock.setsockopt(zmq.SUBSCRIBE, prefix)
+
+    try:
+        while True:
+            _, body = sock.recv_multipart()
+            if args.json:
+                print(body.decode(), end='', flush=True)
+            else:
+                print(format_record(json.loads(body)), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close(0)
+        ctx.term()
+    return 0
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser(
+        'tail', help='Print new records as venus receives them.')
+    parser.set_defaults(func=main)
+    parser.add_argument('--address',
+                        help='Where venus publishes. By default, '
+                             'localhost on TAIL_PORT.')
+    parser.add_argument('--level', help='The minimum level.')
+    parser.add_argument('--logger', help='A logger name, or its prefix.')
+    parser.add_argument('--correlation-id',
+                        help='Only the records of this correlation ID.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the records as JSON.')
@@ -12,9 +12,16 @@ import coverage
 coverage.process_startup()
 
 import venus.db.write
+from venus import admin
+from venus import api
 from venus import db
 from venus import io
+from venus import metrics
 from venus import settings
+from venus import workers
+from venus.db import spill
+from venus.decode import record_columns
+from venus.io import tail
 
 logger = logging.getLogger(__name__)
 
@@ -26,30 +33,83 @@ async def amain(args) -> WeakValueDictionary:
     loop = asyncio.get_event_loop()
     tasks_created = WeakValueDictionary()
 
-    tasks_created['db_pool'] = loop.create_task(db.activate())
-
     logger.info('Task: live-loading env vars and logging levels')
     tasks_created['config'] = loop.create_task(settings.refresh_from_configuration())
 
-    # The PULL queue is used to transfer incoming API calls from the
-    # IO layer over to the DB layer.
-    pull_queue = asyncio.Queue(maxsize=65536)
-    tasks_created['zmq'] = loop.create_task(io.zmq_connection_manager(pull_queue))
-    tasks_created['db_writer'] = loop.create_task(venus.db.write.collect(pull_queue))
+    health = lambda: 'ok'
+    n_workers = settings.INGEST_WORKERS()
+    if n_workers > 0:
+        # Receiving, decoding and writing happen in the worker processes.
+        # This process only forwards messages to them.
+        address = workers.worker_address()
+        workers.start_device(address)
+        tail_address = tail.tail_address()
+        tail.start_proxy(tail_address)
+        worker_pool = workers.WorkerPool(n_workers, address, tail_address)
+        worker_pool.start()
+        logger.info(f'Task: supervising {n_workers} ingest workers')
+        tasks_created['workers'] = loop.create_task(workers.supervise(worker_pool))
+        health = worker_pool.health
+        metrics.WORKERS_ALIVE.set_function(
+            lambda: n_workers - len(worker_pool.dead()))
+    else:
+        tasks_created['db_pool'] = loop.create_task(db.activate())
+
+        # Overflow and un-writable batches go to disk instead of being dropped.
+        spill.open_spill()
+        if spill.get_spill():
+            logger.info('Task: draining the spill log')
+            tasks_created['spill'] = loop.create_task(venus.db.write.drain_spill())
+
+        # The PULL queue is used to transfer incoming API calls from the
+        # IO layer over to the DB layer.
+        pull_queue = io.MessageQueue(maxsize=65536)
+        metrics.QUEUE_DEPTH.set_function(pull_queue.qsize)
+        # High-severity messages skip the line.
+        high_queue = io.make_high_priority_queue()
+        tail.open_publisher(record_columns())
+        tasks_created['zmq'] = loop.create_task(
+            io.zmq_connection_manager(pull_queue, high_queue=high_queue))
+        tasks_created['db_writer'] = loop.create_task(
+            venus.db.write.collect(pull_queue, high_queue))
 
     logger.info('Task: starting up health check listener')
     tasks_created['healthcheck'] = loop.create_task(
         aiohealthcheck.tcp_health_endpoint(
             port=settings.HEALTH_CHECK_PORT,
             host=settings.HEALTH_CHECK_HOST,
-            payload=lambda: 'ok'
+            payload=health
         )
     )
 
+    if settings.METRICS_PORT:
+        logger.info('Task: starting up metrics endpoint')
+        tasks_created['metrics'] = loop.create_task(
+            metrics.serve(port=settings.METRICS_PORT, host=settings.METRICS_HOST)
+        )
+
+    if settings.QUERY_PORT:
+        logger.info('Task: starting up the query API')
+        tasks_created['query_api'] = loop.create_task(
+            api.serve(port=settings.QUERY_PORT, host=settings.QUERY_HOST)
+        )
+
     return tasks_created
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zmqport', type=int, default=None)
+    commands = parser.add_subparsers(dest='command')
+    admin.add_parser(commands)
+    tail.add_parser(commands)
+    args, unknown = parser.parse_known_args()
+    if args.command:
+        logging.basicConfig(level='INFO', stream=sys.stdout)
+        if unknown:
+            parser.error(f'unrecognized arguments: {" ".join(unknown)}')
+        return args.func(args)
+
     aiologfields.install()
     # TODO: use kubectl to connect to a running container in DEV
     # and investigate what environment variables are available.
@@ -57,9 +117,6 @@ def main():
     # the k8s pod name, node name, app version, etc.
 
     logging.basicConfig(level='DEBUG', stream=sys.stdout)
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--zmqport', type=int, default=None)
-    args, unknown = parser.parse_known_args()
     if args.zmqport is not None:
         biodome.environ['VENUS_PORT'] = args.zmqport
 
@@ -0,0 +1,291 @@
+"""
+Minimal Prometheus-style metrics for the ingest pipeline.
+
+The metrics are plain module-level objects that the pipeline updates
+in place. `serve` is a long-running task that answers ``GET /metrics``
+with the Prometheus text exposition format. There are no dependencies
+beyond asyncio, in the same spirit as ``aiohealthcheck``.
+
+In worker mode (``INGEST_WORKERS``), every process has its own metrics,
+so each worker serves them on its own port (``WORKER_METRICS_PORT +
+index``) and the main process on ``METRICS_PORT``.
+"""
+import asyncio
+import bisect
+import logging
+import math
+from asyncio import StreamReader, StreamWriter
+from typing import Callable, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+REGISTRY: List['Metric'] = []
+
+# Seconds, from 1 ms to ~1 min.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def format_labels(self, key: Tuple, **extra) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.type}'] + self.samples()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, n: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + n
+
+    def value(self, **labels) -> float:
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        return [f'{self.name}{self.format_labels(k)} {v}'
+                for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    """A gauge is either set directly, or read from a function at
+    scrape time."""
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple, float] = {}
+        self.function: Callable[[], float] = None
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def samples(self):
+        if self.function:
+            try:
+                return [f'{self.name} {self.function()}']
+            except Exception:
+                logger.exception('Could not read gauge %s', self.name)
+                return []
+        return [f'{self.name}{self.format_labels(k)} {v}'
+                for k, v in self.values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [counts per bucket (last is +Inf), sum]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, **labels) -> int:
+        entry = self.values.get(self.key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def quantile(self, q: float, **labels) -> float:
+        """Estimate a quantile by linear interpolation within the
+        bucket that contains it."""
+        entry = self.values.get(self.key(labels))
+        if not entry:
+            return math.nan
+        counts = entry[0]
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, c in enumerate(counts):
+            if c and cumulative + c >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / c
+            cumulative += c
+        return math.nan
+
+    def samples(self):
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets + (math.inf,), counts):
+                cumulative += c
+                le = '+Inf' if bound == math.inf else bound
+                lines.append(f'{self.name}_bucket'
+                             f'{self.format_labels(key, le=le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {cumulative}')
+        return lines
+
+
+MESSAGES_RECEIVED = Counter(
+    'venus_messages_received_total', 'Messages received on the PULL socket.')
+MESSAGES_DROPPED = Counter(
+    'venus_messages_dropped_total',
+    'Messages dropped because the receive queue was full.')
+MESSAGES_SHED = Counter(
+    'venus_messages_shed_total',
+    'Messages shed by level because the receive queue was filling up.',
+    labelnames=['level'])
+MESSAGES_SPILLED = Counter(
+    'venus_messages_spilled_total',
+    'Messages written to the spill log because the receive queue was full.')
+BATCHES_SPILLED = Counter(
+    'venus_batches_spilled_total',
+    'Batches written to the spill log because the sink write failed.')
+RECORDS_SPILLED = Counter(
+    'venus_records_spilled_total',
+    'Records written to the spill log because the sink write failed.')
+DECODE_FAILURES = Counter(
+    'venus_decode_failures_total', 'Messages that could not be decoded.')
+MISSING_CREATED = Counter(
+    'venus_messages_missing_created_total',
+    'Messages dropped because they have no "created" field.')
+MESSAGES_COMPRESSED = Counter(
+    'venus_messages_compressed_total',
+    'Messages that arrived compressed (zstd or lz4).')
+BATCH_MESSAGES = Counter(
+    'venus_batch_messages_total',
+    'Messages that arrived as a batch envelope of several records.')
+BATCHED_RECORDS = Counter(
+    'venus_batched_records_total', 'Records that arrived in batch envelopes.')
+QUEUE_DEPTH = Gauge(
+    'venus_queue_depth', 'Messages waiting in the receive queue.')
+HIGH_PRIORITY_QUEUE_DEPTH = Gauge(
+    'venus_high_priority_queue_depth',
+    'Messages waiting in the high-priority receive queue.')
+RECORDS_WRITTEN = Counter(
+    'venus_records_written_total', 'Records committed to the sink.')
+SINK_BATCHES_DROPPED = Counter(
+    'venus_sink_batches_dropped_total',
+    'Batches dropped because the buffer of a secondary sink was full.',
+    labelnames=['sink'])
+SINK_ERRORS = Counter(
+    'venus_sink_errors_total', 'Failed writes to a secondary sink.',
+    labelnames=['sink'])
+ROUTED_RECORDS_WRITTEN = Counter(
+    'venus_routed_records_written_total',
+    'Span and context records, and metric rows, written to their tables.',
+    labelnames=['table'])
+ROUTED_RECORDS_DROPPED = Counter(
+    'venus_routed_records_dropped_total',
+    'Span and context records, and metric rows, dropped, because their '
+    'writes kept failing or there is no postgres sink.',
+    labelnames=['table'])
+METRIC_SAMPLES_AGGREGATED = Counter(
+    'venus_metric_samples_aggregated_total',
+    'Metric samples added to the aggregates.')
+METRIC_SAMPLES_DROPPED = Counter(
+    'venus_metric_samples_dropped_total',
+    'Metric samples dropped, because METRIC_MAX_SERIES series were held.')
+METRIC_SERIES = Gauge(
+    'venus_metric_series', 'Metric series currently being aggregated.')
+BATCH_SIZE = Histogram(
+    'venus_batch_size', 'Records per committed batch.', buckets=SIZE_BUCKETS)
+INSERT_SECONDS = Histogram(
+    'venus_insert_seconds', 'Time taken to write a batch.')
+DB_ERRORS = Counter(
+    'venus_db_errors_total', 'Errors while writing batches to the DB (or sink).')
+INFLIGHT_BATCHES = Gauge(
+    'venus_inflight_batches', 'Batches currently being written.')
+TRACE_STAGE_SECONDS = Histogram(
+    'venus_trace_stage_seconds',
+    'Time from the previous stage to this one, for sampled messages.',
+    labelnames=['stage'])
+END_TO_END_LAG_SECONDS = Histogram(
+    'venus_end_to_end_lag_seconds',
+    'Time from "created" at the sender to the commit, for sampled messages.')
+WORKERS_ALIVE = Gauge(
+    'venus_workers_alive', 'Ingest worker processes that are alive.')
+BATCHING_BATCH_SIZE = Gauge(
+    'venus_batching_batch_size', 'Current batch size limit.')
+BATCHING_FLUSH_AGE = Gauge(
+    'venus_batching_flush_age_seconds', 'Current batch flush deadline.')
+TAIL_MESSAGES_PUBLISHED = Counter(
+    'venus_tail_messages_published_total',
+    'Messages published for live tailing, one per record and topic.')
+QUERY_REQUESTS = Counter(
+    'venus_query_requests_total', 'Requests to the query API.',
+    labelnames=['path', 'status'])
+QUERY_RECORDS = Counter(
+    'venus_query_records_total', 'Records streamed by the query API.')
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def serve(port: int, host: str = '0.0.0.0'):
+    """Long-running task serving ``GET /metrics``."""
+
+    async def connection(reader: StreamReader, writer: StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers; there is no request body for a GET.
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' \
+                    and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+            writer.close()
+        except Exception:  # pragma: no cover
+            logger.exception('Error in metrics endpoint:')
+
+    logger.info('Starting up the metrics listener on %s:%s', host, port)
+    server = await asyncio.start_server(connection, host=host, port=port)
+
+    try:
+        while True:
+            await asyncio.sleep(1)
+    except asyncio.CancelledError:
+        logger.warning('Shutting down the metrics listener.')
+        server.close()
+        await server.wait_closed()
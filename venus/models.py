@@ -1,7 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Any
 
 
 @dataclass
 class Message:
     level: bytes
     message: bytes
+    # Optional third frame. Empty means JSON, see `venus.decode`.
+    content_type: bytes = b''
+    # Set on sampled messages only, see `venus.tracing`. Not a frame.
+    trace: Any = field(default=None, init=False, repr=False, compare=False)
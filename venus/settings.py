@@ -1,6 +1,9 @@
 import logging
 import json
 import asyncio
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, FrozenSet, List
 from biodome import environ
 import consul.aio
 
@@ -12,6 +15,34 @@ DO_NOT_PRINT = {'password', 'pass', 'pw'}
 HEALTH_CHECK_PORT = environ.get('HEALTH_CHECK_PORT', 5000)
 HEALTH_CHECK_HOST = environ.get('HEALTH_CHECK_HOST', '0.0.0.0')
 
+# Prometheus-style metrics are served on http://host:port/metrics. A
+# port of 0 disables the endpoint. With INGEST_WORKERS, worker i serves
+# its own on WORKER_METRICS_PORT + i, and 0 disables those.
+METRICS_PORT = environ.get('METRICS_PORT', 9049)
+METRICS_HOST = environ.get('METRICS_HOST', '0.0.0.0')
+WORKER_METRICS_PORT = environ.get('WORKER_METRICS_PORT', 9150)
+
+# The HTTP query API, see `venus.api`. It is off unless QUERY_PORT is
+# set, and it has no authentication, so it only listens on localhost
+# unless QUERY_HOST says otherwise. It has its own pool of
+# QUERY_POOL_SIZE connections, separate from the writers. A page of
+# results has QUERY_DEFAULT_LIMIT records unless the request asks for
+# more, up to QUERY_MAX_LIMIT. A request waits up to
+# QUERY_ACQUIRE_TIMEOUT_SECONDS for a connection, a query statement runs
+# for up to QUERY_STATEMENT_TIMEOUT_SECONDS, and a client that stops
+# reading for QUERY_IDLE_TIMEOUT_SECONDS is disconnected.
+QUERY_PORT = environ.get('QUERY_PORT', 0)
+QUERY_HOST = environ.get('QUERY_HOST', '127.0.0.1')
+QUERY_POOL_SIZE = environ.get_callable('QUERY_POOL_SIZE', 4)
+QUERY_DEFAULT_LIMIT = environ.get_callable('QUERY_DEFAULT_LIMIT', 1000)
+QUERY_MAX_LIMIT = environ.get_callable('QUERY_MAX_LIMIT', 100000)
+QUERY_ACQUIRE_TIMEOUT_SECONDS = environ.get_callable(
+    'QUERY_ACQUIRE_TIMEOUT_SECONDS', 5.0)
+QUERY_STATEMENT_TIMEOUT_SECONDS = environ.get_callable(
+    'QUERY_STATEMENT_TIMEOUT_SECONDS', 30.0)
+QUERY_IDLE_TIMEOUT_SECONDS = environ.get_callable(
+    'QUERY_IDLE_TIMEOUT_SECONDS', 30.0)
+
 START_LOG_LEVEL = environ.get('START_LOG_LEVEL', 'DEBUG')
 
 ENABLE_CONSUL_REFRESH = environ.get_callable('ENABLE_CONSUL_REFRESH', True)
@@ -23,6 +54,24 @@ UPDATE_ENV_VAR_INTERVAL_SECONDS = environ.get_callable(
 )
 
 VENUS_PORT = environ.get_callable('VENUS_PORT', 5049)
+# Decoded records are republished for live tailing on this port, see
+# `venus.io.tail`. 0 disables it. A subscriber that falls behind by more
+# than TAIL_SNDHWM messages loses messages.
+TAIL_PORT = environ.get_callable('TAIL_PORT', 0)
+TAIL_HOST = environ.get_callable('TAIL_HOST', '*')
+TAIL_SNDHWM = environ.get_callable('TAIL_SNDHWM', 10000)
+# With INGEST_WORKERS > 0, the main process only runs a device that
+# forwards messages from VENUS_PORT to this many worker processes. Each
+# worker decodes and writes to the DB on its own.
+INGEST_WORKERS = environ.get_callable('INGEST_WORKERS', 0)
+WORKER_IPC_DIR = environ.get_callable('WORKER_IPC_DIR', tempfile.gettempdir())
+WORKER_SUPERVISE_INTERVAL_SECONDS = environ.get_callable(
+    'WORKER_SUPERVISE_INTERVAL_SECONDS', 5.0)
+# Maximum number of waiting messages received from the socket in one go
+# and handed to the DB side as a single list.
+RECV_DRAIN_MAX = environ.get_callable('RECV_DRAIN_MAX', 1000)
+# Upper limit on the size of a decompressed message body.
+DECOMPRESS_MAX_BYTES = environ.get_callable('DECOMPRESS_MAX_BYTES', 16 * 1024 * 1024)
 DROP_FIELDS = environ.get_callable(
     'DROP_FIELDS', [
         'stack_info',
@@ -36,9 +85,183 @@ DROP_FIELDS = environ.get_callable(
     ]
 )
 
+# Record fields that are stored in typed columns of the ``logs`` table,
+# rather than in ``data``. Each must be one of the columns added for
+# this, see `venus.decode.PROMOTABLE_FIELDS`. Read once at startup.
+PROMOTED_FIELDS = environ.get_callable(
+    'PROMOTED_FIELDS', ['levelno', 'name', 'pathname', 'hostname', 'app'])
+
+# Load shedding by level, before the receive queue is full. Above
+# SHED_DEBUG_WATERMARK (a fraction of the queue size), a shrinking share
+# of DEBUG messages is admitted, down to none when the queue is full.
+# The same for INFO above SHED_INFO_WATERMARK. WARNING and above are not
+# shed. A watermark of 1.0 disables shedding of that level.
+SHED_DEBUG_WATERMARK = environ.get_callable('SHED_DEBUG_WATERMARK', 0.5)
+SHED_INFO_WATERMARK = environ.get_callable('SHED_INFO_WATERMARK', 0.8)
+
 MAX_BATCH_SIZE = environ.get_callable('MAX_BATCH_SIZE', 100)
 MAX_BATCH_AGE_SECONDS = environ.get_callable(
-    'MAX_BATCH_AGE_SECONDS', 5)
+    'MAX_BATCH_AGE_SECONDS', 5.0)
+# With ADAPTIVE_BATCHING, the batch size and flush deadline are tuned
+# between the MIN_ and MAX_ values from the arrival rate and insert
+# latency. Otherwise the MAX_ values are used as they are.
+ADAPTIVE_BATCHING = environ.get_callable('ADAPTIVE_BATCHING', False)
+MIN_BATCH_SIZE = environ.get_callable('MIN_BATCH_SIZE', 10)
+MIN_BATCH_AGE_SECONDS = environ.get_callable('MIN_BATCH_AGE_SECONDS', 0.05)
+
+# Messages of these levels go through a separate, smaller queue and
+# writer pipeline of their own, so that they are not held up behind a
+# flood of lower-level messages. Their batches are flushed after at most
+# HIGH_PRIORITY_MAX_BATCH_AGE_SECONDS. An empty list disables this. A
+# batch envelope of more than HIGH_PRIORITY_MAX_ENVELOPE_RECORDS records,
+# or a compressed one, stays in the normal lane whatever its level. The
+# queue sizes count messages, not records.
+HIGH_PRIORITY_LEVELS = environ.get_callable(
+    'HIGH_PRIORITY_LEVELS', ['ERROR', 'CRITICAL'])
+HIGH_PRIORITY_MAX_BATCH_AGE_SECONDS = environ.get_callable(
+    'HIGH_PRIORITY_MAX_BATCH_AGE_SECONDS', 0.5)
+HIGH_PRIORITY_INFLIGHT_BATCHES = environ.get_callable(
+    'HIGH_PRIORITY_INFLIGHT_BATCHES', 1)
+HIGH_PRIORITY_QUEUE_SIZE = environ.get_callable('HIGH_PRIORITY_QUEUE_SIZE', 8192)
+HIGH_PRIORITY_MAX_ENVELOPE_RECORDS = environ.get_callable(
+    'HIGH_PRIORITY_MAX_ENVELOPE_RECORDS', 10)
+
+# The number of batches that may be committing to the DB concurrently,
+# each on its own connection. Collecting the next batch carries on
+# while these are in flight.
+MAX_INFLIGHT_BATCHES = environ.get_callable('MAX_INFLIGHT_BATCHES', 4)
+WRITE_RETRY_MAX_SECONDS = environ.get_callable('WRITE_RETRY_MAX_SECONDS', 10.0)
+
+# Local spill log for data that cannot be queued or written to the DB.
+# An empty SPILL_DIR disables spilling.
+SPILL_DIR = environ.get_callable('SPILL_DIR', '')
+SPILL_SEGMENT_BYTES = environ.get_callable('SPILL_SEGMENT_BYTES', 16 * 1024 * 1024)
+SPILL_MAX_BYTES = environ.get_callable('SPILL_MAX_BYTES', 1024 ** 3)
+SPILL_FSYNC = environ.get_callable('SPILL_FSYNC', False)
+SPILL_DRAIN_INTERVAL_SECONDS = environ.get_callable(
+    'SPILL_DRAIN_INTERVAL_SECONDS', 5.0)
+SPILL_DRAIN_BATCH_SIZE = environ.get_callable('SPILL_DRAIN_BATCH_SIZE', 10000)
+
+# With DECODE_WORKERS > 0, JSON decoding and field extraction happen in
+# a pool of that many processes, in chunks of DECODE_CHUNK_SIZE messages.
+DECODE_WORKERS = environ.get_callable('DECODE_WORKERS', 0)
+DECODE_CHUNK_SIZE = environ.get_callable('DECODE_CHUNK_SIZE', 500)
+
+# Fraction of messages whose progress through the pipeline is traced,
+# e.g. 0.01 for 1 in 100. Zero disables tracing.
+TRACE_SAMPLE_RATE = environ.get_callable('TRACE_SAMPLE_RATE', 0.0)
+
+# "auto" uses orjson if it is installed, else the stdlib json module.
+JSON_CODEC = environ.get_callable('JSON_CODEC', 'auto')
+
+# Comma-separated list of where batches go: "postgres", "ndjson" (files
+# at NDJSON_PATH) or "null" (discarded). The first sink is the primary:
+# failed writes to it are retried or spilled. Any others are fed from a
+# buffer of up to SINK_BUFFER_BATCHES batches each, and batches are
+# dropped when that is full.
+SINKS = environ.get_callable('SINKS', 'postgres')
+SINK_BUFFER_BATCHES = environ.get_callable('SINK_BUFFER_BATCHES', 100)
+# Spans, context and metrics go to their own tables, see `venus.db.routed`,
+# and only if "postgres" is one of the SINKS. While their writes fail, up
+# to ROUTED_BUFFER_BATCHES batches of each are kept.
+ROUTED_BUFFER_BATCHES = environ.get_callable('ROUTED_BUFFER_BATCHES', 10)
+# Metric samples are aggregated per series (name and tags) over windows
+# of METRIC_WINDOW_SECONDS, and a window is written METRIC_LATENESS_SECONDS
+# after it ends, to wait for late samples. At most METRIC_MAX_SERIES
+# series are held at once; samples of new series beyond that are dropped.
+# Quantiles are within METRIC_RELATIVE_ACCURACY of the true values.
+METRIC_WINDOW_SECONDS = environ.get_callable('METRIC_WINDOW_SECONDS', 10.0)
+METRIC_LATENESS_SECONDS = environ.get_callable('METRIC_LATENESS_SECONDS', 2.0)
+METRIC_MAX_SERIES = environ.get_callable('METRIC_MAX_SERIES', 10000)
+METRIC_RELATIVE_ACCURACY = environ.get_callable('METRIC_RELATIVE_ACCURACY', 0.01)
+# The NDJSON file is rotated when NDJSON_ROTATE_BYTES (uncompressed) have
+# been written to it. Zero disables rotation.
+NDJSON_PATH = environ.get_callable('NDJSON_PATH', 'venus-logs.ndjson')
+NDJSON_ROTATE_BYTES = environ.get_callable('NDJSON_ROTATE_BYTES', 64 * 1024 * 1024)
+NDJSON_COMPRESS = environ.get_callable('NDJSON_COMPRESS', True)
+NDJSON_COMPRESS_LEVEL = environ.get_callable('NDJSON_COMPRESS_LEVEL', 6)
+
+# How batches are written to the logs table, also when replaying the
+# spill log, and to the metric table. "copy" uses the binary COPY
+# protocol, which is much faster. "insert" uses the older executemany
+# path, for when COPY is not available.
+DB_WRITE_MODE = environ.get_callable('DB_WRITE_MODE', 'copy')
+
+
+@dataclass(frozen=True)
+class Config:
+    """Immutable snapshot of the settings read on the hot path, so that
+    they are not parsed from the environment for every message. Read
+    them as attributes of `CONFIG`, which is replaced (never mutated)
+    whenever the values change."""
+    drop_fields: FrozenSet[str]
+    decompress_max_bytes: int
+    max_batch_size: int
+    max_batch_age_seconds: float
+    min_batch_size: int
+    min_batch_age_seconds: float
+    write_retry_max_seconds: float
+    db_write_mode: str
+    shed_debug_watermark: float
+    shed_info_watermark: float
+    high_priority_levels: FrozenSet[bytes]
+    high_priority_max_batch_age_seconds: float
+    high_priority_max_envelope_records: int
+    routed_buffer_batches: int
+
+    @classmethod
+    def load(cls) -> 'Config':
+        return cls(
+            drop_fields=frozenset(DROP_FIELDS()),
+            decompress_max_bytes=DECOMPRESS_MAX_BYTES(),
+            max_batch_size=MAX_BATCH_SIZE(),
+            max_batch_age_seconds=float(MAX_BATCH_AGE_SECONDS()),
+            min_batch_size=MIN_BATCH_SIZE(),
+            min_batch_age_seconds=float(MIN_BATCH_AGE_SECONDS()),
+            write_retry_max_seconds=float(WRITE_RETRY_MAX_SECONDS()),
+            db_write_mode=DB_WRITE_MODE(),
+            shed_debug_watermark=float(SHED_DEBUG_WATERMARK()),
+            shed_info_watermark=float(SHED_INFO_WATERMARK()),
+            high_priority_levels=frozenset(
+                level.encode() for level in HIGH_PRIORITY_LEVELS()),
+            high_priority_max_batch_age_seconds=float(
+                HIGH_PRIORITY_MAX_BATCH_AGE_SECONDS()),
+            high_priority_max_envelope_records=(
+                HIGH_PRIORITY_MAX_ENVELOPE_RECORDS()),
+            routed_buffer_batches=ROUTED_BUFFER_BATCHES(),
+        )
+
+
+CONFIG: Config = Config.load()
+SUBSCRIBERS: List[Callable[[Config, Config], None]] = []
+
+
+def subscribe(callback: Callable[[Config, Config], None]):
+    """``callback(old, new)`` is called after every change of `CONFIG`."""
+    SUBSCRIBERS.append(callback)
+
+
+def unsubscribe(callback: Callable[[Config, Config], None]):
+    if callback in SUBSCRIBERS:
+        SUBSCRIBERS.remove(callback)
+
+
+def refresh_config() -> bool:
+    """Reload `CONFIG` from the environment. It is only replaced, and
+    the subscribers notified, if any value has changed. Returns whether
+    it was replaced."""
+    global CONFIG
+    new = Config.load()
+    if new == CONFIG:
+        return False
+    old, CONFIG = CONFIG, new
+    logger.info('Configuration changed: %s', new)
+    for callback in list(SUBSCRIBERS):
+        try:
+            callback(old, new)
+        except Exception:
+            logger.exception('Error in configuration subscriber %r', callback)
+    return True
 
 
 async def refresh_from_configuration():
@@ -57,7 +280,8 @@ async def refresh_from_configuration():
     while True:
         try:
             if ENABLE_CONSUL_REFRESH():
-                await load_new_env_vars(c)
+                if await load_new_env_vars(c):
+                    refresh_config()
                 await load_new_logger_levels(c)
             await asyncio.sleep(UPDATE_ENV_VAR_INTERVAL_SECONDS())
         except asyncio.CancelledError:
@@ -69,13 +293,15 @@ async def refresh_from_configuration():
             await asyncio.sleep(UPDATE_ENV_VAR_INTERVAL_SECONDS())
 
 
-async def load_new_env_vars(consul: consul.aio.Consul):
+async def load_new_env_vars(consul: consul.aio.Consul) -> bool:
+    """Returns whether any env var was changed."""
+    changed = False
     try:
         index, key_data = await consul.kv.get(CONSUL_ENV_KV_PATH)
         if not key_data:
             logger.debug(f'No environment config defined at '
                          f'{CONSUL_ENV_KV_PATH}. Skipping.')
-            return
+            return False
         data = key_data['Value']
         env_data = json.loads(data.decode('utf-8'))
         # Extract the items with common keys from current env
@@ -95,10 +321,12 @@ async def load_new_env_vars(consul: consul.aio.Consul):
             )
             try:
                 environ[k] = str(v)
+                changed = True
             except ValueError:
                 logger.exception(f'Problem updating {k}')
     except:
         logger.exception('Error when updating env vars')
+    return changed
 
 
 async def load_new_logger_levels(consul: consul.aio.Consul):
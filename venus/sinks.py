@@ -0,0 +1,320 @@
+"""
+Destinations for batches of decoded records.
+
+The sinks are selected with the ``SINKS`` setting, a comma-separated
+list of:
+
+- ``postgres`` (default): the ``logs`` table.
+- ``ndjson``: one JSON object per line in ``NDJSON_PATH``, gzipped and
+  rotated by size.
+- ``null``: discard everything. Useful for profiling the rest of the
+  pipeline on its own.
+
+With more than one, the first is the primary and the others get a copy
+of every batch once the primary has taken it. Each of the others has
+its own bounded buffer and writer task, so a slow or broken secondary
+sink only ever loses its own batches, and never holds up the primary.
+"""
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
+from uuid import UUID
+
+from asyncpg import Connection
+
+from . import codec
+from . import metrics
+from . import settings
+from .db import get_db_pool
+from .decode import LOG_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+
+class Sink:
+    name = ''
+
+    async def write(self, records: List[Tuple],
+                    columns: Sequence[str] = LOG_COLUMNS):
+        raise NotImplementedError
+
+    async def write_many(self, batches: Dict[Tuple, List[Tuple]]):
+        """Write several batches, keyed by their columns. Used when
+        replaying the spill log."""
+        for columns, records in batches.items():
+            await self.write(records, columns)
+
+    async def close(self):
+        pass
+
+
+class PostgresSink(Sink):
+    name = 'postgres'
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        pool = get_db_pool()
+        async with pool.acquire() as conn:  # type: Connection
+            logger.debug('Writing %d records to DB', len(records))
+            await write_records(conn, records, columns=columns)
+
+    async def write_many(self, batches):
+        """All the batches are written in a single transaction."""
+        pool = get_db_pool()
+        chunk_size = settings.SPILL_DRAIN_BATCH_SIZE()
+        async with pool.acquire() as conn:  # type: Connection
+            async with conn.transaction():
+                for columns, records in batches.items():
+                    for i in range(0, len(records), chunk_size):
+                        await write_records(conn, records[i:i + chunk_size],
+                                            columns=columns)
+
+
+class NullSink(Sink):
+    name = 'null'
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        pass
+
+
+class NdjsonSink(Sink):
+    """Lines are written from a single thread, so that compressing and
+    writing the file does not block the event loop. Gzipped files are
+    not flushed after every batch, since that hurts the compression."""
+    name = 'ndjson'
+
+    def __init__(self, path: str, rotate_bytes: int = 0, compress=False,
+                 compress_level: int = 6):
+        self.path = path + '.gz' if compress else path
+        self.rotate_bytes = rotate_bytes
+        self.compress = compress
+        self.compress_level = compress_level
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='ndjson')
+        self.file = None
+        self.written = 0
+        # Start a new file rather than appending to one from an earlier run.
+        if rotate_bytes and os.path.exists(self.path):
+            self.rotate()
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.write_lines,
+                                   records, columns)
+
+    def write_lines(self, records, columns):
+        if self.file is None:
+            self.open()
+        data = b''.join(ndjson_line(columns, r) for r in records)
+        self.file.write(data)
+        if not self.compress:
+            self.file.flush()
+        self.written += len(data)
+        if self.rotate_bytes and self.written >= self.rotate_bytes:
+            self.rotate()
+
+    def open(self):
+        if self.compress:
+            self.file = gzip.open(self.path, 'ab',
+                                  compresslevel=self.compress_level)
+        else:
+            self.file = open(self.path, 'ab')
+        self.written = 0
+
+    def rotate(self):
+        """Move the current file aside, with a timestamp in its name.
+        The next write starts a new file."""
+        if self.file:
+            self.file.close()
+            self.file = None
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f')
+        root, ext = os.path.splitext(self.path[:-3] if self.compress
+                                     else self.path)
+        rotated = f'{root}.{stamp}{ext}' + ('.gz' if self.compress else '')
+        os.replace(self.path, rotated)
+        logger.info('Rotated %s to %s', self.path, rotated)
+
+    async def close(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.close_file)
+        self.executor.shutdown()
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class BufferedSink(Sink):
+    """Feeds a secondary sink from a bounded buffer in its own task.
+    `offer` never waits: when the buffer is full, the batch is dropped.
+    Failed writes are logged and not retried."""
+
+    def __init__(self, sink: Sink, maxsize: int):
+        self.sink = sink
+        self.name = sink.name
+        self.buffer = asyncio.Queue(maxsize=maxsize)
+        self.task: asyncio.Task = None
+
+    def offer(self, records: List[Tuple], columns: Sequence[str]):
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.pump())
+        try:
+            # A copy, because the caller clears its list after the write.
+            self.buffer.put_nowait((list(records), columns))
+        except asyncio.QueueFull:
+            metrics.SINK_BATCHES_DROPPED.inc(sink=self.name)
+            logger.warning('Buffer for the %s sink is full. Dropped a '
+                           'batch of %d records.', self.name, len(records))
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        self.offer(records, columns)
+
+    async def pump(self):
+        while True:
+            item = await self.buffer.get()
+            if item is None:
+                break
+            await self.write_one(*item)
+
+    async def write_one(self, records, columns):
+        try:
+            await self.sink.write(records, columns)
+        except Exception:
+            metrics.SINK_ERRORS.inc(sink=self.name)
+            logger.exception('Error writing %d records to the %s sink. '
+                             'They are dropped.', len(records), self.name)
+
+    async def close(self):
+        """Write out whatever is still buffered, then close."""
+        if self.task:
+            await self.buffer.put(None)
+            await self.task
+        await self.sink.close()
+
+
+class FanoutSink(Sink):
+    """Writes go to the primary first. Only once the primary has
+    succeeded are the batches offered to the secondaries, so that
+    retries of the primary do not produce duplicates there."""
+
+    def __init__(self, primary: Sink, secondaries: List[BufferedSink]):
+        self.primary = primary
+        self.secondaries = secondaries
+        self.name = ','.join(s.name for s in [primary] + secondaries)
+
+    async def write(self, records, columns=LOG_COLUMNS):
+        await self.primary.write(records, columns)
+        for sink in self.secondaries:
+            sink.offer(records, columns)
+
+    async def write_many(self, batches):
+        await self.primary.write_many(batches)
+        for columns, records in batches.items():
+            for sink in self.secondaries:
+                sink.offer(records, columns)
+
+    async def close(self):
+        for sink in [self.primary] + self.secondaries:
+            await sink.close()
+
+
+def ndjson_line(columns: Sequence[str], record: Tuple) -> bytes:
+    """Values that are bytes are already-encoded JSON, and are embedded
+    as they are."""
+    parts = []
+    for column, value in zip(columns, record):
+        if not isinstance(value, bytes):
+            value = codec.dumps(json_value(value))
+        parts.append(b'"%s":%s' % (column.encode(), value))
+    return b'{' + b','.join(parts) + b'}\n'
+
+
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    return value
+
+
+async def write_records(conn: Connection, records: List, table='logs',
+                        columns: Sequence[str] = LOG_COLUMNS):
+    """Write the records with `copy_records`, or `insert_records` if
+    ``DB_WRITE_MODE`` is "insert"."""
+    if settings.CONFIG.db_write_mode == 'insert':
+        await insert_records(conn, records, table=table, columns=columns)
+    else:
+        await copy_records(conn, records, table=table, columns=columns)
+
+
+async def copy_records(conn: Connection, records: List, table='logs',
+                       columns: Sequence[str] = LOG_COLUMNS):
+    """Write the records using the binary COPY protocol. This is the
+    fastest way to get rows into the database."""
+    await conn.copy_records_to_table(table, records=records,
+                                     columns=list(columns))
+
+
+async def insert_records(conn: Connection, records: List, table='logs',
+                         columns: Sequence[str] = LOG_COLUMNS):
+    """Fallback writer using executemany. Much slower than COPY, but
+    kept around in case COPY is not available (e.g., some proxies
+    do not support the COPY protocol)."""
+    names = ', '.join(columns)
+    placeholders = ', '.join(f'${i + 1}' for i in range(len(columns)))
+    await conn.executemany(
+        f'INSERT INTO {table} ({names}) VALUES ({placeholders})', records)
+
+
+SINK: Sink = None
+
+
+def open_sink(name: str) -> Sink:
+    if name == 'postgres':
+        return PostgresSink()
+    if name == 'null':
+        return NullSink()
+    if name == 'ndjson':
+        return NdjsonSink(
+            settings.NDJSON_PATH(),
+            rotate_bytes=settings.NDJSON_ROTATE_BYTES(),
+            compress=settings.NDJSON_COMPRESS(),
+            compress_level=settings.NDJSON_COMPRESS_LEVEL(),
+        )
+    raise ValueError(f'Unknown sink: {name}')
+
+
+def sink_names(names: str = None) -> List[str]:
+    """``names`` is a comma-separated list, as in the ``SINKS`` setting."""
+    return [n.strip() for n in (names or settings.SINKS()).split(',')
+            if n.strip()]
+
+
+def open_sinks(names: str = None) -> Sink:
+    names = sink_names(names)
+    if not names:
+        raise ValueError('No sinks configured')
+    primary = open_sink(names[0])
+    if len(names) == 1:
+        return primary
+    maxsize = settings.SINK_BUFFER_BATCHES()
+    return FanoutSink(
+        primary, [BufferedSink(open_sink(n), maxsize) for n in names[1:]])
+
+
+def get_sink() -> Sink:
+    global SINK
+    if SINK is None:
+        SINK = open_sinks()
+        logger.info('Writing records to the %s sink(s)', SINK.name)
+    return SINK
+
+
+async def close_sink():
+    global SINK
+    if SINK:
+        sink, SINK = SINK, None
+        await sink.close()
@@ -0,0 +1,105 @@
+"""
+Sampled per-stage latency tracing.
+
+With ``TRACE_SAMPLE_RATE`` > 0, every Nth received message (N = 1/rate)
+gets a `Trace` that is stamped as it moves through the pipeline:
+
+    received -> dequeued -> decoded -> flush_start -> committed
+
+After the commit, the time spent between consecutive stages goes into
+the ``venus_trace_stage_seconds`` histogram, and the lag between the
+sender's ``created`` timestamp and the commit into
+``venus_end_to_end_lag_seconds``.
+
+Stamps after decoding are taken per batch: a sampled message is
+attributed to the batch being filled when its chunk was decoded, which
+is accurate to within one batch.
+
+Messages that are not sampled carry no trace. When sampling is
+disabled, no sampler is created and the pipeline skips all of this.
+"""
+import logging
+import time
+from collections import Counter
+from typing import Iterable, List
+
+from . import metrics
+from . import settings
+from .decode import load_body, unpack
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('received', 'dequeued', 'decoded', 'flush_start', 'committed')
+
+
+class Trace:
+    __slots__ = ('stamps', 'payload', 'content_type')
+
+    def __init__(self):
+        self.stamps = dict(received=time.time())
+        self.payload = None
+        self.content_type = b''
+
+    def stamp(self, stage: str):
+        self.stamps[stage] = time.time()
+
+
+class Sampler:
+    """Pick every ``stride``-th message across successive chunks."""
+    def __init__(self, rate: float):
+        self.stride = max(1, round(1 / rate))
+        self.countdown = self.stride
+
+    def sample(self, msgs: List):
+        n = len(msgs)
+        if n < self.countdown:
+            self.countdown -= n
+            return
+
+        i = self.countdown - 1
+        while i < n:
+            msg = msgs[i]
+            msg.trace = Trace()
+            msg.trace.payload = msg.message
+            msg.trace.content_type = msg.content_type
+            i += self.stride
+        self.countdown = i - n + 1
+
+
+def make_sampler() -> Sampler:
+    """Returns None when tracing is disabled."""
+    rate = settings.TRACE_SAMPLE_RATE()
+    if rate <= 0:
+        return None
+    logger.info('Tracing 1 in every %d messages', round(1 / rate))
+    return Sampler(min(rate, 1.0))
+
+
+def stamp_all(traces: Iterable[Trace], stage: str):
+    now = time.time()
+    for trace in traces:
+        trace.stamps[stage] = now
+
+
+def record(traces: Iterable[Trace]):
+    """Move the stamps of completed traces into the histograms."""
+    for trace in traces:
+        previous = None
+        for stage in STAGES:
+            t = trace.stamps.get(stage)
+            if t is None:
+                continue
+            if previous is not None:
+                metrics.TRACE_STAGE_SECONDS.observe(t - previous, stage=stage)
+            previous = t
+
+        committed = trace.stamps.get('committed')
+        if committed is None:
+            continue
+        try:
+            # For a batch, the first record stands in for all of them.
+            body = unpack(trace.payload, Counter())[0]
+            created = float(load_body(body, trace.content_type)['created'])
+        except Exception:
+            continue
+        metrics.END_TO_END_LAG_SECONDS.observe(committed - created)
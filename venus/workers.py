@@ -0,0 +1,168 @@
+"""
+Multi-process ingest.
+
+The main process binds ``VENUS_PORT`` with a PULL socket and forwards
+every message to a PUSH socket bound on an ipc:// address. This is a
+plain ZMQ streamer device, so the forwarding itself runs in a
+background thread without the GIL. Each of the N worker processes
+connects a PULL socket to that address and runs its own `collect`
+pipeline and DB pool. ZMQ load-balances the messages across the
+workers.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+from pathlib import Path
+from typing import List, Optional
+from weakref import WeakValueDictionary
+
+import aiorun
+import zmq
+import zmq.devices
+
+from . import metrics
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+# Workers must not inherit the parent's ZMQ context, so they are never
+# forked.
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def worker_address() -> str:
+    path = Path(settings.WORKER_IPC_DIR()) / f'venus-{os.getpid()}.ipc'
+    return f'ipc://{path}'
+
+
+def start_device(address: str) -> zmq.devices.ThreadDevice:
+    device = zmq.devices.ThreadDevice(zmq.STREAMER, zmq.PULL, zmq.PUSH)
+    device.bind_in(f'tcp://*:{settings.VENUS_PORT():d}')
+    device.bind_out(address)
+    device.setsockopt_in(zmq.LINGER, 1)
+    device.setsockopt_out(zmq.LINGER, 1)
+    device.start()
+    logger.info('Forwarding from port %d to workers on %s',
+                settings.VENUS_PORT(), address)
+    return device
+
+
+class WorkerPool:
+    def __init__(self, n: int, address: str, tail_address: str = None):
+        self.address = address
+        self.tail_address = tail_address
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * n
+        self.restarts = 0
+
+    def start_worker(self, index: int):
+        proc = MP_CONTEXT.Process(
+            target=worker_main, args=(index, self.address, self.tail_address),
+            name=f'venus-worker-{index}', daemon=False,
+        )
+        proc.start()
+        self.processes[index] = proc
+        logger.info('Started ingest worker %d (pid %d)', index, proc.pid)
+
+    def start(self):
+        for i in range(len(self.processes)):
+            self.start_worker(i)
+
+    def dead(self) -> List[int]:
+        return [i for i, p in enumerate(self.processes)
+                if p is None or not p.is_alive()]
+
+    def restart_dead(self):
+        for i in self.dead():
+            proc = self.processes[i]
+            logger.error('Ingest worker %d (pid %s) exited with code %s. '
+                         'Restarting.', i, proc and proc.pid,
+                         proc and proc.exitcode)
+            self.restarts += 1
+            self.start_worker(i)
+
+    def health(self) -> str:
+        """Payload for the health check endpoint."""
+        dead = self.dead()
+        if not dead:
+            return 'ok'
+        return (f'degraded: {len(dead)}/{len(self.processes)} workers '
+                f'not alive ({", ".join(map(str, dead))})')
+
+    def stop(self, timeout=10.0):
+        for p in self.processes:
+            if p and p.is_alive():
+                p.terminate()
+        for p in self.processes:
+            if p:
+                p.join(timeout)
+                if p.is_alive():
+                    logger.warning('Worker pid %d did not exit. Killing.', p.pid)
+                    p.kill()
+
+
+async def supervise(pool: WorkerPool):
+    """Long-running task that restarts workers that have died. The
+    workers are stopped when this task is cancelled."""
+    try:
+        while True:
+            await asyncio.sleep(settings.WORKER_SUPERVISE_INTERVAL_SECONDS())
+            pool.restart_dead()
+    except asyncio.CancelledError:
+        logger.info('Stopping ingest workers')
+        await asyncio.get_event_loop().run_in_executor(None, pool.stop)
+
+
+async def worker_amain(index: int, address: str,
+                       tail_address: str = None) -> WeakValueDictionary:
+    """Like `venus.main.amain`, but receives from the device instead
+    of binding to the port. Live tail messages go to the proxy at
+    ``tail_address``."""
+    # Deferred imports: these pull in the DB and IO layers, which the
+    # main process does not need in worker mode.
+    import venus.db.write
+    from . import db, io
+    from .db import spill
+    from .decode import record_columns
+    from .io import tail
+
+    loop = asyncio.get_event_loop()
+    tasks_created = WeakValueDictionary()
+
+    tasks_created['db_pool'] = loop.create_task(db.activate())
+    tasks_created['config'] = loop.create_task(
+        settings.refresh_from_configuration())
+
+    if settings.SPILL_DIR():
+        spill.open_spill(Path(settings.SPILL_DIR()) / f'worker-{index}')
+    if spill.get_spill():
+        tasks_created['spill'] = loop.create_task(venus.db.write.drain_spill())
+
+    pull_queue = io.MessageQueue(maxsize=65536)
+    metrics.QUEUE_DEPTH.set_function(pull_queue.qsize)
+    high_queue = io.make_high_priority_queue()
+    if tail_address:
+        tail.open_publisher(record_columns(), tail_address)
+    tasks_created['zmq'] = loop.create_task(io.zmq_connection_manager(
+        pull_queue, address, bind=False, high_queue=high_queue))
+    tasks_created['db_writer'] = loop.create_task(
+        venus.db.write.collect(pull_queue, high_queue))
+
+    if settings.METRICS_PORT and settings.WORKER_METRICS_PORT:
+        tasks_created['metrics'] = loop.create_task(metrics.serve(
+            port=settings.WORKER_METRICS_PORT + index,
+            host=settings.METRICS_HOST,
+        ))
+    return tasks_created
+
+
+def worker_main(index: int, address: str, tail_address: str = None):
+    from . import io
+
+    logging.basicConfig(
+        level=settings.START_LOG_LEVEL, stream=sys.stdout,
+        format=f'[worker-{index}] %(levelname)s:%(name)s:%(message)s'
+    )
+    with io.zmq_context():
+        aiorun.run(worker_amain(index, address, tail_address))